@@ -1,10 +1,9 @@
 from app import create_app
+from config import Config
 
-# TODO: construct a config using environment variables
-
-# TODO: pass the config into the app
-app = create_app()
+# Config reads the Mongo connection string, pool size and timeouts from MONGO_* environment variables
+app = create_app(Config)
 
 if __name__ == '__main__':
     print('Starting server...')
-    app.run(host='0.0.0.0', port=5000)
\ No newline at end of file
+    app.run(host='0.0.0.0', port=5000)
@@ -3,28 +3,158 @@ from config import Config
 from app.routes.client import client_bp
 from app.routes.worker_node import worker_node_bp
 from app.routes.main import main_bp
+from app.routes.tiles import tiles_bp
+from app.utilities.composite_cache import CompositeCache, TileCache
 from app.utilities.database import DataBase
+from app.utilities.fair_share import FairShareIndex
+from app.utilities.ingest import RECEIPTS_COLLECTION, IngestPool
+from app.utilities.node_load import NodeLoadIndex
+from app.utilities.notifier import TaskNotifier, start_assignment_watcher
+from app.utilities.preview import PREVIEW_COLLECTION
+from app.utilities.pyramid import PYRAMIDS_COLLECTION, TILES_COLLECTION
+from app.utilities.reaper import start_reaper
+from app.utilities.result_cache import ensure_result_cache
+from app.utilities.speculation import SPECULATION_COLLECTION
+from app.utilities.stragglers import StragglerIndex
+from app.utilities.task_store import backfill_priority_levels, create_task_store
+from app.utilities.migrate_tasks import migrate_task_storage_command
+from app.utilities.mongo import client_options
+from flask import jsonify
+from pymongo.errors import PyMongoError
 import os
+import threading
 
-connection_string = os.getenv("MONGO_CONNECTION_STRING")
 dbs = ["jobs_and_tasks", "computing_nodes"]
 
+# Serializes start_process between the request threads of one process
+_startup_lock = threading.Lock()
+
 
 def create_app(config_class=Config) -> ExtendedFlask:
     # Instantiate our subclass instead of plain Flask
     app = ExtendedFlask(__name__)
     app.config.from_object(config_class)
 
-    # Attach DB instances to the ExtendedFlask object
-    app.jobs_and_tasks_db = DataBase(connection_string, dbs[0])
-    app.computing_nodes_db = DataBase(connection_string, dbs[1])
+    # Attach DB instances to the ExtendedFlask object. Both share the process's Mongo client, which connects on first use
+    options = client_options(app.config)
+    app.jobs_and_tasks_db = DataBase(app.config["MONGO_CONNECTION_STRING"], dbs[0], options)
+    app.computing_nodes_db = DataBase(app.config["MONGO_CONNECTION_STRING"], dbs[1], options)
+
+    # Task storage layout ("per-node" collections or one "unified" tasks collection)
+    app.task_store = create_task_store(app.config["TASK_STORAGE"], app.jobs_and_tasks_db, app.computing_nodes_db)
+
+    # Local LRU cache of encoded job composites served with ETags
+    app.composite_cache = CompositeCache(app.config["COMPOSITE_CACHE_DIR"], app.config["COMPOSITE_CACHE_MAX_BYTES"])
+
+    # In-memory LRU of encoded pyramid tiles
+    app.tile_cache = TileCache(app.config["TILE_MEMORY_CACHE_BYTES"])
+
+    # Inbox depth index used to pick the least loaded node, rebuilt from Mongo when stale
+    app.node_load = NodeLoadIndex(app.config["NODE_LOAD_REBUILD_SECONDS"])
+
+    # Weighted fair-share order over clients with tasks in the unassigned pool, rebuilt from Mongo when stale
+    app.fair_share = FairShareIndex(
+        app.config["CLIENT_WEIGHTS"],
+        half_life_seconds=app.config["FAIR_SHARE_HALF_LIFE_SECONDS"],
+        max_age_seconds=app.config["FAIR_SHARE_REBUILD_SECONDS"]
+    )
+
+    # Straggler tasks idle nodes may copy, rescanned every SPECULATION_SCAN_SECONDS at most
+    app.stragglers = StragglerIndex(app.config["SPECULATION_SCAN_SECONDS"])
+
+    # Wakes long-polling nodes when tasks land in their inbox, replaced along with the watcher in start_process
+    app.task_notifier = TaskNotifier()
+    app.ingest_pool = None
 
     # Register blueprints (ensure 'client_bp' is imported after ExtendedFlask is defined)
     from app.routes.client import client_bp
     from app.routes.worker_node import worker_node_bp
     from app.routes.main import main_bp
+    from app.routes.tiles import tiles_bp
     app.register_blueprint(client_bp)
+    app.register_blueprint(tiles_bp)
     app.register_blueprint(worker_node_bp)
     app.register_blueprint(main_bp)
+    app.cli.add_command(migrate_task_storage_command)
+
+    # Indexes and background threads, once per process: before its first request, or now without LAZY_STARTUP
+    app.started_pid = None
+
+    @app.before_request
+    def start_process_on_first_request():
+        try:
+            start_process(app)
+        except PyMongoError as e:
+            app.logger.error(f"Startup failed, retrying on the next request: {e}")
+            return jsonify({"error": "Database unavailable"}), 503
+
+    if not app.config["LAZY_STARTUP"]:
+        start_process(app)
+
+    return app
+
+
+def start_process(app: ExtendedFlask):
+    """
+    Prepares the database and starts the background threads, once per process. A forked worker
+    inherits neither the parent's threads nor its Mongo client, so it runs this again itself.
+
+    Raises:
+        pymongo.errors.PyMongoError: If the database is unreachable. Nothing is marked as started,
+            so the next call tries again.
+    """
+    if app.started_pid == os.getpid():
+        return
+    with _startup_lock:
+        if app.started_pid == os.getpid():
+            return
+        prepare_database(app)
+        start_background_threads(app)
+        app.started_pid = os.getpid()
+
+
+def prepare_database(app: ExtendedFlask):
+    """
+    Creates every index the app relies on, and the result cache's sentinel node. Existing ones are left alone.
+    Tasks and jobs stored before priority levels existed get one, so they do not jump the dispatch order.
+    """
+    app.task_store.ensure_indexes()
+    app.task_store.backfill_priorities(app.computing_nodes_db.distinct("all_nodes", "node_id", {}))
+    backfill_priority_levels(app.jobs_and_tasks_db, "active_jobs", {})
+    app.jobs_and_tasks_db.create_index(PREVIEW_COLLECTION, [("job_id", 1), ("task_id", 1)])
+    app.jobs_and_tasks_db.create_index("active_jobs", [("lazy_pending", 1), ("priority_level", 1)], sparse=True)
+
+    # Index of completed results reused by identical tasks of later jobs, and its sentinel node
+    ensure_result_cache(app)
+
+    # One speculation record per straggler task, which arbitrates between it and its copy, and the jobs it looks at
+    app.jobs_and_tasks_db.create_index(SPECULATION_COLLECTION, [("task_id", 1)], unique=True)
+    app.jobs_and_tasks_db.create_index("active_jobs", [("in_tail", 1), ("priority_level", 1)])
+
+    # Tile pyramids: one record per tile address
+    app.jobs_and_tasks_db.create_index(PYRAMIDS_COLLECTION, [("pyramid_id", 1)], unique=True)
+    app.jobs_and_tasks_db.create_index(TILES_COLLECTION, [("pyramid_id", 1), ("z", 1), ("x", 1), ("y", 1)], unique=True)
+
+    # Receipts that make retried asynchronous uploads idempotent
+    app.jobs_and_tasks_db.create_index(RECEIPTS_COLLECTION, [("task_id", 1), ("claim_token", 1)], unique=True)
+    app.jobs_and_tasks_db.create_index(RECEIPTS_COLLECTION, [("receipt_id", 1)])
+    app.jobs_and_tasks_db.create_index(
+        RECEIPTS_COLLECTION, [("finished_at", 1)], expireAfterSeconds=app.config["INGEST_RECEIPT_TTL_SECONDS"]
+    )
+
+
+def start_background_threads(app: ExtendedFlask):
+    # Relays inbox assignments by other processes to long-polling nodes
+    app.task_notifier = TaskNotifier()
+    if app.config["TASK_CHANGE_STREAM"]:
+        start_assignment_watcher(app)
+
+    # Background workers for asynchronous result ingestion
+    if app.config["ASYNC_INGESTION"]:
+        app.ingest_pool = IngestPool(
+            app, app.config["INGEST_WORKERS"], app.config["INGEST_QUEUE_SIZE"], app.config["INGEST_SPOOL_DIR"]
+        )
 
-    return app
\ No newline at end of file
+    # Requeue tasks stranded on expired leases or unavailable nodes
+    if app.config["REAPER_INTERVAL_SECONDS"] > 0:
+        start_reaper(app)
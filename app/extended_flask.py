@@ -1,7 +1,27 @@
 # app/extended_flask.py
+from typing import TYPE_CHECKING, Optional
+
 from flask import Flask
+from app.utilities.composite_cache import CompositeCache, TileCache
 from app.utilities.database import DataBase
+from app.utilities.fair_share import FairShareIndex
+from app.utilities.node_load import NodeLoadIndex
+from app.utilities.stragglers import StragglerIndex
+from app.utilities.notifier import TaskNotifier
+from app.utilities.task_store import TaskStore
+
+if TYPE_CHECKING:
+    from app.utilities.ingest import IngestPool  # imports this module
 
 class ExtendedFlask(Flask):
     jobs_and_tasks_db: DataBase
     computing_nodes_db: DataBase
+    node_load: NodeLoadIndex
+    fair_share: FairShareIndex
+    task_store: TaskStore
+    task_notifier: TaskNotifier
+    stragglers: StragglerIndex
+    composite_cache: CompositeCache
+    tile_cache: TileCache
+    ingest_pool: Optional["IngestPool"]  # set when ASYNC_INGESTION is on
+    started_pid: Optional[int]  # process that last ran app.start_process
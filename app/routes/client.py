@@ -2,19 +2,30 @@ import mimetypes
 from datetime import datetime
 
 import gridfs
-from flask import Blueprint, request, jsonify, abort, current_app, Response
-from typing import cast
+from flask import Blueprint, request, jsonify, abort, current_app, Response, send_file, stream_with_context
+from typing import Optional, cast
 from app.extended_flask import ExtendedFlask
 from ..utilities.job_creator import create_job_and_tasks
-from ..utilities.assign_tasks import assign_task
-from PIL import Image  # Make sure Pillow is installed
-from io import BytesIO
+from ..utilities.preview import render_preview
+from ..utilities.assign_tasks import complete_from_cache, queue_tasks
+from ..utilities.composite_cache import CompositeCache
+from ..utilities.compositor import RgbCanvas, composite_parallel, decode_image, slice_offset, stream_png
+from ..utilities.iterations import normalize_palette
 
 
 
 client_bp = Blueprint('client_bp', __name__, url_prefix='/client')
 
 
+def generate_chunks(file_obj, chunk_size=8192):
+    """Yields a file-like object in chunks, so GridFS files are streamed without loading them into memory."""
+    while True:
+        data = file_obj.read(chunk_size)
+        if not data:
+            break
+        yield data
+
+
 @client_bp.route('/job', methods=['POST'])
 def upload_job():
 
@@ -37,6 +48,13 @@ def upload_job():
     x_resolution: int = int(resolution.get('x_resolution', 3840))
     y_resolution: int = int(resolution.get('y_resolution', 2160))
     num_tasks: int = int(json_data.get('num_tasks', 16))
+    tiling: str = json_data.get('tiling', 'strips')
+    result_format: str = json_data.get('result_format', 'png')
+    palette = json_data.get('palette')
+    app = cast(ExtendedFlask, current_app)
+    lazy = json_data.get('lazy', num_tasks >= app.config["LAZY_JOB_MIN_TASKS"] and tiling != 'balanced')
+    if not isinstance(lazy, bool):
+        abort(400, description="lazy must be true or false")
 
     try:
         # Create job and tasks using the utility function
@@ -46,28 +64,26 @@ def upload_job():
             client_id,
             num_tasks=num_tasks,
             message=job_description,
-            priority=priority
+            priority=priority,
+            tiling=tiling,
+            lazy=lazy,
+            result_format=result_format,
+            palette=palette
         )
 
         job: dict = jobs_and_tasks[0]
         tasks: list = jobs_and_tasks[1:]
 
-        # have to recast the app
-        app = cast(ExtendedFlask, current_app)
         job_result = app.jobs_and_tasks_db.add("active_jobs", job)
         job["_id"] = str(job_result.inserted_id)
 
-        #insert into unassigned
-        for task in tasks:
-            task_result = app.jobs_and_tasks_db.add("unassigned_tasks", task)
-            task["_id"] = str(task_result.inserted_id)
-
-
-        #now that they are in the available collection we query that collection to assign all nodes in it.
-        all_unassigned_tasks = app.jobs_and_tasks_db.get_all("unassigned_tasks")
-        for task in all_unassigned_tasks:
-            task_id = task["task_id"]
-            assign_task(task_id)
+        # tasks already computed for an earlier job complete from the result cache, the rest join the
+        # unassigned pool and fill free inbox slots in fair-share order
+        if job.get("lazy"):
+            app.task_notifier.notify_all()  # nodes waiting for work pull the lazy job's tasks themselves
+        else:
+            misses = complete_from_cache(tasks)
+            queue_tasks(misses)
 
 
         return_json: dict = {
@@ -75,6 +91,8 @@ def upload_job():
             "client_id": job["client_id"],
             "priority": job["priority"],
         }
+        if not job.get("lazy"):
+            return_json["tasks_from_cache"] = len(tasks) - len(misses)
 
 
         return jsonify(return_json), 201
@@ -102,46 +120,123 @@ def get_job(job_id):
 
 
 
+@client_bp.route('/job/<job_id>/preview', methods=['GET'])
+def preview_job(job_id: str):
+    """
+    Return a downscaled composite of whatever slices of the job have completed so far, with
+    placeholders for the missing regions. Built from thumbnails stored at submission, so it is
+    cheap to poll while the job runs.
+    """
+    app = cast(ExtendedFlask, current_app)
+    job_doc = app.jobs_and_tasks_db.get_one("active_jobs", {"job_id": job_id})
+    if not job_doc:
+        abort(404, description=f"No job found with job_id={job_id}")
+
+    png, slices_shown = render_preview(job_doc)
+    return Response(png, mimetype="image/png", headers={
+        "X-Tasks-Completed": str(job_doc.get("num_completed", slices_shown)),
+        "X-Tasks-Total": str(job_doc["num_tasks"]),
+        "Cache-Control": "no-cache",
+    })
+
+
 @client_bp.route('/completed-job/<job_id>', methods=['GET'])
 def download_and_reconstruct_job(job_id: str):
-    """Reconstruct a completed Mandelbrot job by assembling partial slices from each node's outbox."""
-    # 1) Basic Setup: Retrieve the Job
+    """
+    Return the final image of a completed Mandelbrot job.
+
+    Responses come from the local composite cache and carry a strong ETag (the sha256 of the PNG),
+    so repeated downloads cost neither CPU nor a Mongo query, and 'If-None-Match' gets a 304.
+    On a miss, jobs composited on submission are copied from their precomputed GridFS blob, and
+    other jobs are reconstructed by assembling partial slices from each node's outbox.
+
+    Jobs with result_format "iterations" accept a 'palette' query parameter (see recolor_job).
+    """
+    return send_composite(job_id, request.args.get('palette'))
+
+
+@client_bp.route('/job/<job_id>/recolor', methods=['GET'])
+def recolor_job(job_id: str):
+    """
+    Return the final image of a completed "iterations" job in another palette, without the fleet.
+
+    'palette' is a palette name (see app/utilities/iterations.py) or comma-separated "#rrggbb"
+    stops. The stored iteration counts are recolored and composited again; the result is cached
+    under its palette like any other download.
+    """
+    if not request.args.get('palette'):
+        abort(400, description="Missing palette")
+    return send_composite(job_id, request.args['palette'])
+
+
+def send_composite(job_id: str, palette: Optional[str] = None):
+    app = cast(ExtendedFlask, current_app)
+    render_params = {"format": "png"}
+    if palette is not None:
+        try:
+            render_params["palette"] = list(normalize_palette(palette))
+        except ValueError as e:
+            abort(400, description=str(e))
+    cache_key = CompositeCache.key(job_id, render_params)
+
+    cached = app.composite_cache.get(cache_key)
+    if cached is None:
+        # 1) Basic Setup: Retrieve the Job
+        job_db = app.jobs_and_tasks_db
+        job_query = {"job_id": job_id}
+        job_doc = job_db.get_one("active_jobs", job_query)
+        if not job_doc:
+            abort(404, description=f"No job found with job_id={job_id}")
+
+        if palette is not None:
+            if job_doc.get("result_format") != "iterations":
+                abort(400, description=f"Job {job_id} was rendered to colored slices and cannot be recolored")
+            chunks = reconstruct_job(job_doc, palette)
+        elif job_doc.get("composite_id"):
+            chunks = generate_chunks(job_db.open_file_gridfs(job_doc["composite_id"]))
+        else:
+            chunks = reconstruct_job(job_doc)
+            if job_doc.get("status") != "COMPLETED":
+                job_db.update_many("active_jobs", job_query, {"$set": {
+                    "status": "COMPLETED",
+                    "completed_at": {"$date": datetime.utcnow().isoformat() + "Z"},
+                }})
+
+        # Stream the first response while teeing it into the cache; the ETag is served from later hits
+        return Response(stream_with_context(app.composite_cache.tee(cache_key, chunks)), mimetype="image/png",
+                        headers={"Content-Disposition": f"inline; filename={job_id}.png"})
+
+    return send_file(cached.file, mimetype="image/png", etag=cached.etag, conditional=True,
+                     download_name=f"{job_id}.png")
+
+
+def reconstruct_job(job_doc: dict, palette: Optional[str] = None):
+    """
+    Reconstruct a completed Mandelbrot job by assembling partial slices from each node's outbox.
+    Returns a generator of PNG chunks, encoded band by band from a memory-mapped canvas.
+    Iteration-count slices are colored with palette, or the job's own palette if omitted.
+    """
     app = cast(ExtendedFlask, current_app)
     job_db = app.jobs_and_tasks_db
-
-    job_query = {"job_id": job_id}
-    job_doc = job_db.get_one("active_jobs", job_query)
-    if not job_doc:
-        abort(404, description=f"No job found with job_id={job_id}")
+    job_id = job_doc["job_id"]
 
     # 2) Extract High-Level Job Info
     total_tasks = job_doc["num_tasks"]
     mandelbrot_info = job_doc["mandelbrot"]
-    x_min = mandelbrot_info["region"]["x_min"]
-    x_max = mandelbrot_info["region"]["x_max"]
-    y_min = mandelbrot_info["region"]["y_min"]
-    y_max = mandelbrot_info["region"]["y_max"]
     final_width = mandelbrot_info["resolution"]["width"]
     final_height = mandelbrot_info["resolution"]["height"]
 
-    tasks_and_nodes = job_doc["tasks_and_nodes"]  # e.g. {task_id: node_id, ...}
-
-    # 3) Verify Completion in Each Node's Outbox
-    computing_nodes_db = app.computing_nodes_db  # Database handle for computing nodes
-    completed_tasks = []
-    for task_id, node_id in tasks_and_nodes.items():
-        outbox_collection = f"outbox_{node_id}"
-        outbox_doc = computing_nodes_db.get_one(
-            outbox_collection,
-            {"task_id": task_id, "job_id": job_id}
-            #also add a consrtaint later about task being completed or to::: "status": "COMPLETED"
-        )
-        if not outbox_doc:
+    tasks_and_nodes = None if job_doc.get("lazy") else job_doc["tasks_and_nodes"]  # e.g. {task_id: node_id, ...}
+
+    # 3) Verify Completion through the task store (one outbox query per node, or one query in unified storage)
+    completed_tasks = app.task_store.completed_tasks(job_id, tasks_and_nodes, job_doc.get("completed_by"))
+    completed_ids = {task["task_id"] for task in completed_tasks}
+    for task_id, node_id in (tasks_and_nodes or {}).items():
+        if task_id not in completed_ids:
             abort(400, description=(
                 f"Job {job_id} not fully completed: "
                 f"Missing or incomplete task {task_id} in node {node_id}'s outbox."
             ))
-        completed_tasks.append(outbox_doc)
 
 
     if len(completed_tasks) < total_tasks:
@@ -152,61 +247,35 @@ def download_and_reconstruct_job(job_id: str):
 
 
 
-    x_total_range = x_max - x_min
-    tasks_db = app.jobs_and_tasks_db
-    tasks_info = []
-
-    for task in completed_tasks:
-
-        instr_data = task["instruction_data"]
-        x_min_slice = float(instr_data["x_min"])
-        x_max_slice = float(instr_data["x_max"])
-        tasks_info.append({
-            "task_id": task["task_id"],
-            "node_id": task["assigned_to"],
-            "x_min": x_min_slice,
-            "x_max": x_max_slice,
-            "width": instr_data["width"],
-            "height": instr_data["height"],
-        })
-
-    # Sort tasks by x_min so we paste them in the correct horizontal order
-    tasks_info.sort(key=lambda t: t["x_min"])
+    # 4) Locate every slice: the outbox record carries its GridFS id, older records are looked up in one query
+    file_ids = {task["task_id"]: task.get("output_data", {}).get("image_id") for task in completed_tasks}
+    missing_ids = [task_id for task_id, file_id in file_ids.items() if not file_id]
+    if missing_ids:
+        file_ids.update(job_db.find_file_ids_gridfs(missing_ids))
+    for task_id, file_id in file_ids.items():
+        if not file_id:
+            abort(404, description=f"Missing partial image in GridFS for task {task_id}")
 
+    palette = palette if palette is not None else job_doc.get("palette")
 
+    def slice_loader(file_id):
+        return lambda: decode_image(job_db.read_file_gridfs(file_id), palette)
 
-    # 5) Reconstruct the Final Image
-    final_image = Image.new("RGB", (final_width, final_height))
-    for task_data in tasks_info:
-        partial_file = job_db.get_file_gridfs(task_data["task_id"])
-        if not partial_file:
-            abort(404, description=f"Missing partial image in GridFS for task {task_data['task_id']}")
-
-        partial_bytes = BytesIO(partial_file.read())
-        partial_img = Image.open(partial_bytes).convert("RGB")
-
-        # Compute the horizontal offset for this slice
-        offset_x = int(round((task_data["x_min"] - x_min) / x_total_range * final_width))
-        offset_y = 0  # We only slice horizontally; the Y range is the entire image
-
-        final_image.paste(partial_img, (offset_x, offset_y))
-        partial_img.close()
-        partial_file.close()
-
-
-    #right here we can set the relevant fields.
-    #def update_field(self, collection: str, query: dict, field: str, value: any) -> int:
-
-
-    query_jobs = {"job_id": job_id}
-    job_db.update_field("active_jobs", query_jobs, "status", "COMPLETED")
-    job_db.update_field("active_jobs", query_jobs, "completed_at", {"$date": datetime.utcnow().isoformat() + "Z"})
+    loaders = [
+        (slice_loader(file_ids[task["task_id"]]), slice_offset(task["instruction_data"], mandelbrot_info))
+        for task in completed_tasks
+    ]
 
+    # 5) Fetch and decode slices on a thread pool while pasting them into a memory-mapped canvas
+    canvas = RgbCanvas(final_width, final_height, spool_dir=app.config["COMPOSITE_SPOOL_DIR"])
+    try:
+        composite_parallel(canvas, loaders, app.config["COMPOSITE_FETCH_WORKERS"])
+    except BaseException:
+        canvas.close()
+        raise
 
-    output_buffer = BytesIO()
-    final_image.save(output_buffer, format="PNG")
-    output_buffer.seek(0)
-    return Response(output_buffer.getvalue(), mimetype="image/png")
+    # 6) Encode the PNG band by band
+    return stream_png(canvas, app.config["COMPOSITE_BAND_HEIGHT"])
 
 
 @client_bp.route('/task-result/<task_id>', methods=['GET'])
@@ -229,17 +298,7 @@ def download_image(task_id: str):
     #    (especially if something has read from it earlier)
     grid_out.seek(0)
 
-    # 4) Create a generator function to yield chunks of data
-    def generate_chunks(file_obj, chunk_size=8192):
-        while True:
-            data = file_obj.read(chunk_size)
-            if not data:
-                break
-            yield data
-
-
-
-    # 5) Return a streaming response
+    # 4) Return a streaming response
     return Response(
         generate_chunks(grid_out),
         mimetype=content_type,
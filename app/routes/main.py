@@ -1,6 +1,12 @@
-from flask import Blueprint, request, jsonify
+import os
+
+from flask import Blueprint, request, jsonify, current_app
+from pymongo.errors import PyMongoError
 from typing import cast
 from app.extended_flask import ExtendedFlask
+from app.utilities.metrics import read_counters
+from app.utilities.result_cache import result_cache_stats
+from app.utilities.speculation import speculation_stats
 
 # create the blueprint for this one:
 main_bp = Blueprint('main_bp', __name__, url_prefix='/')
@@ -10,6 +16,28 @@ def main():
     return jsonify({"Nothing yet": "test2"})
 
 
+@main_bp.route('/ready', methods=['GET'])
+def ready():
+    """Readiness check: 200 once this process has started and both databases answer a ping, 503 otherwise."""
+    app = cast(ExtendedFlask, current_app)
+    try:
+        app.jobs_and_tasks_db.ping()
+        app.computing_nodes_db.ping()
+    except PyMongoError as e:
+        return jsonify({"status": "unavailable", "error": str(e)}), 503
+    return jsonify({"status": "ready", "pid": os.getpid()})
+
+
+@main_bp.route('/metrics', methods=['GET'])
+def metrics():
+    """Every counter in the metrics collection, and the state of the result cache and of speculative execution."""
+    return jsonify({
+        "counters": read_counters(),
+        "result_cache": result_cache_stats(),
+        "speculation": speculation_stats(),
+    })
+
+
 
 
 
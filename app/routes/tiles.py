@@ -0,0 +1,170 @@
+from typing import cast
+
+import gridfs
+from flask import Blueprint, request, jsonify, abort, current_app, Response
+from app.extended_flask import ExtendedFlask
+from ..utilities.assign_tasks import complete_from_cache, queue_tasks
+from ..utilities.composite_cache import CachedTile
+from ..utilities.pyramid import (
+    PYRAMIDS_COLLECTION, TILES_COLLECTION, child_tiles, create_pyramid, forget_tile, get_tile, plan_tile,
+    promote_tile, store_tile_image, valid_tile
+)
+from .client import reconstruct_job
+
+
+tiles_bp = Blueprint('tiles_bp', __name__, url_prefix='/tiles')
+
+
+@tiles_bp.route('', methods=['POST'])
+def create_tile_pyramid():
+    """
+    Create a tile pyramid over a region and queue its first prefetch_zoom levels at low priority.
+    Tiles are then fetched from the returned tile_url template.
+    """
+    json_data = request.get_json()
+    if not json_data or 'client_id' not in json_data:
+        abort(400, description='Missing client_id')
+
+    app = cast(ExtendedFlask, current_app)
+    region = json_data.get('region', {})
+    try:
+        pyramid = create_pyramid(
+            float(region.get('x_min', -2.0)), float(region.get('x_max', 1.0)),
+            float(region.get('y_min', -1.5)), float(region.get('y_max', 1.5)),
+            json_data['client_id'],
+            tile_size=int(json_data.get('tile_size', app.config["TILE_SIZE"])),
+            max_zoom=int(json_data.get('max_zoom', app.config["TILE_MAX_ZOOM"])),
+            prefetch_zoom=int(json_data.get('prefetch_zoom', app.config["TILE_PREFETCH_ZOOM"])),
+            result_format=json_data.get('result_format', 'png'),
+            palette=json_data.get('palette'),
+            zoom_limit=app.config["TILE_MAX_ZOOM"]
+        )
+    except ValueError as e:
+        abort(400, description=str(e))
+
+    app.jobs_and_tasks_db.add(PYRAMIDS_COLLECTION, pyramid)
+    tasks = []
+    for z in range(pyramid["prefetch_zoom"] + 1):
+        for y in range(1 << z):
+            for x in range(1 << z):
+                tasks.extend(plan_tile(pyramid, z, x, y, "low")[1])
+    queue_tasks(complete_from_cache(tasks))
+
+    return jsonify({
+        "pyramid_id": pyramid["pyramid_id"],
+        "tile_url": f"{tiles_bp.url_prefix}/{pyramid['pyramid_id']}/{{z}}/{{x}}/{{y}}.png",
+        "tile_size": pyramid["tile_size"],
+        "max_zoom": pyramid["max_zoom"],
+        "tiles_prefetched": len(tasks),
+    }), 201
+
+
+@tiles_bp.route('/<pyramid_id>', methods=['GET'])
+def get_tile_pyramid(pyramid_id: str):
+    """Return a pyramid's parameters and how many of its tiles have been rendered and served."""
+    app = cast(ExtendedFlask, current_app)
+    pyramid = app.jobs_and_tasks_db.get_one(PYRAMIDS_COLLECTION, {"pyramid_id": pyramid_id})
+    if not pyramid:
+        abort(404, description=f"No tile pyramid found with pyramid_id={pyramid_id}")
+    pyramid.pop("_id", None)
+    pyramid["tiles_planned"] = app.jobs_and_tasks_db.num_items_query(TILES_COLLECTION, {"pyramid_id": pyramid_id})
+    pyramid["tiles_ready"] = app.jobs_and_tasks_db.num_items_query(
+        TILES_COLLECTION, {"pyramid_id": pyramid_id, "image_id": {"$ne": None}}
+    )
+    return jsonify(pyramid)
+
+
+@tiles_bp.route('/<pyramid_id>/<int:z>/<int:x>/<int:y>', methods=['GET'])
+@tiles_bp.route('/<pyramid_id>/<int:z>/<int:x>/<int:y>.png', methods=['GET'])
+def get_tile_image(pyramid_id: str, z: int, x: int, y: int):
+    """
+    Return tile z/x/y of a pyramid as a PNG with a strong ETag.
+
+    Tiles in this process's memory cache are answered without touching Mongo. A tile that is not
+    rendered yet gets 202 with Retry-After: its job is created, or promoted if it was only
+    prefetched, at high priority. The first request for a tile also prefetches its four children.
+    """
+    app = cast(ExtendedFlask, current_app)
+    key = (pyramid_id, z, x, y)
+    cached = app.tile_cache.get(key)
+    if cached is not None:
+        return tile_response(cached)
+
+    job_db = app.jobs_and_tasks_db
+    tile = get_tile(pyramid_id, z, x, y)
+    if tile and tile.get("image_id"):
+        return tile_response(app.tile_cache.put(key, job_db.read_file_gridfs(tile["image_id"])))
+
+    pyramid = job_db.get_one(PYRAMIDS_COLLECTION, {"pyramid_id": pyramid_id})
+    if not pyramid:
+        abort(404, description=f"No tile pyramid found with pyramid_id={pyramid_id}")
+    if not valid_tile(pyramid, z, x, y):
+        abort(404, description=f"Tile {z}/{x}/{y} is outside pyramid {pyramid_id} (max_zoom {pyramid['max_zoom']})")
+
+    job_doc = job_db.get_one("active_jobs", {"job_id": tile["job_id"]}) if tile else None
+    if tile and job_doc is None:
+        forget_tile(tile)
+        tile = None
+    if tile is None:
+        tile, tasks = plan_tile(pyramid, z, x, y, "high")
+        misses = complete_from_cache(tasks)
+        queue_tasks(misses)
+        if tasks and not misses:
+            # The same tile was rendered before, the result cache completed its job on the spot
+            job_doc = job_db.get_one("active_jobs", {"job_id": tile["job_id"]})
+    elif job_doc["num_completed"] < job_doc["num_tasks"]:
+        promote_tile(tile, "high")
+    prefetch_children(pyramid, z, x, y)
+
+    if job_doc and job_doc["num_completed"] >= job_doc["num_tasks"]:
+        return tile_response(app.tile_cache.put(key, tile_png(job_doc, tile)))
+
+    response = jsonify({"status": "RENDERING", "job_id": tile["job_id"]})
+    response.status_code = 202
+    response.headers["Retry-After"] = str(app.config["TILE_RETRY_AFTER_SECONDS"])
+    return response
+
+
+def prefetch_children(pyramid: dict, z: int, x: int, y: int):
+    """Queues the missing children of tile z/x/y at low priority."""
+    app = cast(ExtendedFlask, current_app)
+    if not app.config["TILE_PREFETCH_CHILDREN"] or z >= pyramid["max_zoom"]:
+        return
+    children = child_tiles(z, x, y)
+    existing = {
+        (tile["x"], tile["y"]) for tile in app.jobs_and_tasks_db.find(TILES_COLLECTION, {
+            "pyramid_id": pyramid["pyramid_id"], "z": z + 1,
+            "x": {"$in": [2 * x, 2 * x + 1]}, "y": {"$in": [2 * y, 2 * y + 1]},
+        })
+    }
+    tasks = []
+    for child_z, child_x, child_y in children:
+        if (child_x, child_y) not in existing:
+            tasks.extend(plan_tile(pyramid, child_z, child_x, child_y, "low")[1])
+    queue_tasks(complete_from_cache(tasks))
+
+
+def tile_png(job_doc: dict, tile: dict) -> bytes:
+    """
+    Encoded PNG of a rendered tile: the composite of its job, or the job reconstructed and stored
+    in GridFS when it was not composited on submission. The tile record remembers the file.
+    """
+    app = cast(ExtendedFlask, current_app)
+    job_db = app.jobs_and_tasks_db
+    if job_doc.get("composite_id"):
+        image_id = job_doc["composite_id"]
+        data = job_db.read_file_gridfs(image_id)
+    else:
+        data = b"".join(reconstruct_job(job_doc))
+        fs = gridfs.GridFS(job_db.db)
+        image_id = str(fs.put(data, filename=f"{job_doc['job_id']}.png", contentType="image/png",
+                              metadata={"job_id": job_doc["job_id"], "kind": "tile"}))
+    store_tile_image(tile, image_id)
+    return data
+
+
+def tile_response(tile: CachedTile) -> Response:
+    response = Response(tile.data, mimetype="image/png")
+    response.set_etag(tile.etag)
+    response.headers["Cache-Control"] = "public, max-age=86400, immutable"  # a tile never changes
+    return response.make_conditional(request)
@@ -1,17 +1,32 @@
 import json
 import os
 import secrets
+import time
 import uuid
 from datetime import datetime, timedelta
 
 import gridfs
+from pymongo import UpdateOne
 from flask import Blueprint, request, jsonify, abort, current_app
+from werkzeug.exceptions import HTTPException
 from typing import cast
 from app.extended_flask import ExtendedFlask
+from app.utilities.assign_tasks import (
+    fill_inboxes, load_index, refill_inbox, release_slot, release_slots, work_pending
+)
+from app.utilities.dispatch import INBOX_DISPATCH_SORT
+from app.utilities.ingest import drop_receipt, get_receipt, ingest_result, open_receipt
+from app.utilities.node_stats import expected_task_seconds, node_performance, observe_completion
+from app.utilities.prefetch import inbox_headroom, prefetch_limit
+from app.utilities.reaper import release_node
+from app.utilities.results import record_completion, record_completions
+from app.utilities.speculation import settle
+from app.utilities.uploads import discard_parts, file_fields, parse_into_gridfs
 
 """
 A Few NOTES: 
-- Need to consider what happens when we turn off a node in the middle of processing a task.
+- Tasks on a node that turns off in the middle of processing are requeued by the reaper
+  (app/utilities/reaper.py) once their lease or the node's heartbeat expires.
 """
 
 worker_node_bp = Blueprint('worker_node_bp', __name__, url_prefix='/node')
@@ -41,6 +56,9 @@ def register_node():
             "name": name,
             "date_joined": {"$date": datetime.utcnow().isoformat() + "Z"},
             "available": availability,
+            "last_seen": datetime.utcnow(),
+            "stranded": False,
+            "timed_out": False,
             "tasks_completed": 0,
             "tasks_failed": 0,
             "total_computations": 0,
@@ -54,15 +72,12 @@ def register_node():
         }
 
         app = cast(ExtendedFlask, current_app)
+        new_node["prefetch_limit"] = prefetch_limit(new_node)
         job_result = app.computing_nodes_db.add("all_nodes", new_node)
 
-        #Keed in mind, Inbox and Outbox are from the perspective of the node.
-        dump = "dump_"+ node_id
-        node_inbox: str = "inbox_"+ node_id
-        node_outbox:str  = "outbox_"+ node_id
-        app.computing_nodes_db.create_collection(dump)
-        app.computing_nodes_db.create_collection(node_inbox)
-        app.computing_nodes_db.create_collection(node_outbox)
+        app.task_store.register_node(node_id)
+        app.node_load.set_node(node_id, 0)
+        fill_inboxes()
 
         response = {
             "status": "success",
@@ -82,29 +97,62 @@ def register_node():
 def bad_request(error):
     return {"status": "error", "message": str(error)}, 400
 
+@worker_node_bp.errorhandler(404)
+def not_found(error):
+    return {"status": "error", "message": str(error)}, 404
+
+@worker_node_bp.errorhandler(409)
+def conflict(error):
+    return {"status": "error", "message": str(error)}, 409
+
+@worker_node_bp.errorhandler(413)
+def payload_too_large(error):
+    return {"status": "error", "message": str(error)}, 413
+
 @worker_node_bp.errorhandler(500)
 def server_error(error):
     return {"status": "error", "message": "Internal server error"}, 500
 
 
+def heartbeat(node_id: str):
+    """
+    Records that a node polled. A node the reaper expired for going silent (timed_out) is back, so
+    it becomes available again once the reaper has released its old tasks.
+    """
+    app = cast(ExtendedFlask, current_app)
+    now = datetime.utcnow()
+    revived = app.computing_nodes_db.update_many(
+        "all_nodes", {"node_id": node_id, "timed_out": True, "stranded": False},
+        {"$set": {"available": True, "timed_out": False, "last_seen": now}}
+    )
+    if revived:
+        app.node_load.set_node(node_id, app.task_store.inbox_count(node_id))
+        fill_inboxes()
+    else:
+        app.computing_nodes_db.update_field("all_nodes", {"node_id": node_id}, "last_seen", now)
+
+
 @worker_node_bp.route('/inbox/<string:node_id>', methods=['GET'])
 def inbox(node_id: str):
     """
     This route handles GET requests to retrieve the number of tasks
     and requests for a particular node's inbox.
-    """
-    collection = f"inbox_{node_id}"
 
+    It only reads: an empty inbox is refilled by /node/task, and work_pending tells whether that
+    would find tasks in the unassigned pool or a lazy job.
+    """
     app = cast(ExtendedFlask, current_app)
 
     try:
         nodes: list = app.computing_nodes_db.query_one_attribute("all_nodes", "node_id", node_id)
         if len(nodes) == 0:
             abort(400, description='invalid node_id')
+        heartbeat(node_id)
 
-        num_tasks = app.computing_nodes_db.num_items_query(collection, {"status": "ASSIGNED"})
+        num_tasks = app.task_store.inbox_count(node_id, {"status": "ASSIGNED"})
+        pending = num_tasks == 0 and work_pending()
 
-        num_requests = app.computing_nodes_db.num_items_query(collection, {"data_request": {"$exists": True}})
+        num_requests = app.task_store.inbox_count(node_id, {"data_request": {"$exists": True}})
     except Exception as e:
         app.logger.error(f"Database query failed for node_id={node_id}: {e}") #TEST LOG
         abort(500, description='Internal Server Error')
@@ -112,20 +160,156 @@ def inbox(node_id: str):
     json_response = {
         "num_tasks": num_tasks,
         "num_requests": num_requests,
+        "work_pending": pending,
     }
 
     return jsonify(json_response), 200
 
+def claim_update() -> dict:
+    """Moves claimed tasks to RUNNING with a fresh claim_token and a lease of TASK_LEASE_SECONDS."""
+    app = cast(ExtendedFlask, current_app)
+    now = datetime.utcnow()
+    return {"$set": {
+        "status": "RUNNING",
+        "claim_token": secrets.token_hex(16),
+        "claimed_at": now,
+        "lease_expires_at": now + timedelta(seconds=app.config["TASK_LEASE_SECONDS"]),
+    }}
+
+
+def claim_next_task(node_id: str):
+    """
+    Atomically claims the next ASSIGNED task in the node's inbox, highest priority_level first and
+    in the order tasks were put in the inbox within a level (see app/utilities/dispatch.py).
+    An empty inbox is first refilled from the unassigned pool, then with tasks stolen from a
+    backlogged peer, then from lazy jobs, then with a speculative copy of a straggler task.
+    Returns None when there is still nothing to claim.
+    """
+    app = cast(ExtendedFlask, current_app)
+    update = claim_update()
+    task: dict = app.task_store.claim(node_id, {"status": {"$eq": "ASSIGNED"}}, update, sort=INBOX_DISPATCH_SORT)
+    if task is None and refill_inbox(node_id):
+        task = app.task_store.claim(node_id, {"status": {"$eq": "ASSIGNED"}}, update, sort=INBOX_DISPATCH_SORT)
+    return task
+
+
 @worker_node_bp.route('/task/<string:node_id>', methods=['GET'])
 def get_task(node_id: str):
-    #TODO: worry about priority later. If a task has higher priority send it first.
-    #For now just get a random task.
+    """
+    Claims the next task of the node (see claim_next_task), or returns null if there is none.
 
-    app = cast(ExtendedFlask, current_app)
-    collection = f"inbox_{node_id}"
-    task: dict = app.computing_nodes_db.get_one(collection, {"status": {"$eq": "ASSIGNED"}})
+    The task moves to RUNNING with a fresh claim_token and a lease that expires after
+    TASK_LEASE_SECONDS. The node must send the claim_token back when renewing the lease
+    or submitting the result.
+    """
+    heartbeat(node_id)
+    task = claim_next_task(node_id)
     return jsonify(task)
 
+
+@worker_node_bp.route('/tasks/<string:node_id>', methods=['GET'])
+def get_tasks(node_id: str):
+    """
+    Claims up to 'max' tasks (query parameter, default: as many as allowed) in one call, so a
+    multi-core node can keep every core busy without a poll loop per core.
+
+    The node may hold at most its prefetch_limit RUNNING tasks (see app/utilities/prefetch.py), and
+    tasks are claimed in inbox dispatch order. The batch is not claimed atomically, but a task is
+    never handed to two concurrent calls (see TaskStore.claim_batch). Every task gets its own
+    claim_token, which is sent back with it when renewing its lease or submitting its result.
+    Returns {"tasks": [...], "prefetch_limit": int}; the list is empty if nothing can be claimed.
+    """
+    app = cast(ExtendedFlask, current_app)
+    try:
+        requested = int(request.args.get('max', 0))
+    except ValueError:
+        abort(400, description="max must be an integer")
+    heartbeat(node_id)
+    node = app.computing_nodes_db.get_one("all_nodes", {"node_id": node_id})
+    if not node:
+        abort(404, description=f"No node found with node_id={node_id}")
+
+    app.computing_nodes_db.update_field("all_nodes", {"node_id": node_id}, "prefetching", True)
+    limit = prefetch_limit(node)
+    node["prefetching"] = True
+    app.node_load.set_headroom(node_id, inbox_headroom(node, limit))
+    app.node_load.set_cost(node_id, expected_task_seconds(node, limit))
+    window = limit - app.task_store.inbox_count(node_id, {"status": "RUNNING"})
+    if requested > 0:
+        window = min(window, requested)
+    if window <= 0 or not node.get("available"):
+        return jsonify({"tasks": [], "prefetch_limit": limit})
+
+    if app.task_store.inbox_count(node_id, {"status": "ASSIGNED"}) < window:
+        refill_inbox(node_id)
+    tasks = app.task_store.claim_batch(
+        node_id, {"status": {"$eq": "ASSIGNED"}}, claim_update(), window, sort=INBOX_DISPATCH_SORT
+    )
+    return jsonify({"tasks": tasks, "prefetch_limit": limit})
+
+
+@worker_node_bp.route('/task/<string:node_id>/wait', methods=['GET'])
+def wait_for_task(node_id: str):
+    """
+    Long-poll version of /task/<node_id>: holds the request open until a task can be claimed or
+    the 'timeout' query parameter (seconds, capped at LONG_POLL_MAX_SECONDS) runs out, and returns
+    the claimed task or null. Replaces polling /inbox and /task in a loop.
+
+    The request sleeps until the node is notified of an assignment (see app/utilities/notifier.py).
+    Without a change stream, assignments made by other server processes are only noticed by
+    re-checking every LONG_POLL_RECHECK_SECONDS.
+    """
+    app = cast(ExtendedFlask, current_app)
+    try:
+        timeout = float(request.args.get('timeout', app.config["LONG_POLL_MAX_SECONDS"]))
+    except ValueError:
+        abort(400, description="timeout must be a number of seconds")
+    timeout = min(max(timeout, 0.0), app.config["LONG_POLL_MAX_SECONDS"])
+
+    heartbeat(node_id)
+    if load_index().depth(node_id) is None:
+        return jsonify(None)  # unknown or unavailable nodes get no work
+
+    notifier = app.task_notifier
+    deadline = time.monotonic() + timeout
+    while True:
+        since = notifier.version(node_id)  # read before checking, so a notification in between is not lost
+        task = claim_next_task(node_id)
+        remaining = deadline - time.monotonic()
+        if task is not None or remaining <= 0:
+            return jsonify(task)
+        if not notifier.watching:
+            remaining = min(remaining, app.config["LONG_POLL_RECHECK_SECONDS"])
+        notifier.wait(node_id, since, remaining)
+
+
+@worker_node_bp.route('/lease', methods=['POST'])
+def renew_lease():
+    """
+    Extends the lease on a RUNNING task. Expects JSON with 'node_id', 'task_id' and 'claim_token'.
+    Returns 409 if the task is no longer held with that claim_token.
+    """
+    json_data = request.get_json()
+    if not json_data:
+        abort(400, description="No JSON data provided")
+    for field in ['node_id', 'task_id', 'claim_token']:
+        if field not in json_data:
+            abort(400, description=f"Missing required field: {field}")
+
+    app = cast(ExtendedFlask, current_app)
+    lease_expires_at = datetime.utcnow() + timedelta(seconds=app.config["TASK_LEASE_SECONDS"])
+    task = app.task_store.claim(
+        json_data['node_id'],
+        {"task_id": json_data['task_id'], "claim_token": json_data['claim_token'], "status": "RUNNING"},
+        {"$set": {"lease_expires_at": lease_expires_at}}
+    )
+    if not task:
+        return jsonify({"status": "error", "message": "Task is not held with this claim_token"}), 409
+
+    heartbeat(json_data['node_id'])
+
+    return jsonify({"status": "success", "lease_expires_at": lease_expires_at}), 200
+
 @worker_node_bp.route('/data-request', methods=['GET'])
 def get_data_request():
     #TODO: Implement this when we add advanced data collection on the nodes, such as battery life and network speed testing.
@@ -134,7 +318,6 @@ def get_data_request():
 
 
 
-#TODO: some things wrong with this, need to update
 @worker_node_bp.route('/availability', methods=['PATCH'])
 def change_availability():
     """
@@ -144,6 +327,9 @@ def change_availability():
         "node_id": "...",
         "availability": false
       }
+    When a node becomes unavailable every task in its inbox, including ones it is in the middle of,
+    goes back to unassigned_tasks and is reassigned by the reaper. A late upload for one of those
+    tasks is rejected because its claim_token no longer matches.
     """
     json_data = request.get_json()
     if not json_data or 'node_id' not in json_data:
@@ -157,30 +343,42 @@ def change_availability():
     app = cast(ExtendedFlask, current_app)
 
     query = {"node_id": node_id}
-    result = app.computing_nodes_db.update_field("all_nodes", query, "available", availability_status)
-
-    #TODO:
-    #Try to reassign all of the tasks to a new node.
-    #if there is not a node available, put the task back in the unassigned_task box.
-    #DONT FORGET TO CHANGE TASK DATA (WHO THE TASK IS ASSIGNED TO, RESET CRITICAL FIELDS LIKE DATE)
-    #QUESTION: Procedure if it is in the middle of a task.
-        #terminate task process (inside of the app)
-        #change task status and try to reassign it.
+    update = {"available": availability_status, "last_seen": datetime.utcnow(), "timed_out": False}
+    if not availability_status:
+        # Flag first so the reaper finishes the job if the requeue below is interrupted
+        update["stranded"] = True
+        update["unavailable_since"] = update["last_seen"]
+    result = app.computing_nodes_db.update_many("all_nodes", query, {"$set": update})
 
     if result == 0:
         return jsonify({"status": "error", "message": "No matching node or nothing updated"}), 400
 
-    #TODO
-    #if the availability has changed from true to false:
-        #1. gather all tasks in the inbox, move them to the unassigned category.
-        #2. call a method that takes all the tasks in the unassigned category and assigns them to a node.
+    requeued = 0
+    if availability_status:
+        app.node_load.set_node(node_id, app.task_store.inbox_count(node_id))
+        fill_inboxes()
+    else:
+        requeued = release_node(node_id)
 
     return jsonify({
         "status": "success",
-        "message": f"Availability for node '{node_id}' updated to {availability_status}"
+        "message": f"Availability for node '{node_id}' updated to {availability_status}",
+        "tasks_requeued": requeued
     }), 200
 
 
+@worker_node_bp.route('/stats', methods=['GET'])
+def get_node_stats():
+    """
+    Performance model of every registered node (see app/utilities/node_stats.py), fastest first by
+    expected seconds per task; nodes without a completed task yet come last.
+    """
+    app = cast(ExtendedFlask, current_app)
+    nodes = [node_performance(node) for node in app.computing_nodes_db.find("all_nodes", {"sentinel": {"$ne": True}})]
+    nodes.sort(key=lambda node: (node["expected_task_seconds"] is None, node["expected_task_seconds"] or 0))
+    return jsonify({"nodes": nodes})
+
+
 @worker_node_bp.route('/outbox', methods=['POST'])
 def outbox():
 #TODO: UPDATE THIS CODE TO BE USED FOR INFORMATION REQUESTS. The sections of this code needed for uploading the image are not needed.
@@ -196,27 +394,22 @@ def outbox():
         task_type = json_data['type'].lower()
         if task_type == "task":
             # Validate task-specific fields
-            task_fields = ['task_id', 'image_id', 'file_name']
+            task_fields = ['task_id', 'claim_token', 'image_id', 'file_name']
             for field in task_fields:
                 if field not in json_data:
                     abort(400, description=f"Missing required field for task: {field}")
             task_id = json_data['task_id']
             app = cast(ExtendedFlask, current_app)
-            inbox_collection = f"inbox_{node_id}"
-            outbox_collection = f"outbox_{node_id}"
-            query = {"task_id": task_id}
-            task_result = app.computing_nodes_db.find_and_delete(inbox_collection, query)
-            if not task_result:
-                abort(404, description=f"No task found with ID: {task_id}")
-            task = task_result[0]
-            task['completed_at'] = datetime.utcnow()  # Fixed to use datetime object
-            task['output_data'] = task.get('output_data', {})
-            task['output_data'].update({
+            task = app.task_store.complete(node_id, task_id, json_data['claim_token'], {
                 'image_id': json_data['image_id'],
                 'file_name': json_data['file_name']
             })
-            task['status'] = "COMPLETED"
-            app.computing_nodes_db.add(outbox_collection, task)
+            if not task:
+                abort(409, description=f"Task {task_id} is not held with this claim_token")
+            winners, _ = settle(node_id, [task])
+            if not winners:
+                abort(409, description=f"Task {task_id} was completed by another node first")
+            task = winners[0]
             nodes_query = {"node_id": node_id}
             app.computing_nodes_db.increment_field(
                 "all_nodes",
@@ -224,6 +417,9 @@ def outbox():
                 "tasks_completed",
                 1
             )
+            record_completion(task)
+            observe_completion(node_id, [task])
+            release_slot(node_id, task)
             return jsonify(task)
         elif task_type == "data_request":
             #TODO: This is the only reason to include this code, which is that I will need it for uploading information requests.
@@ -236,6 +432,8 @@ def outbox():
         else:
             abort(400, description=f"Unsupported task type: {task_type}")
 
+    except HTTPException:
+        raise
     except Exception as e:
         current_app.logger.error(f"Error processing outbox request: {str(e)}")
         abort(500, description="Internal server error")
@@ -258,76 +456,227 @@ def get_credentials():
     }), 200
 
 
+RECEIPT_STATUS_CODES = {"QUEUED": 202, "COMPLETED": 200, "REJECTED": 409, "FAILED": 500}
+
+
+def queue_upload(node_id: str, task_id: str, claim_token: str, metadata: dict, image_file):
+    """
+    ASYNC_INGESTION path of /submit-image: spools the upload and queues it for the ingest pool.
+    Returns 202 with the receipt, the existing receipt for a retried upload, or 429 when the
+    queue is full.
+    """
+    app = cast(ExtendedFlask, current_app)
+    pool = app.ingest_pool
+    if pool.full():
+        return busy_response()
+
+    receipt, fresh = open_receipt(node_id, task_id, claim_token)
+    if not fresh:
+        return jsonify(receipt), RECEIPT_STATUS_CODES[receipt["status"]]
+
+    spool_path = pool.spool_path(receipt)
+    image_file.save(spool_path)
+    queued = pool.submit({
+        "receipt": receipt,
+        "node_id": node_id,
+        "task_id": task_id,
+        "claim_token": claim_token,
+        "metadata": metadata,
+        "spool_path": spool_path,
+    })
+    if not queued:
+        os.remove(spool_path)
+        drop_receipt(receipt["receipt_id"])
+        return busy_response()
+    return jsonify(receipt), 202
+
+
+def busy_response():
+    response = jsonify({"status": "error", "message": "Result ingestion queue is full, retry later"})
+    response.headers["Retry-After"] = str(current_app.config["INGEST_RETRY_AFTER_SECONDS"])
+    return response, 429
+
+
 @worker_node_bp.route('/submit-image', methods=['POST'])
 def submit_image():
     """
     Endpoint to receive an image from a worker node, upload it to GridFS,
     move the associated task from inbox to outbox, and update node statistics.
+    The claim_token handed out by /node/task must match, otherwise the upload is discarded with a 409.
+
+    With ASYNC_INGESTION the upload is only spooled and the node gets 202 with a receipt
+    ({"receipt_id", "status": "QUEUED", ...}) to poll at /node/receipt/<receipt_id>. Retrying the
+    same task_id and claim_token returns the same receipt, and 429 means the queue is full.
+    See app/utilities/ingest.py.
     """
     try:
         # Extract form data from the request
         node_id = request.form.get('node_id')
         task_id = request.form.get('task_id')
+        claim_token = request.form.get('claim_token')
         metadata_str = request.form.get('metadata')
         image_file = request.files.get('image')
 
         # Validate required fields
-        if not all([node_id, task_id, metadata_str, image_file]):
-            abort(400, description="Missing required fields: node_id, task_id, metadata, or image")
+        if not all([node_id, task_id, claim_token, metadata_str, image_file]):
+            abort(400, description="Missing required fields: node_id, task_id, claim_token, metadata, or image")
 
         # Parse metadata JSON
         metadata = json.loads(metadata_str)
 
-        # Access the app and database
         app = cast(ExtendedFlask, current_app)
-        db = app.jobs_and_tasks_db.db  # Assuming db is the raw MongoDB database object
-
-        # Upload the image to GridFS
-        fs = gridfs.GridFS(db)
-        grid_fs_id = fs.put(image_file, **metadata)  # Use metadata as provided by the node
-
-        # Database operations for task completion
-        inbox_collection = f"inbox_{node_id}"
-        outbox_collection = f"outbox_{node_id}"
-
-        # Find and remove task from inbox
-        query = {"task_id": task_id}
-        task_result = app.computing_nodes_db.find_and_delete(inbox_collection, query)
-
-        if not task_result:
-            abort(404, description=f"No task found with ID: {task_id}")
-
-        task = task_result[0]
-
-        # Update task with completion details
-        task['completed_at'] = datetime.utcnow()
-        task['output_data'] = task.get('output_data', {})
-        task['output_data'].update({
-            'image_id': str(grid_fs_id),
-            'file_name': metadata["filename"]
-        })
-        task['status'] = "COMPLETED"
-
-        # Add to outbox
-        app.computing_nodes_db.add(outbox_collection, task)
-
-        # Update node statistics
-        nodes_query = {"node_id": node_id}
-        app.computing_nodes_db.increment_field(
-            "all_nodes",
-            nodes_query,
-            "tasks_completed",
-            1
-        )
+        if app.config["ASYNC_INGESTION"]:
+            return queue_upload(node_id, task_id, claim_token, metadata, image_file)
+
+        image_id = ingest_result(node_id, task_id, claim_token, metadata, image_file.read())
+        if image_id is None:
+            abort(409, description=f"Task {task_id} is not held with this claim_token")
 
         return jsonify({
             "message": "Image uploaded and task completed successfully",
-            "image_id": str(grid_fs_id)
+            "image_id": image_id
         }), 200
 
     except json.JSONDecodeError:
         abort(400, description="Invalid metadata format")
+    except HTTPException:
+        raise
     except Exception as e:
         abort(500, description=f"Server error: {str(e)}")
 
 
+
+
+@worker_node_bp.route('/receipt/<string:receipt_id>', methods=['GET'])
+def get_upload_receipt(receipt_id: str):
+    """Returns the receipt of an asynchronously ingested upload; the status code follows its status."""
+    receipt = get_receipt(receipt_id)
+    if not receipt:
+        abort(404, description=f"No receipt found with receipt_id={receipt_id}")
+    return jsonify(receipt), RECEIPT_STATUS_CODES[receipt["status"]]
+
+
+@worker_node_bp.route('/submit-images', methods=['POST'])
+def submit_images():
+    """
+    Receives many task results in one multipart request.
+
+    Every file part is streamed into GridFS as it arrives (see app/utilities/uploads.py). The
+    'manifest' form field is JSON describing the parts:
+      {
+        "node_id": "...",
+        "results": [
+          {"task_id": "...", "claim_token": "...", "part": "<file field name, default task_id>",
+           "metadata": {"filename": "...", ...}},
+          ...
+        ]
+      }
+    All matching tasks move to the outbox in one bulk write, and the node's tasks_completed and
+    each job's num_completed are incremented once for the whole batch. Slices are read back from
+    GridFS for compositing, since they were never held in memory.
+
+    Returns 200 if every result was accepted and 207 otherwise, with a per-task report:
+      {"completed": int, "failed": int, "results": [{"task_id", "status": "completed", "image_id"}
+                                                     | {"task_id", "status": "rejected", "message"}]}
+    Results are rejected if their file part is missing, their metadata is not an object, their
+    claim_token no longer matches or another copy of a speculated task finished first (the status
+    of the single upload endpoint's 400 and 409); their files are deleted. A result's metadata names
+    and tags its GridFS file (see uploads.file_fields); it can never change the file's own fields.
+    """
+    app = cast(ExtendedFlask, current_app)
+    fs = gridfs.GridFS(app.jobs_and_tasks_db.db)
+    try:
+        form, parts = parse_into_gridfs(request, fs)
+    except HTTPException:
+        raise
+    except ValueError as e:
+        abort(400, description=f"Malformed multipart body: {e}")
+
+    used = set()  # ids of parts that completed tasks now point to
+    try:
+        try:
+            manifest = json.loads(form.get('manifest', ''))
+            node_id = manifest['node_id']
+            entries = manifest['results']
+            if not isinstance(node_id, str) or not node_id:
+                raise TypeError("node_id must be a non-empty string")
+            if not isinstance(entries, list):
+                raise TypeError("results must be a list")
+        except (ValueError, KeyError, TypeError) as e:
+            abort(400, description=f"Invalid manifest: {e}")
+        if len(entries) > app.config["MAX_RESULTS_PER_UPLOAD"]:
+            abort(413, description=f"At most {app.config['MAX_RESULTS_PER_UPLOAD']} results per upload")
+
+        report = {}  # task_id -> outcome, in manifest order
+        accepted = {}  # task_id -> (claim_token, GridFS part, fs.files fields)
+        for entry in entries:
+            task_id = entry.get('task_id') if isinstance(entry, dict) else None
+            claim_token = entry.get('claim_token') if isinstance(entry, dict) else None
+            if not task_id or not claim_token or not isinstance(task_id, str) or not isinstance(claim_token, str):
+                # Only strings are used as report keys and in queries, so an object cannot smuggle in a query operator
+                report.setdefault(str(task_id), {
+                    "status": "rejected", "message": "task_id and claim_token must be non-empty strings"
+                })
+                continue
+            report.setdefault(task_id, None)
+            part_name = entry.get('part', task_id)
+            part = parts.get(part_name) if isinstance(part_name, str) else None
+            try:
+                fields = file_fields(entry.get('metadata') or {})
+            except ValueError as e:
+                fields = None
+                invalid_metadata = str(e)
+            if task_id in accepted or report[task_id] is not None:
+                report[task_id] = {"status": "rejected", "message": "Duplicate task_id"}
+                accepted.pop(task_id, None)
+            elif fields is None:
+                report[task_id] = {"status": "rejected", "message": f"Invalid metadata: {invalid_metadata}"}
+            elif part is None:
+                report[task_id] = {"status": "rejected", "message": "Missing file part"}
+            elif any(part is other for _, other, _ in accepted.values()):
+                report[task_id] = {"status": "rejected", "message": "File part already used by another result"}
+            else:
+                accepted[task_id] = (claim_token, part, fields)
+
+        # Name and tag the GridFS files like the single upload endpoint does, in one round trip
+        app.jobs_and_tasks_db.bulk_write("fs.files", [
+            UpdateOne({"_id": part.file_id}, {"$set": fields})
+            for _, part, fields in accepted.values() if fields
+        ])
+        completed = app.task_store.complete_many(node_id, [
+            (task_id, claim_token, {
+                'image_id': str(part.file_id),
+                'file_name': fields.get("filename", part.grid_in.filename),
+            })
+            for task_id, (claim_token, part, fields) in accepted.items()
+        ])
+
+        completed_ids = {task['task_id'] for task in completed}
+        used = {id(part) for task_id, (_, part, _) in accepted.items() if task_id in completed_ids}
+        completed, lost = settle(node_id, completed)  # lost results' files are deleted by settle
+        for task_id, (_, part, _) in accepted.items():
+            if task_id in lost:
+                report[task_id] = {
+                    "status": "rejected", "message": f"Task {task_id} was completed by another node first"
+                }
+            elif task_id in completed_ids:
+                report[task_id] = {"status": "completed", "image_id": str(part.file_id)}
+            else:
+                report[task_id] = {
+                    "status": "rejected", "message": f"Task {task_id} is not held with this claim_token"
+                }
+        discard_parts(fs, [part for part in parts.values() if id(part) not in used])
+
+        if completed:
+            app.computing_nodes_db.increment_field("all_nodes", {"node_id": node_id}, "tasks_completed", len(completed))
+            record_completions([(task, None) for task in completed])
+            observe_completion(node_id, completed)
+            release_slots(node_id, completed)
+    except Exception:
+        # No error leaves uploaded files behind, except those completed tasks already point to
+        discard_parts(fs, [part for part in parts.values() if id(part) not in used])
+        raise
+
+    results = [{"task_id": task_id, **outcome} for task_id, outcome in report.items()]
+    failed = len(results) - len(completed)
+    return jsonify({"completed": len(completed), "failed": failed, "results": results}), 207 if failed else 200
@@ -1,54 +1,345 @@
-import uuid
+from collections import Counter, defaultdict, deque
 from datetime import datetime
-from flask import Blueprint, request, jsonify, abort, current_app
-from typing import cast
+from flask import current_app
+from typing import Optional, cast
 from app.extended_flask import ExtendedFlask
-import sys
-
-#This is the algorithm that I will work on extensively, ML -> review node performance etc later on.
+from app.utilities.fair_share import FairShareIndex
+from app.utilities.job_creator import materialize_tasks
+from app.utilities.metrics import increment_many
+from app.utilities.node_load import NodeLoadIndex
+from app.utilities.node_stats import expected_task_seconds
+from app.utilities.prefetch import inbox_headroom
+from app.utilities.result_cache import CACHE_NODE_ID, split_cached
+from app.utilities.results import record_completions
+from app.utilities.speculation import speculate
+from pymongo import UpdateOne
 
 def assign_task(task_id: str):
     app = cast(ExtendedFlask, current_app)
-    task_to_assign: dict = app.jobs_and_tasks_db.find_and_delete("unassigned_tasks", {"task_id": task_id})[0]
-
-    node_id = node_id_to_assign(task_to_assign['task_id'])
+    tasks = app.task_store.take_unassigned(1, {"task_id": task_id})
+    if not tasks:
+        return "task not found"
 
-    if node_id is None:
-        app.jobs_and_tasks_db.add("unassigned_tasks", task_to_assign)
-        print("no available nodes")
+    result = assign_new_tasks(tasks)
+    if result["assigned"] == 0:
         return "no available nodes"
+    return "success"
 
 
-    collection = str("inbox_" + node_id)
-    task_to_assign['assigned_to'] = node_id
-    task_to_assign['status'] = "ASSIGNED"
-    task_to_assign['assigned_at'] = {"$date": datetime.utcnow().isoformat() + "Z"}
-    #update the job field.
-    job_id = task_to_assign['job_id']
-    app.jobs_and_tasks_db.update_field('active_jobs', {"job_id": job_id}, f"tasks_and_nodes.{task_id}", node_id)
-    app.jobs_and_tasks_db.update_field('active_jobs', {"job_id": job_id}, "status", "TASKS-ASSIGNED")
+def node_id_to_assign(task_id: str) -> str:
+    """The available node expected to complete one more task first (see NodeLoadIndex)."""
+    return load_index().least_loaded()
 
 
-    app.computing_nodes_db.add(collection, task_to_assign)
-    return "success"
+def load_index() -> NodeLoadIndex:
+    """
+    Returns the app's inbox depth index, rebuilding it from Mongo first if it has gone stale. Node
+    costs come from the performance model in app.utilities.node_stats.
+    """
+    app = cast(ExtendedFlask, current_app)
+    index = app.node_load
+    if index.is_stale():
+        active_nodes = app.computing_nodes_db.query_one_attribute("all_nodes", "available", True)
+        index.rebuild(
+            app.task_store.inbox_depths([node["node_id"] for node in active_nodes]),
+            {node["node_id"]: inbox_headroom(node) for node in active_nodes},
+            {node["node_id"]: expected_task_seconds(node) for node in active_nodes}
+        )
+    return index
 
 
-def node_id_to_assign(task_id: str) -> str:
+def fair_share_index() -> FairShareIndex:
+    """
+    Returns the app's fair-share index, rebuilding it from Mongo first if it has gone stale.
+    """
+    app = cast(ExtendedFlask, current_app)
+    index = app.fair_share
+    if index.is_stale():
+        active_nodes = app.computing_nodes_db.query_one_attribute("all_nodes", "available", True)
+        index.rebuild(
+            app.task_store.in_flight_by_client([node["node_id"] for node in active_nodes]),
+            app.task_store.pending_clients()
+        )
+    return index
+
+
+def inbox_target_depth() -> Optional[int]:
+    app = cast(ExtendedFlask, current_app)
+    return app.config["INBOX_TARGET_DEPTH"] or None
+
+
+def queue_tasks(tasks: list) -> int:
+    """
+    Puts new tasks in the unassigned pool and fills inboxes from it in fair-share order.
+    Returns how many tasks were assigned.
+    """
+    app = cast(ExtendedFlask, current_app)
+    if not tasks:
+        return 0
+
+    app.task_store.add_unassigned(tasks)
+    index = fair_share_index()
+    for client_id in {task.get('client_id') for task in tasks}:
+        index.mark_pending(client_id)
+    return fill_inboxes()
+
+
+def complete_from_cache(tasks: list) -> list:
+    """
+    Completes new tasks of stored jobs whose results are already in the result cache, as if the
+    sentinel node CACHE_NODE_ID had uploaded them, and returns the tasks that still need computing.
+    Tasks of several jobs are looked up together.
+    """
+    app = cast(ExtendedFlask, current_app)
+    hits, misses = split_cached(tasks)
+    if not hits:
+        return misses
+
+    app.task_store.add_completed(CACHE_NODE_ID, hits)
+    job_updates = defaultdict(dict)
+    for task in hits:
+        if not task.get('lazy'):  # lazy jobs keep no per-task map
+            job_updates[task['job_id']][f"tasks_and_nodes.{task['task_id']}"] = CACHE_NODE_ID
+    app.jobs_and_tasks_db.bulk_write('active_jobs', [
+        UpdateOne({"job_id": job_id}, {"$set": fields}) for job_id, fields in job_updates.items()
+    ])
+    record_completions([(task, None) for task in hits])
+    return misses
+
+
+def fill_inboxes(limit: Optional[int] = None) -> int:
+    """
+    Moves tasks from the unassigned pool into inboxes until every inbox holds INBOX_TARGET_DEPTH
+    tasks, the pool is empty, or limit tasks were assigned.
+
+    Each free slot goes to the pending client with the smallest weighted share (an O(log clients)
+    pick from the fair-share index). The picked tasks are taken from the pool with one query per
+    client, highest priority first, and assigned interleaved in pick order.
+
+    Returns:
+        int: How many tasks were assigned.
+    """
     app = cast(ExtendedFlask, current_app)
-    active_nodes = app.computing_nodes_db.query_one_attribute("all_nodes", "available", True)
+    nodes = load_index()
+    clients = fair_share_index()
+    max_depth = inbox_target_depth()
+    batch_size = app.config["REAPER_BATCH_SIZE"]
 
-    min_tasks = sys.maxsize
-    min_node_id = None
-    for node in active_nodes:
-        current_node_id = node["node_id"]
-        current_node_inbox_size = app.computing_nodes_db.collection_size(str("inbox_" + current_node_id))
-        if current_node_inbox_size < min_tasks:
-            min_tasks = current_node_inbox_size
-            min_node_id = current_node_id
+    filled = 0
+    while len(nodes) and len(clients):
+        slots = min(batch_size, nodes.free_slots(max_depth)) if max_depth else batch_size
+        if limit is not None:
+            slots = min(slots, limit - filled)
+        picks = clients.schedule(slots)
+        if not picks:
+            break
 
-    return min_node_id
+        taken = {}
+        for client_id, count in Counter(picks).items():
+            client_tasks = app.task_store.take_unassigned(count, {"client_id": client_id})
+            if len(client_tasks) < count:
+                # The pool ran dry for this client (or another process took its tasks)
+                clients.refund(client_id, count - len(client_tasks))
+                clients.drop_pending(client_id)
+            taken[client_id] = deque(client_tasks)
 
+        tasks = [taken[client_id].popleft() for client_id in picks if taken[client_id]]
+        if not tasks:
+            continue
+
+        result = assign_new_tasks(tasks)
+        for task in tasks[result["assigned"]:]:
+            clients.refund(task.get('client_id'))
+            clients.mark_pending(task.get('client_id'))  # it went back to the pool
+        filled += result["assigned"]
+        if result["assigned"] < len(tasks):
+            break
+
+    return filled
+
+
+def release_slot(node_id: str, task: dict):
+    """
+    Bookkeeping once a node finished a task: its inbox has a free slot and the task's client has
+    one task less in flight. The slot is refilled from the pool straight away.
+    """
+    release_slots(node_id, [task])
+
+
+def release_slots(node_id: str, tasks: list):
+    """release_slot for a batch of tasks the node finished, refilling its inbox once."""
+    app = cast(ExtendedFlask, current_app)
+    if not tasks:
+        return
+    app.node_load.adjust(node_id, -len(tasks))
+    for client_id, count in Counter(task.get('client_id') for task in tasks).items():
+        app.fair_share.complete(client_id, count)
+    fill_inboxes()
 
 
+def assign_new_tasks(tasks: list) -> dict:
+    """
+    Assigns a batch of tasks that are not in any inbox yet, without touching the rest of the unassigned queue.
 
+    Nodes are picked from the inbox depth index in one pass, so each pick is O(log nodes) and
+    no inbox is counted in Mongo. Inbox inserts are grouped per node, the tasks_and_nodes updates for
+    every job are sent as one bulk write, and tasks that find no node below INBOX_TARGET_DEPTH are
+    written back to the unassigned pool at once.
 
+    Args:
+        tasks: Task dicts taken out of the unassigned pool.
+
+    Returns:
+        dict: {"assigned": int, "unassigned": int}. The first "assigned" tasks are the assigned ones.
+    """
+    app = cast(ExtendedFlask, current_app)
+    if not tasks:
+        return {"assigned": 0, "unassigned": 0}
+
+    picks = load_index().spread(len(tasks), inbox_target_depth())
+    if len(picks) < len(tasks):
+        app.task_store.add_unassigned(tasks[len(picks):])
+    if not picks:
+        return {"assigned": 0, "unassigned": len(tasks)}
+
+    now = datetime.utcnow()
+    assigned_at = {"$date": now.isoformat() + "Z"}
+    tasks_per_node = defaultdict(list)
+    job_updates = defaultdict(dict)
+    for task, node_id in zip(tasks, picks):
+        task['assigned_to'] = node_id
+        task['status'] = "ASSIGNED"
+        task['assigned_at'] = assigned_at
+        task['inboxed_at'] = now
+        tasks_per_node[node_id].append(task)
+        fields = job_updates[task['job_id']]
+        if not task.get('lazy'):  # lazy jobs keep no per-task map
+            fields[f"tasks_and_nodes.{task['task_id']}"] = node_id
+
+    for node_id, node_tasks in tasks_per_node.items():
+        app.task_store.add_to_inbox(node_id, node_tasks)
+        app.task_notifier.notify(node_id)
+
+    app.jobs_and_tasks_db.bulk_write('active_jobs', [
+        UpdateOne({"job_id": job_id}, {"$set": {**fields, "status": "TASKS-ASSIGNED"}})
+        for job_id, fields in job_updates.items()
+    ])
+
+    return {"assigned": len(picks), "unassigned": len(tasks) - len(picks)}
+
+
+def pull_lazy_tasks(node_id: str, limit: int) -> int:
+    """
+    Generates up to limit tasks of lazy jobs straight into a node's inbox, highest priority job
+    first, then oldest.
+
+    Each job's task_range.next counter is advanced with a single $inc, so concurrent pulls never
+    generate the same task twice, and only the reserved tasks are ever built in memory. Tasks found
+    in the result cache are completed right away and do not count towards limit.
+
+    Returns:
+        int: How many tasks were added to the inbox.
+    """
+    app = cast(ExtendedFlask, current_app)
+    job_db = app.jobs_and_tasks_db
+    if app.node_load.depth(node_id) is None:
+        return 0  # unknown or unavailable node
+
+    tasks = []
+    while len(tasks) < limit:
+        wanted = limit - len(tasks)
+        job = job_db.claim_one(
+            "active_jobs", {"lazy_pending": True}, {"$inc": {"task_range.next": wanted}},
+            sort=[("priority_level", 1), ("_id", 1)]
+        )
+        if not job:
+            break
+
+        total = job["task_range"]["total"]
+        stop = job["task_range"]["next"]
+        if stop >= total:
+            job_db.update_many("active_jobs", {"job_id": job["job_id"], "lazy_pending": True},
+                               {"$set": {"lazy_pending": False}})
+        tasks.extend(complete_from_cache(materialize_tasks(job, stop - wanted, stop)))
+
+    if not tasks:
+        return 0
+
+    now = datetime.utcnow()
+    assigned_at = {"$date": now.isoformat() + "Z"}
+    for task in tasks:
+        task['assigned_to'] = node_id
+        task['status'] = "ASSIGNED"
+        task['assigned_at'] = assigned_at
+        task['inboxed_at'] = now
+    app.task_store.add_to_inbox(node_id, tasks)
+    app.node_load.adjust(node_id, len(tasks))
+    for client_id, count in Counter(task.get('client_id') for task in tasks).items():
+        app.fair_share.charge(client_id, count)
+
+    job_db.update_many("active_jobs", {"job_id": {"$in": list({task['job_id'] for task in tasks})},
+                                       "status": "NOT-STARTED"},
+                       {"$set": {"status": "TASKS-ASSIGNED"}})
+    return len(tasks)
+
+
+def steal_tasks(node_id: str) -> int:
+    """
+    Moves unclaimed tasks from the peer with the longest backlog into this node's inbox, as many as
+    balance the two by expected completion time (see NodeLoadIndex.steal_candidates). If a peer
+    has nothing left to steal, for instance because it already claimed everything, the next one is
+    tried. The stolen tasks' assigned_to, their jobs' tasks_and_nodes and both inbox depths are
+    updated; fair share is unaffected since the tasks stay in flight.
+
+    Returns:
+        int: How many tasks were stolen.
+    """
+    app = cast(ExtendedFlask, current_app)
+    if not app.config["WORK_STEALING"]:
+        return 0
+
+    for victim, share in load_index().steal_candidates(node_id, inbox_target_depth()):
+        tasks = app.task_store.steal(victim, node_id, share)
+        if not tasks:
+            continue
+
+        app.node_load.adjust(victim, -len(tasks))
+        app.node_load.adjust(node_id, len(tasks))
+        job_updates = defaultdict(dict)
+        for task in tasks:
+            if not task.get('lazy'):  # lazy jobs keep no per-task map
+                job_updates[task['job_id']][f"tasks_and_nodes.{task['task_id']}"] = node_id
+        app.jobs_and_tasks_db.bulk_write('active_jobs', [
+            UpdateOne({"job_id": job_id}, {"$set": fields}) for job_id, fields in job_updates.items()
+        ])
+        increment_many({"work_stealing.steals": 1, "work_stealing.tasks": len(tasks)})
+        return len(tasks)
+    return 0
+
+
+def work_pending() -> bool:
+    """Whether refill_inbox could find tasks in the unassigned pool or a lazy job. Only reads, unlike refill_inbox."""
+    app = cast(ExtendedFlask, current_app)
+    if app.task_store.pending_clients():
+        return True
+    return app.jobs_and_tasks_db.get_one("active_jobs", {"lazy_pending": True}) is not None
+
+
+def refill_inbox(node_id: str) -> int:
+    """
+    Tops up inboxes from the unassigned pool and, if this node's inbox is still empty, steals
+    queued tasks from a backlogged peer, then pulls tasks of lazy jobs into it. Lazy jobs are very
+    large by definition, so they only get nodes that nothing else keeps busy. A node that is still
+    idle gets a speculative copy of a straggler task, if there is one (see
+    app/utilities/speculation.py). Returns the number of ASSIGNED tasks waiting in the node's inbox.
+    """
+    app = cast(ExtendedFlask, current_app)
+    fill_inboxes()
+    waiting = app.task_store.inbox_count(node_id, {"status": "ASSIGNED"})
+    if waiting == 0:
+        waiting = steal_tasks(node_id)
+    if waiting == 0:
+        waiting = pull_lazy_tasks(node_id, app.config["LAZY_PULL_BATCH"])
+    if waiting == 0:
+        waiting = speculate(node_id)
+    return waiting
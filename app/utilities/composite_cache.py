@@ -0,0 +1,159 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import BinaryIO, Hashable, Iterable, Iterator, NamedTuple, Optional
+
+
+class CachedComposite(NamedTuple):
+    file: BinaryIO
+    etag: str
+    size: int
+
+
+class CompositeCache:
+    """
+    Local disk cache of encoded job composites, keyed by job_id and render parameters.
+
+    Every entry is the encoded file plus a sidecar holding its ETag, the sha256 of its content.
+    Entries are evicted least recently used first (a hit refreshes the file's mtime) once the
+    directory holds more than max_bytes. Completed jobs never change, so entries are never stale;
+    a different rendering of the same job simply uses different render parameters.
+    """
+    __slots__ = ['directory', 'max_bytes', '_lock']
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(job_id: str, params: dict) -> str:
+        canonical = json.dumps({"job_id": job_id, "params": params}, sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(canonical.encode()).hexdigest()
+
+    def _paths(self, key: str):
+        base = os.path.join(self.directory, key)
+        return base + ".bin", base + ".etag"
+
+    def get(self, key: str) -> Optional[CachedComposite]:
+        """
+        Returns the entry with its file already open, so a concurrent evict() cannot remove it
+        between the lookup and the response. The caller owns (and must close) the file.
+        """
+        data_path, etag_path = self._paths(key)
+        try:
+            f = open(data_path, "rb")
+        except OSError:
+            return None
+        try:
+            with open(etag_path) as etag_file:
+                etag = etag_file.read().strip()
+            os.utime(data_path)
+            size = os.fstat(f.fileno()).st_size
+        except OSError:
+            f.close()
+            return None
+        return CachedComposite(f, etag, size)
+
+    def tee(self, key: str, chunks: Iterable[bytes]) -> Iterator[bytes]:
+        """
+        Yields chunks while writing them to the cache, hashing them on the way. The entry is
+        published only once the last chunk is written; if the consumer stops early, the partial
+        file is discarded.
+        """
+        data_path, etag_path = self._paths(key)
+        digest = hashlib.sha256()
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                for chunk in chunks:
+                    digest.update(chunk)
+                    f.write(chunk)
+                    yield chunk
+            os.replace(tmp_path, data_path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        finally:
+            close = getattr(chunks, "close", None)
+            if close is not None:
+                close()
+
+        with open(etag_path, "w") as f:
+            f.write(digest.hexdigest())
+        self.evict(keep=key)
+
+    def evict(self, keep: Optional[str] = None):
+        """Removes least recently used entries until the cache fits in max_bytes. Never removes keep."""
+        with self._lock:
+            entries = []
+            total = 0
+            for name in os.listdir(self.directory):
+                if not name.endswith(".bin"):
+                    continue
+                try:
+                    stat = os.stat(os.path.join(self.directory, name))
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, name[:-len(".bin")]))
+                total += stat.st_size
+
+            entries.sort()
+            for _, size, key in entries:
+                if total <= self.max_bytes:
+                    break
+                if key == keep:
+                    continue
+                for path in self._paths(key):
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+                total -= size
+
+
+class CachedTile(NamedTuple):
+    data: bytes
+    etag: str
+
+
+class TileCache:
+    """
+    In-process LRU cache of encoded pyramid tiles, bounded by the total bytes held. Tiles are small
+    and requested in bursts while a client pans, so hot tiles are served from memory without
+    touching Mongo or the disk.
+    """
+    __slots__ = ['max_bytes', '_entries', '_size', '_lock']
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key: Hashable) -> Optional[CachedTile]:
+        with self._lock:
+            tile = self._entries.get(key)
+            if tile is not None:
+                self._entries.move_to_end(key)
+            return tile
+
+    def put(self, key: Hashable, data: bytes) -> CachedTile:
+        tile = CachedTile(data, hashlib.sha256(data).hexdigest())
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._size -= len(previous.data)
+            self._entries[key] = tile
+            self._size += len(data)
+            while self._size > self.max_bytes and len(self._entries) > 1:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted.data)
+        return tile
@@ -0,0 +1,209 @@
+import math
+import os
+import struct
+import tempfile
+import zlib
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from io import BytesIO
+from typing import Callable, Iterable, Iterator, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+from app.utilities.iterations import PaletteSpec, colorize, decode_iterations, is_iteration_data
+
+"""
+Memory-bounded assembly of a job's final image.
+
+Slices are decoded and pasted into an RGB canvas that is memory-mapped onto an
+anonymous temporary file, so the full-size image lives in the page cache rather than on the heap.
+The PNG is then produced band by band: each band of rows is filtered, compressed and emitted as
+IDAT chunks straight away.
+
+Fetching and decoding slices runs on a bounded thread pool (GridFS reads wait on the network and
+Pillow releases the GIL while decoding) and is pipelined with pasting: slices are pasted on the
+calling thread as soon as they are ready, while the next ones are still in flight. Peak memory is
+the decoded slices in flight plus one band of rows, whatever the final resolution.
+"""
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+
+def png_chunk(chunk_type: bytes, data: bytes) -> bytes:
+    return (
+        struct.pack(">I", len(data))
+        + chunk_type
+        + data
+        + struct.pack(">I", zlib.crc32(chunk_type + data) & 0xFFFFFFFF)
+    )
+
+
+class PngStreamWriter:
+    """
+    Incremental 8-bit RGB PNG encoder. Rows go in with write_rows, encoded bytes come out as they
+    are produced by zlib. Every row uses the 'Up' filter, which is cheap to compute with NumPy and
+    compresses the smooth vertical gradients of escape-time renders well.
+    """
+    __slots__ = ['width', 'height', '_compressor', '_previous_row', '_rows_written']
+
+    def __init__(self, width: int, height: int, compress_level: int = 6):
+        self.width = width
+        self.height = height
+        self._compressor = zlib.compressobj(compress_level)
+        self._previous_row = np.zeros((width * 3,), dtype=np.uint8)
+        self._rows_written = 0
+
+    def header(self) -> bytes:
+        ihdr = struct.pack(">IIBBBBB", self.width, self.height, 8, 2, 0, 0, 0)
+        return PNG_SIGNATURE + png_chunk(b"IHDR", ihdr)
+
+    def write_rows(self, rows: np.ndarray) -> bytes:
+        """Encodes a (rows, width, 3) uint8 band. Returns whatever compressed output is ready, possibly b''."""
+        flat = rows.reshape(rows.shape[0], self.width * 3)
+        previous = np.vstack([self._previous_row[np.newaxis, :], flat[:-1]])
+        filtered = np.empty((flat.shape[0], flat.shape[1] + 1), dtype=np.uint8)
+        filtered[:, 0] = 2  # filter type 'Up'
+        np.subtract(flat, previous, out=filtered[:, 1:])  # uint8 arithmetic wraps modulo 256
+
+        self._previous_row = flat[-1].copy()
+        self._rows_written += flat.shape[0]
+
+        data = self._compressor.compress(filtered.tobytes())
+        return png_chunk(b"IDAT", data) if data else b""
+
+    def finish(self) -> bytes:
+        if self._rows_written != self.height:
+            raise ValueError(f"PNG expects {self.height} rows, {self._rows_written} were written")
+        data = self._compressor.flush()
+        return (png_chunk(b"IDAT", data) if data else b"") + png_chunk(b"IEND", b"")
+
+
+class RgbCanvas:
+    """
+    A (height, width, 3) uint8 canvas memory-mapped onto a file. With no path, the backing file is
+    an anonymous temporary file in spool_dir that disappears when the canvas is closed.
+    """
+    __slots__ = ['width', 'height', 'array', '_file']
+
+    def __init__(self, width: int, height: int, path: Optional[str] = None, spool_dir: Optional[str] = None):
+        self.width = width
+        self.height = height
+        if path is None:
+            self._file = tempfile.TemporaryFile(dir=spool_dir)
+            self._file.truncate(width * height * 3)
+            self.array = np.memmap(self._file, dtype=np.uint8, mode="r+", shape=(height, width, 3))
+        else:
+            self._file = None
+            self.array = np.memmap(path, dtype=np.uint8, mode="r+", shape=(height, width, 3))
+
+    @classmethod
+    def open_or_create(cls, path: str, width: int, height: int) -> "RgbCanvas":
+        """
+        Opens the canvas file at path, creating it (zero filled) if needed. Safe to race: every
+        caller only ever grows the file to the same size.
+        """
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size < width * height * 3:
+                os.ftruncate(fd, width * height * 3)
+        finally:
+            os.close(fd)
+        return cls(width, height, path=path)
+
+    def paste(self, image: Image.Image, offset_x: int, offset_y: int):
+        """Copies an RGB image into the canvas at (offset_x, offset_y), clipping anything outside it."""
+        pixels = np.asarray(image.convert("RGB"))
+        height = min(pixels.shape[0], self.height - offset_y)
+        width = min(pixels.shape[1], self.width - offset_x)
+        if height > 0 and width > 0:
+            self.array[offset_y:offset_y + height, offset_x:offset_x + width] = pixels[:height, :width]
+
+    def flush(self):
+        self.array.flush()
+
+    def close(self):
+        self.array.flush()
+        del self.array
+        if self._file is not None:
+            self._file.close()
+
+
+def slice_offset(instruction_data: dict, mandelbrot_info: dict) -> Tuple[int, int]:
+    """
+    Pixel offset of a task's slice in the final image. Tasks record it as pixel_x/pixel_y; for
+    older strip tasks it is derived from the x range. generate_tasks starts slice i at column
+    (width * i) // num_tasks, so the offset is floored (with a little slack for float error) rather
+    than rounded, which would leave a blank column.
+    """
+    if "pixel_x" in instruction_data:
+        return int(instruction_data["pixel_x"]), int(instruction_data.get("pixel_y", 0))
+
+    x_min = mandelbrot_info["region"]["x_min"]
+    x_total_range = mandelbrot_info["region"]["x_max"] - x_min
+    final_width = mandelbrot_info["resolution"]["width"]
+    offset_x = math.floor((float(instruction_data["x_min"]) - x_min) / x_total_range * final_width + 1e-6)
+    offset_y = 0  # Strip tasks cover the entire y range
+    return offset_x, offset_y
+
+
+def decode_image(data: bytes, palette: Optional[PaletteSpec] = None) -> Image.Image:
+    """
+    Fully decodes an encoded image to RGB, so the work happens on the calling (worker) thread.
+    Iteration-count payloads are colored with palette (see app/utilities/iterations.py).
+    """
+    if is_iteration_data(data):
+        counts, max_iter = decode_iterations(data)
+        return Image.fromarray(colorize(counts, max_iter, palette), "RGB")
+    with Image.open(BytesIO(data)) as image:
+        return image.convert("RGB")
+
+
+def composite_parallel(
+    canvas: RgbCanvas,
+    loaders: Iterable[Tuple[Callable[[], Image.Image], Tuple[int, int]]],
+    max_workers: int = 8,
+):
+    """
+    Pastes slices into the canvas while the next ones are fetched and decoded on a thread pool.
+
+    Args:
+        canvas: Destination canvas.
+        loaders: (load, (offset_x, offset_y)) pairs; load() fetches and decodes one slice.
+        max_workers: Pool size. At most 2 * max_workers decoded slices are held at once.
+    """
+    window = 2 * max_workers
+    loaders = iter(loaders)
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="slice-fetch") as pool:
+        pending = {}
+        while True:
+            for load, offset in loaders:
+                pending[pool.submit(load)] = offset
+                if len(pending) >= window:
+                    break
+            if not pending:
+                break
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                offset_x, offset_y = pending.pop(future)
+                image = future.result()
+                canvas.paste(image, offset_x, offset_y)
+                image.close()
+
+
+def stream_png(canvas: RgbCanvas, band_height: int, close: bool = True) -> Iterator[bytes]:
+    """
+    Yields the canvas as PNG bytes, encoding band_height rows at a time.
+    The canvas is closed once the last chunk has been produced, unless close is False.
+    """
+    try:
+        writer = PngStreamWriter(canvas.width, canvas.height)
+        yield writer.header()
+        for top in range(0, canvas.height, band_height):
+            chunk = writer.write_rows(np.asarray(canvas.array[top:top + band_height]))
+            if chunk:
+                yield chunk
+        yield writer.finish()
+    finally:
+        if close:
+            canvas.close()
@@ -1,26 +1,48 @@
+from typing import Optional
+
 import gridfs
 from bson import ObjectId
+from pymongo import ReturnDocument
+from pymongo.database import Database
 from pymongo.mongo_client import MongoClient
-from pymongo.server_api import ServerApi
-from pymongo.errors import ConnectionFailure
-
 
+from app.utilities.mongo import get_client
 
-class DataBase:
-    __slots__ = ['client', 'db']
-
-    def __init__(self, connection_string, db_name):
 
-        try:
-            self.client = MongoClient(connection_string, server_api=ServerApi('1'))
-            self.client.admin.command('ping')
-            print("Pinged your deployment. You successfully connected to MongoDB!")
-        except ConnectionFailure as e:
-            print(f"Failed to connect to MongoDB: {e}")
-            raise
 
+class DataBase:
+    """
+    One Mongo database on the process-wide client of app.utilities.mongo. Constructing it does not
+    touch the network; the client connects on the first operation, and ping checks readiness.
+    """
+    __slots__ = ['connection_string', 'db_name', 'client_options', '_db']
+
+    def __init__(self, connection_string, db_name, client_options: Optional[dict] = None):
+        self.connection_string = connection_string
+        self.db_name = db_name
+        self.client_options = client_options
+        self._db: Optional[Database] = None
+
+    @property
+    def client(self) -> MongoClient:
+        return get_client(self.connection_string, self.client_options)
+
+    @property
+    def db(self) -> Database:
+        client = self.client
+        if self._db is None or self._db.client is not client:
+            # First use, or first use after a fork replaced the client
+            self._db = client[self.db_name]
+        return self._db
+
+    def ping(self):
+        """
+        Round trip to the server.
 
-        self.db = self.client[db_name]
+        Raises:
+            pymongo.errors.PyMongoError: If no server is reachable within the server selection timeout.
+        """
+        self.client.admin.command('ping')
 
 
     def find_and_delete(self, collection:str, query):
@@ -36,6 +58,38 @@ class DataBase:
 
         return docs
 
+    def claim_one(self, collection: str, query: dict, update: dict, sort: list = None):
+        """
+        Atomically applies update to the first document matching query and returns it afterwards.
+
+        This is a single find_one_and_update, so two callers can never claim the same document.
+
+        Args:
+            collection: Name of the MongoDB collection
+            query: MongoDB filter query
+            update: MongoDB update document, e.g. {"$set": {...}}
+            sort: Optional list of (field, direction) pairs choosing which match is claimed
+
+        Returns:
+            The updated document, or None if nothing matched
+        """
+        doc = self.db[collection].find_one_and_update(
+            query, update, sort=sort, return_document=ReturnDocument.AFTER
+        )
+        if doc and "_id" in doc:
+            doc["_id"] = str(doc["_id"])
+        return doc
+
+    def take_one(self, collection: str, query: dict):
+        """
+        Atomically removes and returns the first document matching query (find_one_and_delete).
+        Returns None if nothing matched.
+        """
+        doc = self.db[collection].find_one_and_delete(query)
+        if doc and "_id" in doc:
+            doc["_id"] = str(doc["_id"])
+        return doc
+
     def update_field(self, collection: str, query: dict, field: str, value: any) -> int:
         """
         Updates the specified field to value for all documents matching the query.
@@ -53,6 +107,15 @@ class DataBase:
         update_result = collection_obj.update_many(query, {"$set": {field: value}})
         return update_result.modified_count
 
+    def update_many(self, collection: str, query: dict, update: dict) -> int:
+        """
+        Applies an arbitrary update document to all documents matching the query.
+
+        Returns:
+            Number of documents modified
+        """
+        return self.db[collection].update_many(query, update).modified_count
+
     def increment_field(self, collection: str, query: dict, field: str, amount: int) -> int:
         """
         Increments the specified field by the given amount for matching documents.
@@ -77,6 +140,33 @@ class DataBase:
     def create_collection(self, collection: str):
         self.db.create_collection(collection)
 
+    def create_index(self, collection: str, keys: list, **kwargs):
+        """
+        Creates an index on collection if it does not exist yet, e.g. keys=[("status", 1), ("lease_expires_at", 1)].
+        """
+        return self.db[collection].create_index(keys, **kwargs)
+
+    def ensure_indexes(self, collection: str, indexes: list):
+        """
+        Creates every index in indexes (a list of key lists) on collection. Existing indexes are left alone,
+        so this is safe to call at every startup.
+        """
+        for keys in indexes:
+            self.db[collection].create_index(keys)
+
+    def distinct(self, collection: str, field: str, query: dict) -> list:
+        return self.db[collection].distinct(field, query)
+
+    def aggregate(self, collection: str, pipeline: list) -> list:
+        return list(self.db[collection].aggregate(pipeline))
+
+    def find(self, collection: str, query: dict, limit: int = 0, sort: list = None) -> list:
+        cursor = self.db[collection].find(query, sort=sort, limit=limit)
+        return list(cursor)
+
+    def delete_many(self, collection: str, query: dict) -> int:
+        return self.db[collection].delete_many(query).deleted_count
+
     def add(self, collection: str, file: dict):
         """
         Pass in an arbitrary collection and file, will add it
@@ -84,6 +174,23 @@ class DataBase:
         collection = self.db[collection]
         return collection.insert_one(file)
 
+    def add_many(self, collection: str, files: list):
+        """
+        Inserts every document in files with a single batched write.
+        Documents are inserted in order, and each dict gets its '_id' set by the driver.
+        """
+        if not files:
+            return None
+        return self.db[collection].insert_many(files, ordered=True)
+
+    def bulk_write(self, collection: str, operations: list):
+        """
+        Sends a list of pymongo write operations (UpdateOne, DeleteOne, ...) as one round trip.
+        """
+        if not operations:
+            return None
+        return self.db[collection].bulk_write(operations, ordered=False)
+
     def query_one_attribute(self, collection: str, attribute: str, value) -> list:
         query_filter = {attribute: value}
         cursor = self.db[collection].find(query_filter)
@@ -121,6 +228,22 @@ class DataBase:
         else:
             return None
 
+    def open_file_gridfs(self, file_id):
+        """Opens a GridFS file by its id (ObjectId or its string form) for streaming reads."""
+        fs = gridfs.GridFS(self.db)
+        return fs.get(ObjectId(file_id) if isinstance(file_id, str) else file_id)
+
+    def read_file_gridfs(self, file_id) -> bytes:
+        """Reads a whole GridFS file by its id (ObjectId or its string form)."""
+        fs = gridfs.GridFS(self.db)
+        with fs.get(ObjectId(file_id) if isinstance(file_id, str) else file_id) as grid_out:
+            return grid_out.read()
+
+    def find_file_ids_gridfs(self, task_ids: list) -> dict:
+        """Looks up the GridFS files of many tasks in one query. Returns {task_id: file_id}."""
+        cursor = self.db.fs.files.find({"metadata.task_id": {"$in": task_ids}}, {"metadata.task_id": 1})
+        return {doc["metadata"]["task_id"]: doc["_id"] for doc in cursor}
+
 
 
 
@@ -0,0 +1,94 @@
+from datetime import datetime, timedelta
+from typing import List, Tuple, Union
+
+"""
+Dispatch order of tasks.
+
+Clients send a free-form priority string; it is normalized into priority_level (0 = high,
+1 = normal, 2 = low) and every task records when it was queued. The unassigned pool is drained in
+DISPATCH_SORT order, (priority_level, queued_at). Nodes claim from their inbox in
+INBOX_DISPATCH_SORT order, (priority_level, inboxed_at): the inbox was filled in fair-share order
+(see assign_tasks.fill_inboxes), and sorting it by submission time again would let an old flood
+of tasks jump ahead of a newer client's work. Both orders are backed by indexes on the same keys.
+
+Strict priority would let a steady stream of higher priority jobs starve other work forever, so the
+reaper ages waiting tasks: every PRIORITY_AGING_SECONDS a task spends queued moves it up one level,
+down to AGING_FLOOR. aged_at records the last promotion. Ordinary aging stops short of high on
+purpose: a promoted task is old and would win every tie on queued_at, putting interactive renders
+behind batch work. That alone would still let a steady stream of high priority work starve
+everything else, so a task queued for longer than PRIORITY_MAX_WAIT_SECONDS is promoted to high
+regardless. This bounds how long any task waits behind others, at the price of the occasional old
+task being dispatched ahead of interactive work.
+"""
+
+PRIORITY_LEVELS = {
+    "high": 0,
+    "urgent": 0,
+    "interactive": 0,
+    "normal": 1,
+    "medium": 1,
+    "default": 1,
+    "low": 2,
+    "batch": 2,
+    "background": 2,
+}
+PRIORITY_NAMES = ["high", "normal", "low"]
+LOWEST_PRIORITY = len(PRIORITY_NAMES) - 1
+AGING_FLOOR = PRIORITY_LEVELS["normal"]
+
+DISPATCH_SORT = [("priority_level", 1), ("queued_at", 1)]
+INBOX_DISPATCH_SORT = [("priority_level", 1), ("inboxed_at", 1)]
+QUEUED_STATUSES = ["AVAILABLE", "ASSIGNED"]
+
+
+def normalize_priority(priority: Union[str, int, None]) -> int:
+    """
+    Maps a client priority ("high", "Low", "batch", 0, ...) to a priority level.
+
+    Raises:
+        ValueError: If the priority is not a known name or level.
+    """
+    if priority is None:
+        return PRIORITY_LEVELS["low"]
+    if isinstance(priority, int) and not isinstance(priority, bool):
+        if 0 <= priority <= LOWEST_PRIORITY:
+            return priority
+    elif isinstance(priority, str) and priority.strip().lower() in PRIORITY_LEVELS:
+        return PRIORITY_LEVELS[priority.strip().lower()]
+    raise ValueError(f"Unknown priority '{priority}', expected one of {PRIORITY_NAMES} or 0-{LOWEST_PRIORITY}")
+
+
+def aging_query(now: datetime, aging_seconds: float) -> dict:
+    """Queued tasks that have waited aging_seconds since they were queued or last promoted."""
+    return {
+        "status": {"$in": QUEUED_STATUSES},
+        "priority_level": {"$gt": AGING_FLOOR},
+        "aged_at": {"$lt": now - timedelta(seconds=aging_seconds)},
+    }
+
+
+def aging_update(now: datetime) -> dict:
+    return {"$inc": {"priority_level": -1}, "$set": {"aged_at": now}}
+
+
+def max_wait_query(now: datetime, max_wait_seconds: float) -> dict:
+    """Queued tasks below high priority that were queued more than max_wait_seconds ago."""
+    return {
+        "status": {"$in": QUEUED_STATUSES},
+        "priority_level": {"$gt": PRIORITY_LEVELS["high"]},
+        "queued_at": {"$lt": now - timedelta(seconds=max_wait_seconds)},
+    }
+
+
+def max_wait_update(now: datetime) -> dict:
+    return {"$set": {"priority_level": PRIORITY_LEVELS["high"], "aged_at": now}}
+
+
+def aging_steps(now: datetime, aging_seconds: float, max_wait_seconds: float) -> List[Tuple[dict, dict]]:
+    """(query, update) pairs of one aging pass: the max wait escape first, then ordinary aging. 0 disables either."""
+    steps = []
+    if max_wait_seconds > 0:
+        steps.append((max_wait_query(now, max_wait_seconds), max_wait_update(now)))
+    if aging_seconds > 0:
+        steps.append((aging_query(now, aging_seconds), aging_update(now)))
+    return steps
@@ -0,0 +1,141 @@
+import heapq
+import itertools
+import threading
+import time
+from typing import Dict, Iterable, List, Optional
+
+
+class FairShareIndex:
+    """
+    In-memory weighted fair-share order over the clients that have tasks waiting in the unassigned pool.
+
+    A client's usage is its in-flight tasks (sitting in some inbox) plus its recently completed
+    tasks, decayed with a half-life of half_life_seconds, and its share is usage / weight. Inbox
+    slots go to the pending client with the smallest share, so a client flooding the pool only
+    gets its weighted share of the fleet and a small job from anyone else is picked within a few
+    slots.
+
+    Shares live in a min-heap with lazy deletion, like NodeLoadIndex: every change pushes a fresh
+    (share, version, client_id) entry and outdated ones are skipped at the top, so a pick is
+    O(log clients). Entries are not re-keyed as completed work decays; rebuild, run whenever the
+    index is older than max_age_seconds, re-keys everything and resyncs in-flight counts and
+    pending clients from Mongo.
+    """
+    __slots__ = ['_lock', '_weights', '_default_weight', '_in_flight', '_completed', '_pending', '_heap',
+                 '_versions', '_counter', '_built_at', 'half_life_seconds', 'max_age_seconds']
+
+    def __init__(self, weights: Optional[Dict[str, float]] = None, default_weight: float = 1.0,
+                 half_life_seconds: float = 300, max_age_seconds: float = 30):
+        self._lock = threading.Lock()
+        self._weights = dict(weights or {})
+        self._default_weight = default_weight
+        self._in_flight: Dict[Optional[str], int] = {}
+        self._completed: Dict[Optional[str], tuple] = {}  # client_id -> (decayed count, as of monotonic time)
+        self._pending: set = set()
+        self._heap: list = []
+        self._versions: Dict[Optional[str], int] = {}
+        self._counter = itertools.count()
+        self._built_at: Optional[float] = None
+        self.half_life_seconds = half_life_seconds
+        self.max_age_seconds = max_age_seconds
+
+    def is_stale(self) -> bool:
+        if self._built_at is None:
+            return True
+        return time.monotonic() - self._built_at > self.max_age_seconds
+
+    def rebuild(self, in_flight: Dict[Optional[str], int], pending: Iterable[Optional[str]]):
+        """Replaces in-flight counts and pending clients; recently completed work is kept."""
+        with self._lock:
+            self._in_flight = dict(in_flight)
+            self._pending = set(pending)
+            self._heap = []
+            for client_id in self._pending:
+                self._push(client_id)
+            self._built_at = time.monotonic()
+
+    def mark_pending(self, client_id: Optional[str]):
+        """Records that client_id has tasks in the unassigned pool."""
+        with self._lock:
+            if client_id not in self._pending:
+                self._pending.add(client_id)
+                self._push(client_id)
+
+    def drop_pending(self, client_id: Optional[str]):
+        with self._lock:
+            self._pending.discard(client_id)
+
+    def invalidate(self):
+        """Forces a rebuild on next use, e.g. after tasks were requeued behind the index's back."""
+        self._built_at = None
+
+    def charge(self, client_id: Optional[str], count: int = 1):
+        """Counts tasks that reached an inbox without going through schedule (lazy jobs) as in flight."""
+        with self._lock:
+            self._in_flight[client_id] = self._in_flight.get(client_id, 0) + count
+            if client_id in self._pending:
+                self._push(client_id)
+
+    def schedule(self, count: int) -> List[Optional[str]]:
+        """
+        Picks a client for each of count inbox slots, charging every pick as in flight so the next
+        one sees the updated share. Returns fewer picks (possibly none) if no client is pending.
+        """
+        picks = []
+        with self._lock:
+            for _ in range(count):
+                client_id = self._peek()
+                if client_id is None:
+                    break
+                self._in_flight[client_id] = self._in_flight.get(client_id, 0) + 1
+                self._push(client_id)
+                picks.append(client_id)
+        return picks
+
+    def refund(self, client_id: Optional[str], count: int = 1):
+        """Takes back picks that found no task, or in-flight tasks that went back to the pool."""
+        with self._lock:
+            self._in_flight[client_id] = max(0, self._in_flight.get(client_id, 0) - count)
+            if client_id in self._pending:
+                self._push(client_id)
+
+    def complete(self, client_id: Optional[str], count: int = 1):
+        """Moves count tasks of client_id from in flight to recently completed."""
+        with self._lock:
+            self._in_flight[client_id] = max(0, self._in_flight.get(client_id, 0) - count)
+            self._completed[client_id] = (self._decayed(client_id) + count, time.monotonic())
+            if client_id in self._pending:
+                self._push(client_id)
+
+    def share(self, client_id: Optional[str]) -> float:
+        with self._lock:
+            return self._share(client_id)
+
+    def __len__(self):
+        return len(self._pending)
+
+    def _decayed(self, client_id: Optional[str]) -> float:
+        if client_id not in self._completed:
+            return 0.0
+        count, as_of = self._completed[client_id]
+        return count * 0.5 ** ((time.monotonic() - as_of) / self.half_life_seconds)
+
+    def _share(self, client_id: Optional[str]) -> float:
+        usage = self._in_flight.get(client_id, 0) + self._decayed(client_id)
+        return usage / self._weights.get(client_id, self._default_weight)
+
+    def _push(self, client_id: Optional[str]):
+        version = next(self._counter)
+        self._versions[client_id] = version
+        heapq.heappush(self._heap, (self._share(client_id), version, client_id))
+        if len(self._heap) > 4 * len(self._pending) + 64:
+            self._heap = [(self._share(c), self._versions[c], c) for c in self._pending]
+            heapq.heapify(self._heap)
+
+    def _peek(self) -> Optional[str]:
+        while self._heap:
+            _, version, client_id = self._heap[0]
+            if client_id in self._pending and self._versions.get(client_id) == version:
+                return client_id
+            heapq.heappop(self._heap)
+        return None
@@ -0,0 +1,206 @@
+import os
+import queue
+import secrets
+import threading
+from datetime import datetime, timedelta
+from typing import Optional, Tuple, cast
+
+import gridfs
+from flask import current_app
+from pymongo import ReturnDocument
+
+from app.extended_flask import ExtendedFlask
+from app.utilities.assign_tasks import release_slot
+from app.utilities.node_stats import observe_completion
+from app.utilities.results import record_completion
+from app.utilities.speculation import settle
+
+"""
+Persistence of an uploaded task result, inline or on a background pool.
+
+ingest_result does everything an upload implies: GridFS put, the move to the outbox, node stats,
+compositing and refilling the node's inbox. /node/submit-image runs it on the request thread,
+unless ASYNC_INGESTION is on. Then the upload is only spooled to INGEST_SPOOL_DIR and the node
+gets 202 with a receipt while an IngestPool worker runs ingest_result.
+
+Receipts live in the ingest_receipts collection, one per (task_id, claim_token) under a unique
+index, so a retried upload gets the existing receipt instead of being ingested twice. A receipt
+goes QUEUED -> COMPLETED, or REJECTED if the claim no longer matched, or FAILED on an error. A
+FAILED receipt, or a QUEUED one older than INGEST_STALE_SECONDS (its process died with the upload
+still spooled), is taken over by the next retry as a new attempt with its own spool file. A
+COMPLETED outcome always stands, whichever attempt reports it, and a retry that finds the task
+already completed with its claim_token reports COMPLETED too. Finished receipts expire after
+INGEST_RECEIPT_TTL_SECONDS through a TTL index. The queue is bounded by INGEST_QUEUE_SIZE and
+uploads beyond it are refused with 429, so a slow database pushes back on the nodes instead of
+filling the spool directory.
+"""
+
+RECEIPTS_COLLECTION = "ingest_receipts"
+
+
+def ingest_result(node_id: str, task_id: str, claim_token: str, metadata: dict, image_data: bytes) -> Optional[str]:
+    """
+    Stores a task result and completes the task. Returns the GridFS id of the image, or None if the
+    node no longer holds the task with this claim_token, or another copy of a speculated task
+    finished first (the upload is discarded).
+    """
+    app = cast(ExtendedFlask, current_app)
+    fs = gridfs.GridFS(app.jobs_and_tasks_db.db)
+    grid_fs_id = fs.put(image_data, **metadata)  # Use metadata as provided by the node
+
+    # Atomically move the task to the outbox, only if this node still holds the claim
+    task = app.task_store.complete(node_id, task_id, claim_token, {
+        'image_id': str(grid_fs_id),
+        'file_name': metadata["filename"]
+    })
+    if not task:
+        fs.delete(grid_fs_id)
+        return None
+    winners, _ = settle(node_id, [task])
+    if not winners:
+        return None
+    task = winners[0]
+
+    app.computing_nodes_db.increment_field("all_nodes", {"node_id": node_id}, "tasks_completed", 1)
+
+    # Update the job and paste the slice into its canvas, then hand the free inbox slot to the next task
+    record_completion(task, image_data)
+    observe_completion(node_id, [task])
+    release_slot(node_id, task)
+    return str(grid_fs_id)
+
+
+def open_receipt(node_id: str, task_id: str, claim_token: str) -> Tuple[dict, bool]:
+    """
+    Returns the receipt of (task_id, claim_token) and whether the caller should ingest the upload:
+    True for a new receipt or one taken over from a FAILED or stale QUEUED attempt.
+    """
+    app = cast(ExtendedFlask, current_app)
+    receipts = app.jobs_and_tasks_db.db[RECEIPTS_COLLECTION]
+    now = datetime.utcnow()
+    receipt_id = secrets.token_hex(16)
+    existing = receipts.find_one_and_update(
+        {"task_id": task_id, "claim_token": claim_token},
+        {"$setOnInsert": {
+            "receipt_id": receipt_id, "node_id": node_id, "status": "QUEUED", "queued_at": now, "attempt": 1,
+        }},
+        upsert=True, return_document=ReturnDocument.BEFORE
+    )
+    if existing is None:
+        return receipts.find_one({"receipt_id": receipt_id}, {"_id": 0}), True
+
+    stale = now - timedelta(seconds=app.config["INGEST_STALE_SECONDS"])
+    taken_over = receipts.find_one_and_update(
+        {"receipt_id": existing["receipt_id"], "$or": [
+            {"status": "FAILED"}, {"status": "QUEUED", "queued_at": {"$lt": stale}}
+        ]},
+        {"$set": {"status": "QUEUED", "queued_at": now, "message": None},
+         "$inc": {"attempt": 1}, "$unset": {"finished_at": ""}},
+        return_document=ReturnDocument.AFTER
+    )
+    receipt, fresh = (taken_over, True) if taken_over else (existing, False)
+    receipt.pop("_id", None)
+    return receipt, fresh
+
+
+def update_receipt(receipt: dict, status: str, **fields):
+    """
+    Records the outcome of one attempt. COMPLETED always stands; any other outcome is ignored if a
+    retry has taken the receipt over since, or if an attempt completed.
+    """
+    app = cast(ExtendedFlask, current_app)
+    query = {"receipt_id": receipt["receipt_id"]}
+    if status != "COMPLETED":
+        query.update({"queued_at": receipt["queued_at"], "status": {"$ne": "COMPLETED"}})
+    app.jobs_and_tasks_db.update_many(
+        RECEIPTS_COLLECTION, query, {"$set": {"status": status, "finished_at": datetime.utcnow(), **fields}}
+    )
+
+
+def completed_image_id(node_id: str, task_id: str, claim_token: str) -> Optional[str]:
+    """The image of a task the node already completed with this claim_token, e.g. by an attempt whose process died."""
+    app = cast(ExtendedFlask, current_app)
+    db, collection, base = app.task_store.outbox(node_id)
+    task = db.get_one(collection, {**base, "task_id": task_id, "claim_token": claim_token})
+    return task.get("output_data", {}).get("image_id") if task else None
+
+
+def get_receipt(receipt_id: str) -> Optional[dict]:
+    app = cast(ExtendedFlask, current_app)
+    return app.jobs_and_tasks_db.db[RECEIPTS_COLLECTION].find_one({"receipt_id": receipt_id}, {"_id": 0})
+
+
+def drop_receipt(receipt_id: str):
+    """Forgets a receipt whose upload could not be queued, so the node's retry starts afresh."""
+    app = cast(ExtendedFlask, current_app)
+    app.jobs_and_tasks_db.delete_many(RECEIPTS_COLLECTION, {"receipt_id": receipt_id})
+
+
+class IngestPool:
+    """
+    Bounded queue of spooled uploads drained by a fixed number of daemon worker threads, each
+    running ingest_result inside an app context.
+    """
+    __slots__ = ['app', 'spool_dir', '_queue', '_threads']
+
+    def __init__(self, app, workers: int, queue_size: int, spool_dir: str):
+        self.app = app
+        self.spool_dir = spool_dir
+        self._queue = queue.Queue(maxsize=queue_size)
+        os.makedirs(spool_dir, exist_ok=True)
+        self._threads = [
+            threading.Thread(target=self._run, name=f"ingest-{i}", daemon=True) for i in range(workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def spool_path(self, receipt: dict) -> str:
+        """One file per attempt, so a retry that takes a receipt over never touches the file of the attempt before."""
+        return os.path.join(self.spool_dir, f"{receipt['receipt_id']}-{receipt.get('attempt', 1)}.upload")
+
+    def submit(self, item: dict) -> bool:
+        """Queues a spooled upload. Returns False if the queue is full."""
+        try:
+            self._queue.put_nowait(item)
+            return True
+        except queue.Full:
+            return False
+
+    def full(self) -> bool:
+        return self._queue.full()
+
+    def join(self):
+        """Blocks until every queued upload was processed."""
+        self._queue.join()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                with self.app.app_context():
+                    self._process(item)
+            except Exception as e:
+                self.app.logger.error(f"Ingest worker error on task {item['task_id']}: {e}")
+            finally:
+                self._queue.task_done()
+
+    def _process(self, item: dict):
+        path = item["spool_path"]
+        try:
+            with open(path, "rb") as spooled:
+                image_data = spooled.read()
+            image_id = ingest_result(item["node_id"], item["task_id"], item["claim_token"], item["metadata"],
+                                     image_data)
+            if image_id is None:
+                image_id = completed_image_id(item["node_id"], item["task_id"], item["claim_token"])
+            if image_id is None:
+                update_receipt(item["receipt"], "REJECTED",
+                               message=f"Task {item['task_id']} is not held with this claim_token")
+            else:
+                update_receipt(item["receipt"], "COMPLETED", image_id=image_id)
+        except Exception as e:
+            self.app.logger.error(f"Could not ingest the result of task {item['task_id']}: {e}")
+            update_receipt(item["receipt"], "FAILED", message=str(e))
+        finally:
+            if os.path.exists(path):
+                os.remove(path)
@@ -0,0 +1,168 @@
+import struct
+import zlib
+from functools import lru_cache
+from typing import List, Optional, Tuple, Union
+
+import numpy as np
+
+try:
+    import zstandard
+except ImportError:  # optional: only needed to read zstd-compressed uploads
+    zstandard = None
+
+"""
+Compact iteration-count results and their colorization.
+
+Instead of a 24-bit PNG, a worker may upload the raw escape-iteration count of every pixel of its
+slice. The payload is a 20-byte header followed by the compressed counts, row-major, little-endian:
+
+    offset  size  field
+    0       4     magic b"MBIT"
+    4       1     format version (1)
+    5       1     dtype: 2 = uint16, 4 = uint32
+    6       1     codec: 0 = none, 1 = zlib, 2 = zstd (needs the optional zstandard package)
+    7       1     reserved, 0
+    8       4     width   (uint32, big-endian)
+    12      4     height  (uint32, big-endian)
+    16      4     max_iter (uint32, big-endian); pixels with this count never escaped
+
+The server colors the counts when it composites, through a NumPy lookup table of max_iter + 1
+RGB entries, so a palette change never needs the fleet: /client/job/<job_id>/recolor re-runs the
+composite from the stored counts. Counts compress much better than colored pixels and workers
+skip PNG encoding altogether.
+
+A palette is either a name from PALETTES or a list of "#rrggbb" color stops, spread evenly over
+log(1 + count) so the many pixels that escape early still get distinct colors. Pixels at max_iter
+are always black.
+"""
+
+MAGIC = b"MBIT"
+VERSION = 1
+HEADER = struct.Struct(">4sBBBxIII")
+DTYPES = {2: np.dtype("<u2"), 4: np.dtype("<u4")}
+CODECS = {"none": 0, "zlib": 1, "zstd": 2}
+CONTENT_TYPE = "application/x-mandelbrot-iterations"
+
+PALETTES = {
+    "classic": ["#000764", "#206bcb", "#edffff", "#ffaa00", "#000200"],
+    "fire": ["#000000", "#7f0000", "#ff4000", "#ffc000", "#ffffff"],
+    "ocean": ["#000010", "#003366", "#0099cc", "#66ffff", "#ffffff"],
+    "grayscale": ["#000000", "#ffffff"],
+}
+DEFAULT_PALETTE = "classic"
+MAX_LUT_ENTRIES = 1 << 20
+
+PaletteSpec = Union[str, List[str], Tuple[str, ...]]
+
+
+def is_iteration_data(data: bytes) -> bool:
+    return data[:4] == MAGIC
+
+
+def encode_iterations(counts: np.ndarray, max_iter: int, codec: str = "zlib", level: int = 6) -> bytes:
+    """Packs a (height, width) array of iteration counts, as a worker would."""
+    if counts.ndim != 2:
+        raise ValueError("counts must be a 2D (height, width) array")
+    dtype_size = 2 if max_iter <= np.iinfo(np.uint16).max else 4
+    raw = np.ascontiguousarray(counts, dtype=DTYPES[dtype_size]).tobytes()
+    if codec == "zlib":
+        payload = zlib.compress(raw, level)
+    elif codec == "zstd":
+        if zstandard is None:
+            raise ValueError("zstd compression needs the zstandard package")
+        payload = zstandard.ZstdCompressor(level=level).compress(raw)
+    elif codec == "none":
+        payload = raw
+    else:
+        raise ValueError(f"Unknown codec '{codec}', expected one of {list(CODECS)}")
+    height, width = counts.shape
+    return HEADER.pack(MAGIC, VERSION, dtype_size, CODECS[codec], width, height, max_iter) + payload
+
+
+def decode_iterations(data: bytes) -> Tuple[np.ndarray, int]:
+    """
+    Unpacks an iteration-count payload. Returns the (height, width) counts and max_iter.
+
+    Raises:
+        ValueError: If the header is invalid, the codec is unavailable or the size does not match.
+    """
+    if len(data) < HEADER.size:
+        raise ValueError("Iteration payload is shorter than its header")
+    magic, version, dtype_size, codec, width, height, max_iter = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("Not an iteration payload of a supported version")
+    if dtype_size not in DTYPES:
+        raise ValueError(f"Unsupported iteration dtype size {dtype_size}")
+
+    payload = memoryview(data)[HEADER.size:]
+    expected = width * height * dtype_size
+    if codec == CODECS["zlib"]:
+        # One byte past the expected size is enough to tell an oversized payload without inflating all of it
+        raw = zlib.decompressobj().decompress(payload, expected + 1)
+    elif codec == CODECS["zstd"]:
+        if zstandard is None:
+            raise ValueError("zstd-compressed payload, but the zstandard package is not installed")
+        raw = zstandard.ZstdDecompressor().decompress(bytes(payload), max_output_size=expected)
+    elif codec == CODECS["none"]:
+        raw = payload
+    else:
+        raise ValueError(f"Unknown iteration codec {codec}")
+
+    if len(raw) != expected:
+        raise ValueError(f"Iteration payload holds {len(raw)} bytes, expected {expected}")
+    return np.frombuffer(raw, dtype=DTYPES[dtype_size]).reshape(height, width), max_iter
+
+
+def normalize_palette(palette: Optional[PaletteSpec]) -> Tuple[str, ...]:
+    """
+    Canonical color stops of a palette spec, usable as a cache key.
+
+    Raises:
+        ValueError: If the palette is not a known name or a list of at least two "#rrggbb" colors.
+    """
+    if palette is None:
+        palette = DEFAULT_PALETTE
+    if isinstance(palette, str):
+        if palette.strip().lower() in PALETTES:
+            return tuple(PALETTES[palette.strip().lower()])
+        palette = palette.split(",")
+    stops = tuple(str(color).strip().lower() for color in palette)
+    if len(stops) < 2 or not all(len(color) == 7 and color[0] == "#" for color in stops):
+        raise ValueError(f"Palette must be one of {list(PALETTES)} or a list of at least two '#rrggbb' colors")
+    for color in stops:
+        try:
+            int(color[1:], 16)
+        except ValueError:
+            raise ValueError(f"Invalid palette color '{color}'")
+    return stops
+
+
+def interpolate(stops: Tuple[str, ...], counts: np.ndarray, max_iter: int) -> np.ndarray:
+    """Colors of the given counts, blending the stops over log(1 + count), black at max_iter."""
+    colors = np.array([[int(color[i:i + 2], 16) for i in (1, 3, 5)] for color in stops], dtype=np.float64)
+    positions = np.linspace(0, np.log1p(max(max_iter - 1, 1)), len(stops))
+    scaled = np.log1p(counts.astype(np.float64))
+    rgb = np.empty(counts.shape + (3,), dtype=np.uint8)
+    for channel in range(3):
+        rgb[..., channel] = np.interp(scaled, positions, colors[:, channel]).round().astype(np.uint8)
+    rgb[counts >= max_iter] = 0
+    return rgb
+
+
+@lru_cache(maxsize=64)
+def palette_lut(stops: Tuple[str, ...], max_iter: int) -> np.ndarray:
+    """(max_iter + 1, 3) uint8 table mapping an iteration count to its color."""
+    lut = interpolate(stops, np.arange(max_iter + 1), max_iter)
+    lut.setflags(write=False)
+    return lut
+
+
+def colorize(counts: np.ndarray, max_iter: int, palette: Optional[PaletteSpec] = None) -> np.ndarray:
+    """
+    Maps iteration counts to a (height, width, 3) uint8 RGB array with one vectorized table lookup.
+    Iteration limits too large for a table are interpolated per pixel instead.
+    """
+    stops = normalize_palette(palette)
+    if max_iter > MAX_LUT_ENTRIES:
+        return interpolate(stops, counts, max_iter)
+    return palette_lut(stops, max_iter)[np.minimum(counts, max_iter)]
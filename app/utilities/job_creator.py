@@ -2,6 +2,19 @@ import uuid
 from datetime import datetime
 from typing import List, Dict, Any, Optional
 
+from app.utilities.dispatch import normalize_priority
+from app.utilities.iterations import CONTENT_TYPE as ITERATIONS_CONTENT_TYPE, normalize_palette
+from app.utilities.tiling import balanced_tiles, estimate_cost_grid, grid_bands, grid_tile, tile_region
+
+TILING_MODES = ("strips", "grid", "balanced")
+LAZY_TILING_MODES = ("strips", "grid")
+
+# image_metadata fields telling workers what to upload (see app/utilities/iterations.py for "iterations")
+RESULT_FORMATS = {
+    "png": {"color_depth": "24-bit", "compression": "PNG"},
+    "iterations": {"color_depth": "iterations", "compression": "zlib", "content_type": ITERATIONS_CONTENT_TYPE},
+}
+
 
 def generate_tasks(
     x_min: float,
@@ -12,10 +25,19 @@ def generate_tasks(
     height: int,
     num_tasks: int,
     job_id: str,
-    priority: str
+    priority: str,
+    tiling: str = "strips",
+    client_id: Optional[str] = None,
+    result_format: str = "png"
 ) -> List[Dict[str, Any]]:
     """
-    Divides the Mandelbrot set region into 'num_tasks' vertical slices, each covering a stripe of the full y-range.
+    Divides the Mandelbrot set region into 'num_tasks' pieces of work.
+
+    With tiling="strips" every task is a vertical slice covering a stripe of the full y-range. With
+    tiling="grid" the tasks are near-square tiles laid out in horizontal bands, and with
+    tiling="balanced" the region is cut into 2D tiles of roughly equal estimated escape-time cost
+    (see app.utilities.tiling). Either way instruction_data carries pixel_x/pixel_y, the position of
+    the task's image in the final image.
 
     Args:
         x_min (float): Minimum x-coordinate (real axis) of the region.
@@ -26,62 +48,155 @@ def generate_tasks(
         height (int): Height of the output image in pixels.
         num_tasks (int): Number of tasks to split the job into.
         job_id (str): Unique identifier of the parent job.
-        priority (str): Priority level of the tasks (e.g., "LOW", "HIGH").
+        priority (str): Priority of the tasks (e.g., "low", "high"), normalized into priority_level.
+        tiling (str, optional): "strips", "grid" or "balanced". Defaults to "strips".
+        client_id (str, optional): Client that submitted the job, used for fair-share scheduling.
+        result_format (str, optional): What workers upload, "png" or "iterations". Defaults to "png".
 
     Returns:
         List[Dict[str, Any]]: List of task dictionaries, each defining a slice of the Mandelbrot set.
 
     Raises:
-        ValueError: If num_tasks is less than 1 or exceeds width * height.
+        ValueError: If num_tasks is less than 1 or exceeds width * height, or tiling is unknown.
     """
     if num_tasks < 1:
         raise ValueError("num_tasks must be at least 1")
     if num_tasks > width * height:
         raise ValueError(f"num_tasks ({num_tasks}) cannot exceed total pixels ({width * height})")
+    if tiling not in TILING_MODES:
+        raise ValueError(f"tiling must be one of {TILING_MODES}")
 
-    tasks = []
+    if tiling == "balanced":
+        cost = estimate_cost_grid(x_min, x_max, y_min, y_max, width, height)
+        regions = [
+            tile_region(rect, x_min, x_max, y_min, y_max, width, height)
+            for rect in balanced_tiles(width, height, num_tasks, cost)
+        ]
+    elif tiling == "grid":
+        bands = grid_bands(width, height, num_tasks)
+        regions = [
+            tile_region(grid_tile(i, num_tasks, bands, width, height), x_min, x_max, y_min, y_max, width, height)
+            for i in range(num_tasks)
+        ]
+    else:
+        regions = [strip_region(i, num_tasks, x_min, x_max, y_min, y_max, width, height) for i in range(num_tasks)]
+
+    queued_at = datetime.utcnow()
+    return [
+        make_task(job_id, instruction_data, priority, width, height, queued_at=queued_at, client_id=client_id,
+                  result_format=result_format)
+        for instruction_data in regions
+    ]
+
+
+def strip_region(
+    i: int,
+    num_tasks: int,
+    x_min: float,
+    x_max: float,
+    y_min: float,
+    y_max: float,
+    width: int,
+    height: int
+) -> Dict[str, Any]:
+    """
+    instruction_data of vertical slice i out of num_tasks. Computed on its own, so lazy jobs can
+    produce any slice without generating the ones before it.
+    """
     x_range = x_max - x_min
     x_step = x_range / num_tasks
 
-    for i in range(num_tasks):
-        task_x_min = x_min + i * x_step
-        task_x_max = x_min + (i + 1) * x_step if i < num_tasks - 1 else x_max
-
-        pixel_x_min = (width * i) // num_tasks
-        pixel_x_max = (width * (i + 1)) // num_tasks  # One past the last pixel column
-        task_width = pixel_x_max - pixel_x_min
-
-        task = {
-            "task_id": str(uuid.uuid4()),
-            "job_id": job_id,
-            "time_created": {"$date": datetime.utcnow().isoformat() + "Z"},  # UTC with 'Z' for consistency
-            "status": "AVAILABLE",
-            "assigned_to": None,
-            "assigned_at": {"$date": None},
-            "completed_at": {"$date": None},
-            "instruction": "MANDELBROT",  # Placeholder; consider an enum or config in production
-            "instruction_data": {
-                "x_min": task_x_min,
-                "x_max": task_x_max,
-                "y_min": y_min,
-                "y_max": y_max,
-                "width": task_width,
-                "height": height
-            },
-            "priority": priority,
-            "output_data": {
-                "file_id": None,
-                "storage_method": "GridFS",
-                "file_name": None
-            },
-            "image_metadata": {
-                "resolution": f"{width}x{height}",
-                "color_depth": "24-bit",
-                "compression": "PNG"
-            }
+    task_x_min = x_min + i * x_step
+    task_x_max = x_min + (i + 1) * x_step if i < num_tasks - 1 else x_max
+
+    pixel_x_min = (width * i) // num_tasks
+    pixel_x_max = (width * (i + 1)) // num_tasks  # One past the last pixel column
+    task_width = pixel_x_max - pixel_x_min
+
+    return {
+        "x_min": task_x_min,
+        "x_max": task_x_max,
+        "y_min": y_min,
+        "y_max": y_max,
+        "width": task_width,
+        "height": height,
+        "pixel_x": pixel_x_min,
+        "pixel_y": 0
+    }
+
+
+def make_task(
+    job_id: str,
+    instruction_data: Dict[str, Any],
+    priority: str,
+    width: int,
+    height: int,
+    task_id: Optional[str] = None,
+    queued_at: Optional[datetime] = None,
+    client_id: Optional[str] = None,
+    result_format: str = "png"
+) -> Dict[str, Any]:
+    """
+    Builds an AVAILABLE task document for one piece of a job. queued_at, the dispatch order within a
+    priority level, defaults to now.
+    """
+    queued_at = queued_at or datetime.utcnow()
+    return {
+        "task_id": task_id or str(uuid.uuid4()),
+        "job_id": job_id,
+        "client_id": client_id,
+        "time_created": {"$date": datetime.utcnow().isoformat() + "Z"},  # UTC with 'Z' for consistency
+        "status": "AVAILABLE",
+        "assigned_to": None,
+        "assigned_at": {"$date": None},
+        "inboxed_at": None,
+        "completed_at": {"$date": None},
+        "claim_token": None,
+        "claimed_at": None,
+        "lease_expires_at": None,
+        "instruction": "MANDELBROT",  # Placeholder; consider an enum or config in production
+        "instruction_data": instruction_data,
+        "priority": priority,
+        "priority_level": normalize_priority(priority),
+        "queued_at": queued_at,
+        "aged_at": queued_at,
+        "output_data": {
+            "file_id": None,
+            "storage_method": "GridFS",
+            "file_name": None
+        },
+        "image_metadata": {
+            "resolution": f"{width}x{height}",
+            **RESULT_FORMATS[result_format]
         }
-        tasks.append(task)
+    }
 
+
+def materialize_tasks(job: Dict[str, Any], start: int, stop: int) -> List[Dict[str, Any]]:
+    """
+    Generates tasks start..stop-1 of a lazy job from its task_range descriptor.
+    Task ids are derived from the index ("<job_id>:<i>"), so the same slice always gets the same id.
+    """
+    region = job["mandelbrot"]["region"]
+    x_min, x_max, y_min, y_max = region["x_min"], region["x_max"], region["y_min"], region["y_max"]
+    width, height = job["mandelbrot"]["resolution"]["width"], job["mandelbrot"]["resolution"]["height"]
+    total = job["task_range"]["total"]
+    bands = job["task_range"].get("bands", 1)
+    tasks = []
+    for i in range(start, min(stop, total)):
+        if job.get("tiling") == "grid":
+            rect = grid_tile(i, total, bands, width, height)
+            instruction_data = tile_region(rect, x_min, x_max, y_min, y_max, width, height)
+        else:
+            instruction_data = strip_region(i, total, x_min, x_max, y_min, y_max, width, height)
+        # Tasks of a lazy job queue from the job's submission, not from when they happen to be generated
+        task = make_task(
+            job["job_id"], instruction_data, job["priority"], width, height,
+            task_id=f"{job['job_id']}:{i}", queued_at=job.get("queued_at"), client_id=job.get("client_id"),
+            result_format=job.get("result_format", "png")
+        )
+        task["lazy"] = True
+        tasks.append(task)
     return tasks
 
 
@@ -96,7 +211,11 @@ def create_job_and_tasks(
     *,
     num_tasks: int = 16,
     message: str = "Default Message",
-    priority: str = "low"
+    priority: str = "low",
+    tiling: str = "strips",
+    lazy: bool = False,
+    result_format: str = "png",
+    palette: Any = None
 ) -> List[Any]:
     """
     Creates a job and its associated tasks for rendering a Mandelbrot set region.
@@ -111,23 +230,50 @@ def create_job_and_tasks(
         client_id (str): Identifier of the client submitting the job.
         num_tasks (int, optional): Number of tasks to split the job into. Defaults to 16.
         message (str, optional): Description of the job. Defaults to "Default Message".
-        priority (str, optional): Priority level of the job. Defaults to "LOW".
+        priority (str, optional): Priority of the job ("high", "normal", "low" or an alias, see
+            app.utilities.dispatch). Defaults to "low".
+        tiling (str, optional): How the region is split, "strips", "grid" or "balanced". Defaults to "strips".
+        lazy (bool, optional): Store a task range instead of the tasks themselves; the tasks are
+            generated as nodes pull work (see assign_tasks.pull_lazy_tasks). Not available with
+            "balanced" tiling. Defaults to False.
+        result_format (str, optional): What workers upload, "png" (colored slices) or "iterations"
+            (escape counts colored by the server, see app.utilities.iterations). Defaults to "png".
+        palette (optional): Palette name or list of "#rrggbb" stops for "iterations" jobs. Defaults to
+            the default palette.
 
     Returns:
         List[Any]: A list where:
             - First item is a dict representing the job.
-            - Remaining items are a list of task dicts associated with the job.
+            - Remaining items are a list of task dicts associated with the job (none for a lazy job).
 
     Raises:
-        ValueError: If num_tasks is invalid or region dimensions are inconsistent.
+        ValueError: If num_tasks, priority, result_format or palette is invalid, or region dimensions
+            are inconsistent.
     """
+    if result_format not in RESULT_FORMATS:
+        raise ValueError(f"result_format must be one of {list(RESULT_FORMATS)}")
+    if palette is not None:
+        normalize_palette(palette)
     if x_max <= x_min or y_max <= y_min:
         raise ValueError("Invalid region: x_max must be greater than x_min, and y_max must be greater than y_min")
     if width <= 0 or height <= 0:
         raise ValueError("Width and height must be positive integers")
 
     job_id = str(uuid.uuid4())
-    tasks = generate_tasks(x_min, x_max, y_min, y_max, width, height, num_tasks, job_id, priority)
+    if lazy:
+        if tiling not in LAZY_TILING_MODES:
+            raise ValueError(f"Lazy jobs support tiling {LAZY_TILING_MODES}")
+        if num_tasks < 1:
+            raise ValueError("num_tasks must be at least 1")
+        if num_tasks > width * height:
+            raise ValueError(f"num_tasks ({num_tasks}) cannot exceed total pixels ({width * height})")
+        if tiling == "strips" and num_tasks > width:
+            raise ValueError(f"num_tasks ({num_tasks}) cannot exceed the image width with strips tiling, use grid")
+        tasks = []
+    else:
+        tasks = generate_tasks(
+            x_min, x_max, y_min, y_max, width, height, num_tasks, job_id, priority, tiling, client_id, result_format
+        )
     task_ids = [task["task_id"] for task in tasks]  # Extract task IDs for the job
 
     tasks_dict = {task["task_id"]: None for task in tasks}
@@ -140,6 +286,11 @@ def create_job_and_tasks(
         "created_at": {"$date": datetime.utcnow().isoformat() + "Z"},  # UTC with 'Z'
         "completed_at": None,
         "num_tasks": num_tasks,
+        "num_completed": 0,
+        "tiling": tiling,
+        "result_format": result_format,
+        "palette": palette,
+        "composite_id": None,
         "mandelbrot": {
             "region": {
                 "x_min": x_min,
@@ -152,9 +303,18 @@ def create_job_and_tasks(
                 "height": height
             }
         },
-        "tasks_and_nodes": tasks_dict,  # List of actual task IDs
+        "tasks_and_nodes": tasks_dict,  # List of actual task IDs (empty for lazy jobs)
         "client_id": client_id,
-        "priority": priority
+        "priority": priority,
+        "priority_level": normalize_priority(priority),
+        "queued_at": datetime.utcnow()
     }
+    if lazy:
+        # Tasks next..total-1 have not been generated yet; lazy_pending is dropped once next reaches total
+        job["lazy"] = True
+        job["lazy_pending"] = True
+        job["completed_by"] = []  # nodes whose outboxes hold its completed tasks, in place of tasks_and_nodes
+        bands = grid_bands(width, height, num_tasks) if tiling == "grid" else 1
+        job["task_range"] = {"next": 0, "total": num_tasks, "bands": bands}
 
     return [job] + tasks  # Return job as first item, followed by tasks
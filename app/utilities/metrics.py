@@ -0,0 +1,37 @@
+import re
+from typing import Dict, cast
+
+from flask import current_app
+from pymongo import UpdateOne
+
+from app.extended_flask import ExtendedFlask
+
+"""
+Operational counters shared by every server process.
+
+Each counter is one document {_id: name, value: n} in the 'metrics' collection of the jobs
+database, bumped with an upserting $inc, so counts survive restarts and add up across processes.
+GET /metrics returns them together with gauges computed on demand (see app/routes/main.py).
+"""
+
+METRICS_COLLECTION = "metrics"
+
+
+def increment(name: str, amount: int = 1):
+    increment_many({name: amount})
+
+
+def increment_many(amounts: Dict[str, int]):
+    """Bumps several counters with one bulk write. Zero amounts are skipped."""
+    app = cast(ExtendedFlask, current_app)
+    app.jobs_and_tasks_db.bulk_write(METRICS_COLLECTION, [
+        UpdateOne({"_id": name}, {"$inc": {"value": amount}}, upsert=True)
+        for name, amount in amounts.items() if amount
+    ])
+
+
+def read_counters(prefix: str = "") -> Dict[str, int]:
+    """Current value of every counter whose name starts with prefix."""
+    app = cast(ExtendedFlask, current_app)
+    query = {"_id": {"$regex": f"^{re.escape(prefix)}"}} if prefix else {}
+    return {doc["_id"]: doc["value"] for doc in app.jobs_and_tasks_db.find(METRICS_COLLECTION, query)}
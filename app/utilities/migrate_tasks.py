@@ -0,0 +1,86 @@
+from typing import cast
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from pymongo import ReplaceOne
+
+from app.extended_flask import ExtendedFlask
+from app.utilities.task_store import UnifiedTaskStore
+
+"""
+Converts the per-node task layout (unassigned_tasks, inbox_<id>, outbox_<id>, dump_<id>) into the
+single indexed 'tasks' collection used by TASK_STORAGE = "unified".
+
+Run it while the server is stopped:
+    flask --app app migrate-task-storage          # copy, keep the old collections
+    flask --app app migrate-task-storage --drop   # copy, then drop the old collections
+
+Documents are upserted by task_id, so the migration can be re-run safely if it is interrupted.
+"""
+
+BATCH_SIZE = 1000
+
+
+def copy_collection(source_db, source: str, target_db, status: str = None) -> int:
+    """Upserts every document of source into the unified tasks collection, optionally forcing its status."""
+    copied = 0
+    batch = []
+    for task in source_db.db[source].find({}):
+        task.pop("_id", None)
+        task.pop("reap_token", None)
+        if status is not None:
+            task["status"] = status
+        batch.append(ReplaceOne({"task_id": task["task_id"]}, task, upsert=True))
+        if len(batch) >= BATCH_SIZE:
+            target_db.bulk_write(UnifiedTaskStore.COLLECTION, batch)
+            copied += len(batch)
+            batch = []
+    target_db.bulk_write(UnifiedTaskStore.COLLECTION, batch)
+    return copied + len(batch)
+
+
+def migrate_to_unified(drop: bool = False) -> dict:
+    """
+    Copies every per-node task collection into the unified tasks collection.
+
+    Args:
+        drop: Drop the old collections once they have been copied.
+
+    Returns:
+        dict: Number of tasks copied per source kind.
+    """
+    app = cast(ExtendedFlask, current_app)
+    jobs_db = app.jobs_and_tasks_db
+    nodes_db = app.computing_nodes_db
+    UnifiedTaskStore.create_indexes(jobs_db)
+
+    # Outboxes are copied last, so a task that somehow sits in two boxes keeps its completed state
+    counts = {"unassigned": 0, "inbox": 0, "outbox": 0}
+    counts["unassigned"] = copy_collection(jobs_db, "unassigned_tasks", jobs_db, status="AVAILABLE")
+
+    node_ids = [node["node_id"] for node in nodes_db.find("all_nodes", {})]
+    for node_id in node_ids:
+        counts["inbox"] += copy_collection(nodes_db, f"inbox_{node_id}", jobs_db)
+        counts["outbox"] += copy_collection(nodes_db, f"outbox_{node_id}", jobs_db, status="COMPLETED")
+
+    if drop:
+        jobs_db.db.drop_collection("unassigned_tasks")
+        for node_id in node_ids:
+            for prefix in ("inbox_", "outbox_", "dump_"):
+                nodes_db.db.drop_collection(f"{prefix}{node_id}")
+
+    return counts
+
+
+@click.command("migrate-task-storage")
+@click.option("--drop", is_flag=True, help="Drop the per-node collections after copying them.")
+@with_appcontext
+def migrate_task_storage_command(drop: bool):
+    """Move tasks from per-node collections into the unified tasks collection."""
+    counts = migrate_to_unified(drop)
+    click.echo(
+        f"Migrated {counts['unassigned']} unassigned, {counts['inbox']} inbox and "
+        f"{counts['outbox']} completed tasks into '{UnifiedTaskStore.COLLECTION}'."
+    )
+    click.echo('Set TASK_STORAGE = "unified" before restarting the server.')
@@ -0,0 +1,71 @@
+import os
+import threading
+from typing import Dict, Optional, Tuple
+
+from pymongo.mongo_client import MongoClient
+from pymongo.server_api import ServerApi
+
+"""
+One MongoClient per process, shared by every DataBase.
+
+A MongoClient owns a connection pool and monitor threads per server, so each one costs
+connections on the server and a handshake on first use. get_client hands out a single client per
+connection string and options, which makes the jobs and nodes databases share one pool. Clients
+are created with connect=False: nothing touches the network until the first operation, so
+building the app never blocks on (or fails because of) an unreachable database.
+
+MongoClient is not fork-safe: a child that inherits one shares its sockets and locks with the
+parent. The registry is therefore per process. It is emptied in the child right after a fork
+(os.register_at_fork), and a client created under another pid is never handed out, so pre-fork
+servers get a fresh client in each worker on its first query.
+
+Pool size and timeouts come from the MONGO_* config values (client_options), which default to
+environment variables of the same name (see config.py).
+"""
+
+_lock = threading.Lock()
+_clients: Dict[Tuple[str, tuple], MongoClient] = {}
+_pid = os.getpid()
+
+
+def client_options(config) -> dict:
+    """MongoClient keyword arguments from the MONGO_* config values. Zero timeouts mean no limit."""
+    return {
+        "maxPoolSize": config["MONGO_MAX_POOL_SIZE"],
+        "minPoolSize": config["MONGO_MIN_POOL_SIZE"],
+        "maxIdleTimeMS": config["MONGO_MAX_IDLE_TIME_MS"] or None,
+        "connectTimeoutMS": config["MONGO_CONNECT_TIMEOUT_MS"] or None,
+        "serverSelectionTimeoutMS": config["MONGO_SERVER_SELECTION_TIMEOUT_MS"],
+        "socketTimeoutMS": config["MONGO_SOCKET_TIMEOUT_MS"] or None,
+    }
+
+
+def get_client(connection_string: Optional[str], options: Optional[dict] = None) -> MongoClient:
+    """The process's client for connection_string and options, created on first call without connecting."""
+    global _pid
+    key = (connection_string, tuple(sorted((options or {}).items())))
+    client = _clients.get(key)
+    if client is not None and _pid == os.getpid():
+        return client
+
+    with _lock:
+        if _pid != os.getpid():
+            # Forked without register_at_fork (or before it ran): the inherited clients belong to the parent
+            _clients.clear()
+            _pid = os.getpid()
+        client = _clients.get(key)
+        if client is None:
+            client = MongoClient(connection_string, server_api=ServerApi('1'), connect=False, **(options or {}))
+            _clients[key] = client
+        return client
+
+
+def _reset_after_fork():
+    global _lock, _pid
+    _lock = threading.Lock()  # another thread may have held it at the moment of the fork
+    _clients.clear()
+    _pid = os.getpid()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
@@ -0,0 +1,214 @@
+import heapq
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+
+class NodeLoadIndex:
+    """
+    In-memory index of how many tasks sit in each available node's inbox, and how fast each node
+    gets through them.
+
+    Every node has a cost, the expected seconds it needs per task (see app.utilities.node_stats).
+    Nodes are picked by expected completion time, (depth + 1) * cost: the node that would finish
+    one more task soonest. A node without statistics yet is assumed to be as fast as the fastest
+    available node, so it gets a task and is measured. With no costs at all this is plain least-depth.
+
+    Depths live in a dict and are mirrored in a min-heap with lazy deletion: every change pushes
+    a fresh (completion time, node_id) entry and stale entries are skipped when they reach the top.
+    Picking the best node is therefore O(log n) instead of one count_documents per node.
+
+    An idle node can steal from the peers with the longest backlog, depth * cost: it takes the share
+    of a peer's inbox that lets both finish at the same time (see steal_candidates).
+
+    Under a max_depth, a node's inbox holds max_depth tasks scaled by its speed relative to the
+    fastest node (at least one, and exactly one until the node is measured), so a slow node does
+    not sit on a full inbox of work that faster nodes could finish first. Nodes that prefetch more
+    tasks than that get headroom: extra slots on top.
+
+    The index is a cache, Mongo stays the source of truth. It is kept current on assign, complete
+    and requeue, and rebuilt from the inbox collections whenever it is older than max_age_seconds,
+    which also corrects drift between several server processes.
+    """
+    __slots__ = ['_lock', '_depths', '_headroom', '_costs', '_min_cost', '_heap', '_built_at', 'max_age_seconds']
+
+    def __init__(self, max_age_seconds: float = 30):
+        self._lock = threading.Lock()
+        self._depths: Dict[str, int] = {}
+        self._headroom: Dict[str, int] = {}
+        self._costs: Dict[str, float] = {}
+        self._min_cost: Optional[float] = None
+        self._heap: list = []
+        self._built_at: Optional[float] = None
+        self.max_age_seconds = max_age_seconds
+
+    def is_stale(self) -> bool:
+        if self._built_at is None:
+            return True
+        return time.monotonic() - self._built_at > self.max_age_seconds
+
+    def rebuild(self, depths: Dict[str, int], headroom: Optional[Dict[str, int]] = None,
+                costs: Optional[Dict[str, Optional[float]]] = None):
+        """
+        Replaces the whole index with the given {node_id: inbox depth}, {node_id: headroom} and
+        {node_id: seconds per task} mappings. Nodes missing from costs (or mapped to None) are unmeasured.
+        """
+        with self._lock:
+            self._depths = dict(depths)
+            self._headroom = {node_id: slots for node_id, slots in (headroom or {}).items() if slots}
+            self._costs = {node_id: cost for node_id, cost in (costs or {}).items() if cost}
+            self._min_cost = self._available_min_cost()
+            self._heap = [(self._key(node_id), node_id) for node_id in self._depths]
+            heapq.heapify(self._heap)
+            self._built_at = time.monotonic()
+
+    def set_node(self, node_id: str, depth: int = 0):
+        """Adds a node (or overwrites its depth), e.g. when it registers or becomes available."""
+        with self._lock:
+            self._push(node_id, depth)
+            self._update_min_cost()
+
+    def set_headroom(self, node_id: str, slots: int):
+        """Lets a node's inbox hold slots tasks more than its share of max_depth. Unknown (unavailable) nodes are ignored."""
+        with self._lock:
+            if node_id in self._depths:
+                self._headroom[node_id] = slots
+
+    def set_cost(self, node_id: str, seconds: Optional[float]):
+        """Records a node's expected seconds per task. Kept while the node is unavailable, like its headroom."""
+        with self._lock:
+            if not seconds or seconds == self._costs.get(node_id):
+                return
+            self._costs[node_id] = seconds
+            if node_id in self._depths:
+                self._push(node_id, self._depths[node_id])
+                self._update_min_cost()
+
+    def cost(self, node_id: str) -> Optional[float]:
+        return self._costs.get(node_id)
+
+    def remove(self, node_id: str):
+        """Drops a node that is no longer available. Its heap entries are discarded lazily, its headroom and cost are kept."""
+        with self._lock:
+            if self._depths.pop(node_id, None) is not None:
+                self._update_min_cost()
+
+    def adjust(self, node_id: str, delta: int):
+        """Moves a node's depth by delta. Unknown (unavailable) nodes are ignored."""
+        with self._lock:
+            if node_id in self._depths:
+                self._push(node_id, max(0, self._depths[node_id] + delta))
+
+    def depth(self, node_id: str) -> Optional[int]:
+        return self._depths.get(node_id)
+
+    def least_loaded(self) -> Optional[str]:
+        with self._lock:
+            return self._peek()
+
+    def spread(self, count: int, max_depth: Optional[int] = None) -> List[str]:
+        """
+        Picks a node for each of count tasks in one pass, charging every pick to the index so the
+        next one sees the updated completion time. Full nodes are set aside while picking. Stops
+        early once every inbox is full, and returns an empty list when no node is available.
+        """
+        picks = []
+        full = []
+        with self._lock:
+            for _ in range(count):
+                node_id = self._peek()
+                while node_id is not None and max_depth is not None and \
+                        self._depths[node_id] >= self._capacity(node_id, max_depth):
+                    full.append(heapq.heappop(self._heap))
+                    node_id = self._peek()
+                if node_id is None:
+                    break
+                self._push(node_id, self._depths[node_id] + 1)
+                picks.append(node_id)
+            for entry in full:
+                heapq.heappush(self._heap, entry)
+        return picks
+
+    def steal_candidates(self, node_id: str, max_depth: Optional[int] = None, limit: int = 3) -> List[Tuple[str, int]]:
+        """
+        Peers an idle node should take tasks from, longest backlog (depth * cost) first, with how many
+        tasks to take from each: k such that (depth + k) * cost of the thief equals (depth - k) * cost
+        of the peer, capped by the thief's free slots under max_depth. Peers it would not gain a
+        whole task from are left out. Nothing is charged; call adjust once the tasks have moved.
+        """
+        with self._lock:
+            if node_id not in self._depths:
+                return []
+            depth = self._depths[node_id]
+            cost = self._cost(node_id)
+            room = self._capacity(node_id, max_depth) - depth if max_depth is not None else None
+            if room is not None and room <= 0:
+                return []
+            backlogs = heapq.nlargest(
+                limit, (other for other in self._depths if other != node_id),
+                key=lambda other: self._depths[other] * self._cost(other)
+            )
+            candidates = []
+            for other in backlogs:
+                other_cost = self._cost(other)
+                share = int((self._depths[other] * other_cost - depth * cost) / (other_cost + cost))
+                if room is not None:
+                    share = min(share, room)
+                if share >= 1:
+                    candidates.append((other, share))
+            return candidates
+
+    def busy_nodes(self) -> List[str]:
+        """Available nodes whose inbox holds at least one task."""
+        with self._lock:
+            return [node_id for node_id, depth in self._depths.items() if depth]
+
+    def free_slots(self, max_depth: int) -> int:
+        """How many more tasks fit before every inbox is full."""
+        with self._lock:
+            return sum(max(0, self._capacity(node_id, max_depth) - depth) for node_id, depth in self._depths.items())
+
+    def __len__(self):
+        return len(self._depths)
+
+    def _cost(self, node_id: str) -> float:
+        return self._costs.get(node_id) or self._min_cost or 1.0
+
+    def _available_min_cost(self) -> Optional[float]:
+        return min((self._costs[node_id] for node_id in self._depths if node_id in self._costs), default=None)
+
+    def _update_min_cost(self):
+        """Recomputes the fastest cost among available nodes after a node or cost changed."""
+        min_cost = self._available_min_cost()
+        if min_cost != self._min_cost:
+            # Unmeasured nodes are keyed on the fastest cost, so their entries moved too
+            self._min_cost = min_cost
+            for other in self._depths:
+                if other not in self._costs:
+                    heapq.heappush(self._heap, (self._key(other), other))
+
+    def _key(self, node_id: str) -> float:
+        """Expected time until the node would complete one more task."""
+        return (self._depths[node_id] + 1) * self._cost(node_id)
+
+    def _capacity(self, node_id: str, max_depth: int) -> int:
+        share = max_depth
+        if self._min_cost:
+            # An unmeasured node joining a measured fleet is probed with one task
+            share = max(1, round(max_depth * self._min_cost / self._costs[node_id])) if node_id in self._costs else 1
+        return share + self._headroom.get(node_id, 0)
+
+    def _push(self, node_id: str, depth: int):
+        self._depths[node_id] = depth
+        heapq.heappush(self._heap, (self._key(node_id), node_id))
+        if len(self._heap) > 4 * len(self._depths) + 64:
+            self._heap = [(self._key(n), n) for n in self._depths]
+            heapq.heapify(self._heap)
+
+    def _peek(self) -> Optional[str]:
+        while self._heap:
+            key, node_id = self._heap[0]
+            if node_id in self._depths and self._key(node_id) == key:
+                return node_id
+            heapq.heappop(self._heap)
+        return None
@@ -0,0 +1,130 @@
+from datetime import datetime
+from typing import List, Optional, cast
+
+from flask import current_app
+
+from app.extended_flask import ExtendedFlask
+from app.utilities.prefetch import inbox_headroom, prefetch_limit
+
+"""
+Per-node performance model, kept incrementally on each node's all_nodes document.
+
+Every completed batch of tasks updates, as exponentially weighted moving averages (weight
+PREFETCH_EWMA_ALPHA per observation):
+
+- task_seconds: time from claim to completion of a task
+- seconds_per_megapixel: the same time per million pixels of the task's slice, so slices of
+  different sizes are comparable
+
+and derives
+
+- parallelism: tasks the node works on at once, its prefetch_limit if it claims batches, else 1
+- pixels_per_second: parallelism * 1e6 / seconds_per_megapixel
+- failure_rate: tasks_failed / (tasks_completed + tasks_failed), from the node's counters
+- expected_task_seconds: task_seconds / parallelism / (1 - failure_rate), the time the node adds
+  per task to its queue, counting the retries its failures cause
+
+expected_task_seconds is the node's cost in the inbox depth index (app.utilities.node_load), which
+assigns each task to the node with the earliest expected completion time. Claim time is used
+instead of assigned_at: a task waits in the inbox between the two, and that wait is the queue the
+model predicts, not part of the node's speed.
+"""
+
+# Failure rates are capped so a node that failed everything still gets the odd task to prove itself again
+MAX_FAILURE_RATE = 0.9
+
+
+def task_pixels(task: dict) -> int:
+    instruction_data = task.get("instruction_data", {})
+    return max(1, int(instruction_data.get("width", 1)) * int(instruction_data.get("height", 1)))
+
+
+def parallelism(node: dict, limit: Optional[int] = None) -> int:
+    """Tasks the node holds at once: its prefetch window if it claims batches, otherwise one."""
+    if not node.get("prefetching"):
+        return 1
+    return limit if limit is not None else node.get("prefetch_limit") or prefetch_limit(node)
+
+
+def failure_rate(node: dict) -> float:
+    completed = node.get("tasks_completed") or 0
+    failed = node.get("tasks_failed") or 0
+    if completed + failed == 0:
+        return 0.0
+    return min(MAX_FAILURE_RATE, failed / (completed + failed))
+
+
+def expected_task_seconds(node: dict, limit: Optional[int] = None) -> Optional[float]:
+    """Seconds the node adds to its queue per task, or None before its first completed task."""
+    task_seconds = node.get("task_seconds")
+    if not task_seconds:
+        return None
+    return task_seconds / parallelism(node, limit) / (1 - failure_rate(node))
+
+
+def node_performance(node: dict) -> dict:
+    """The performance fields of a node, for reporting."""
+    return {
+        "node_id": node["node_id"],
+        "available": node.get("available", False),
+        "tasks_completed": node.get("tasks_completed", 0),
+        "tasks_failed": node.get("tasks_failed", 0),
+        "failure_rate": failure_rate(node),
+        "task_seconds": node.get("task_seconds"),
+        "pixels_per_second": node.get("pixels_per_second"),
+        "parallelism": parallelism(node),
+        "expected_task_seconds": expected_task_seconds(node),
+    }
+
+
+def observe_completion(node_id: str, tasks: List[dict]):
+    """
+    Folds the node's freshly completed tasks into its averages and updates its prefetch_limit,
+    inbox headroom and cost in the inbox depth index. The node's tasks_completed counter must
+    already include them. Concurrent completions may overwrite each other's samples, which only
+    costs a few data points.
+    """
+    app = cast(ExtendedFlask, current_app)
+    tasks = [task for task in tasks if task.get("claimed_at")]
+    if not tasks:
+        return
+    node = app.computing_nodes_db.get_one("all_nodes", {"node_id": node_id})
+    if not node:
+        return
+
+    now = datetime.utcnow()
+    alpha = app.config["PREFETCH_EWMA_ALPHA"]
+    task_seconds = node.get("task_seconds")
+    seconds_per_megapixel = node.get("seconds_per_megapixel")
+    for task in tasks:
+        elapsed = max(1e-3, (now - task["claimed_at"]).total_seconds())
+        per_megapixel = elapsed / (task_pixels(task) / 1e6)
+        if task_seconds is None:
+            task_seconds, seconds_per_megapixel = elapsed, per_megapixel
+        else:
+            task_seconds = alpha * elapsed + (1 - alpha) * task_seconds
+            seconds_per_megapixel = alpha * per_megapixel + (1 - alpha) * (seconds_per_megapixel or per_megapixel)
+
+    limit = prefetch_limit(node, task_seconds)
+    node["task_seconds"] = task_seconds
+    app.computing_nodes_db.update_many("all_nodes", {"node_id": node_id}, {"$set": {
+        "task_seconds": task_seconds,
+        "seconds_per_megapixel": seconds_per_megapixel,
+        "pixels_per_second": parallelism(node, limit) * 1e6 / seconds_per_megapixel,
+        "failure_rate": failure_rate(node),
+        "prefetch_limit": limit,
+    }})
+    app.node_load.set_headroom(node_id, inbox_headroom(node, limit))
+    app.node_load.set_cost(node_id, expected_task_seconds(node, limit))
+
+
+def observe_failures(node_id: str):
+    """Refreshes the failure rate and cost of a node after its tasks_failed counter went up."""
+    app = cast(ExtendedFlask, current_app)
+    node = app.computing_nodes_db.get_one("all_nodes", {"node_id": node_id})
+    if not node:
+        return
+    app.computing_nodes_db.update_many("all_nodes", {"node_id": node_id}, {"$set": {
+        "failure_rate": failure_rate(node),
+    }})
+    app.node_load.set_cost(node_id, expected_task_seconds(node))
@@ -0,0 +1,100 @@
+import threading
+import time
+from typing import Dict
+
+"""
+Wake-ups for nodes long-polling /node/task/<node_id>/wait.
+
+TaskNotifier keeps a version counter per node. Whoever puts tasks in a node's inbox bumps it, and
+a waiting request sleeps on that node's own condition until the version moves or its timeout
+runs out, so a notification only wakes the node it is meant for.
+
+Assignments made by this process notify directly. Assignments made by other server processes are
+picked up from a Mongo change stream on the inboxes (start_assignment_watcher), which needs a
+replica set. Without one, waiters fall back to re-checking Mongo every LONG_POLL_RECHECK_SECONDS.
+"""
+
+
+class TaskNotifier:
+    __slots__ = ['_lock', '_versions', '_conditions', '_waiters', 'watching']
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._versions: Dict[str, int] = {}
+        self._conditions: Dict[str, threading.Condition] = {}
+        self._waiters: Dict[str, int] = {}
+        self.watching = False  # True while a change stream delivers other processes' assignments
+
+    def version(self, node_id: str) -> int:
+        with self._lock:
+            return self._versions.get(node_id, 0)
+
+    def notify(self, node_id: str):
+        with self._lock:
+            self._versions[node_id] = self._versions.get(node_id, 0) + 1
+            condition = self._conditions.get(node_id)
+            if condition is not None:
+                condition.notify_all()
+
+    def notify_all(self):
+        """Wakes every waiting node, e.g. when a lazy job any of them could pull from arrives."""
+        with self._lock:
+            for node_id, condition in self._conditions.items():
+                self._versions[node_id] = self._versions.get(node_id, 0) + 1
+                condition.notify_all()
+
+    def wait(self, node_id: str, since: int, timeout: float) -> bool:
+        """
+        Blocks until node_id's version differs from since or timeout seconds pass.
+        Returns True if the node was notified.
+        """
+        with self._lock:
+            condition = self._conditions.get(node_id)
+            if condition is None:
+                condition = self._conditions[node_id] = threading.Condition(self._lock)
+            self._waiters[node_id] = self._waiters.get(node_id, 0) + 1
+            try:
+                return condition.wait_for(lambda: self._versions.get(node_id, 0) != since, timeout)
+            finally:
+                self._waiters[node_id] -= 1
+                if self._waiters[node_id] == 0:
+                    del self._waiters[node_id]
+                    del self._conditions[node_id]
+
+    def waiting(self) -> int:
+        with self._lock:
+            return sum(self._waiters.values())
+
+
+def start_assignment_watcher(app, retry_seconds: float = 5, max_retry_seconds: float = 60) -> threading.Thread:
+    """
+    Relays inbox assignments seen on a Mongo change stream to app.task_notifier on a daemon thread.
+    Retries with backoff when the stream fails; while it is down, waiters re-check periodically.
+    """
+    notifier: TaskNotifier = app.task_notifier
+
+    def run():
+        delay = retry_seconds
+        warned = False
+        while True:
+            try:
+                stream, node_id_of = app.task_store.open_inbox_stream()
+                with stream:
+                    notifier.watching = True
+                    warned = False
+                    delay = retry_seconds
+                    for change in stream:
+                        node_id = node_id_of(change)
+                        if node_id:
+                            notifier.notify(node_id)
+            except Exception as e:
+                if not warned:
+                    app.logger.warning(f"Inbox change stream unavailable, long-polls fall back to re-checking: {e}")
+                    warned = True
+            notifier.watching = False
+            time.sleep(delay)
+            delay = min(delay * 2, max_retry_seconds)
+
+    thread = threading.Thread(target=run, name="assignment-watcher", daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,61 @@
+import math
+from typing import Optional, cast
+
+from flask import current_app
+
+from app.extended_flask import ExtendedFlask
+
+"""
+Per-node prefetch window for batch claims (/node/tasks/<node_id>).
+
+A node may hold at most prefetch_limit RUNNING tasks. The limit starts at the node's advertised
+compute_specs.cores, one task per core, and grows with the throughput the server observes: enough
+tasks to keep every core busy for PREFETCH_TARGET_SECONDS, so a node working through short tasks
+does not go idle for a round trip between batches. It never exceeds PREFETCH_MAX_TASKS.
+
+Throughput is cores / task_seconds, where task_seconds is an exponentially weighted moving average
+of the time from claim to completion of the node's tasks, kept on its all_nodes document by
+app.utilities.node_stats. Tasks of a batch larger than the node's core count wait for a free core,
+which inflates task_seconds and errs towards a smaller window. Intervals between completions would not work: a batch finished
+in parallel is often uploaded in a burst.
+
+Once a node has claimed a batch (prefetching on its document), a window larger than
+INBOX_TARGET_DEPTH becomes headroom in the inbox depth index, so fill_inboxes keeps enough tasks
+in its inbox to fill it. Nodes fetching one task at a time keep shallow inboxes: tasks parked in
+a deep inbox are tasks another client's new job has to wait behind.
+"""
+
+
+def advertised_cores(node: dict) -> int:
+    """The node's compute_specs.cores as a positive int, 1 if it did not send a usable value."""
+    try:
+        return max(1, int(node.get("computer_specs", {}).get("cores")))
+    except (TypeError, ValueError):
+        return 1
+
+
+def prefetch_limit(node: dict, task_seconds: Optional[float] = None) -> int:
+    """
+    Args:
+        node: The node's all_nodes document.
+        task_seconds: Observed seconds per task, read from the document if omitted.
+    """
+    app = cast(ExtendedFlask, current_app)
+    cores = advertised_cores(node)
+    limit = cores
+    if task_seconds is None:
+        task_seconds = node.get("task_seconds")
+    if task_seconds:
+        limit = max(limit, math.ceil(cores * app.config["PREFETCH_TARGET_SECONDS"] / task_seconds))
+    return min(limit, app.config["PREFETCH_MAX_TASKS"])
+
+
+def inbox_headroom(node: dict, limit: Optional[int] = None) -> int:
+    """Extra inbox slots beyond INBOX_TARGET_DEPTH the node needs to fill its prefetch window."""
+    app = cast(ExtendedFlask, current_app)
+    target_depth = app.config["INBOX_TARGET_DEPTH"]
+    if not target_depth or not node.get("prefetching"):
+        return 0
+    if limit is None:
+        limit = prefetch_limit(node)
+    return max(0, limit - target_depth)
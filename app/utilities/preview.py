@@ -0,0 +1,73 @@
+import math
+from io import BytesIO
+from typing import Tuple, cast
+
+from bson import Binary
+from flask import current_app
+from PIL import Image
+
+from app.extended_flask import ExtendedFlask
+from app.utilities.compositor import slice_offset
+
+"""
+Low-resolution previews of jobs that are still running.
+
+When a slice is submitted, a thumbnail of it is stored in 'job_previews' at the scale the preview
+uses (PREVIEW_MAX_WIDTH wide for the whole image). A preview is then one indexed query for the
+job's thumbnails, pasted onto a small placeholder canvas, whatever the full resolution is.
+"""
+
+PREVIEW_COLLECTION = "job_previews"
+PLACEHOLDER_COLOR = (48, 48, 48)
+
+
+def preview_scale(job: dict) -> float:
+    app = cast(ExtendedFlask, current_app)
+    final_width = job["mandelbrot"]["resolution"]["width"]
+    return min(1.0, app.config["PREVIEW_MAX_WIDTH"] / final_width)
+
+
+def preview_size(job: dict) -> Tuple[int, int]:
+    scale = preview_scale(job)
+    resolution = job["mandelbrot"]["resolution"]
+    return max(1, math.floor(resolution["width"] * scale)), max(1, math.floor(resolution["height"] * scale))
+
+
+def store_thumbnail(job: dict, task: dict, image: Image.Image):
+    """
+    Downscales a submitted slice to preview scale and stores it for the job's preview. A slice
+    recorded again, e.g. after a retried upload, replaces its thumbnail instead of adding another.
+    """
+    app = cast(ExtendedFlask, current_app)
+    scale = preview_scale(job)
+    offset_x, offset_y = slice_offset(task["instruction_data"], job["mandelbrot"])
+
+    # Scale the slice's edges rather than its size, so neighbouring thumbnails meet without gaps
+    left, top = math.floor(offset_x * scale), math.floor(offset_y * scale)
+    right = max(left + 1, math.floor((offset_x + image.width) * scale))
+    bottom = max(top + 1, math.floor((offset_y + image.height) * scale))
+
+    thumbnail = image.resize((right - left, bottom - top), Image.BILINEAR)
+    buffer = BytesIO()
+    thumbnail.save(buffer, format="PNG")
+    app.jobs_and_tasks_db.db[PREVIEW_COLLECTION].replace_one({"job_id": job["job_id"], "task_id": task["task_id"]}, {
+        "job_id": job["job_id"],
+        "task_id": task["task_id"],
+        "x": left,
+        "y": top,
+        "png": Binary(buffer.getvalue()),
+    }, upsert=True)
+
+
+def render_preview(job: dict) -> Tuple[bytes, int]:
+    """Composites every stored thumbnail of a job over a placeholder. Returns (png bytes, slices shown)."""
+    app = cast(ExtendedFlask, current_app)
+    preview = Image.new("RGB", preview_size(job), PLACEHOLDER_COLOR)
+    thumbnails = app.jobs_and_tasks_db.find(PREVIEW_COLLECTION, {"job_id": job["job_id"]})
+    for thumbnail in thumbnails:
+        with Image.open(BytesIO(thumbnail["png"])) as image:
+            preview.paste(image.convert("RGB"), (thumbnail["x"], thumbnail["y"]))
+
+    buffer = BytesIO()
+    preview.save(buffer, format="PNG")
+    return buffer.getvalue(), len(thumbnails)
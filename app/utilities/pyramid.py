@@ -0,0 +1,188 @@
+import uuid
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple, cast
+
+from flask import current_app
+from pymongo import ReturnDocument
+
+from app.extended_flask import ExtendedFlask
+from app.utilities.dispatch import normalize_priority
+from app.utilities.job_creator import RESULT_FORMATS, create_job_and_tasks
+from app.utilities.iterations import normalize_palette
+
+"""
+Deep-zoom tile pyramids over a region of the complex plane.
+
+A pyramid is a quadtree of tile_size x tile_size tiles: zoom level z splits the region into
+2^z x 2^z tiles, addressed XYZ style with x growing with the real axis and y with the imaginary
+axis (row 0 of every image is y_min, as in full jobs). A tile is rendered by an ordinary one-task
+job tagged with pyramid_id and tile, so scheduling, fair share, result memoization, compositing and
+both result formats work for tiles unchanged.
+
+The 'tiles' collection maps (pyramid_id, z, x, y) to the tile's job_id and, once the job is done
+and the tile was first served, to the GridFS id of its PNG. A unique index on the address makes
+sure concurrent requests for a missing tile start a single job. On top of that, each process keeps
+the encoded bytes of hot tiles in an in-memory LRU (app.tile_cache), so a cached tile is answered
+without any database round trip.
+
+Levels up to prefetch_zoom are queued at low priority when the pyramid is created, and the four
+children of every requested tile are prefetched the same way. A tile requested before it is
+rendered is queued, or promoted if it was prefetched, at high priority.
+"""
+
+PYRAMIDS_COLLECTION = "tile_pyramids"
+TILES_COLLECTION = "tiles"
+MAX_PREFETCH_ZOOM = 4  # 341 tiles
+
+
+def create_pyramid(
+    x_min: float,
+    x_max: float,
+    y_min: float,
+    y_max: float,
+    client_id: str,
+    *,
+    tile_size: int,
+    max_zoom: int,
+    prefetch_zoom: int = 0,
+    result_format: str = "png",
+    palette: Any = None,
+    zoom_limit: int = 40
+) -> Dict[str, Any]:
+    """
+    Builds a pyramid document.
+
+    Args:
+        x_min, x_max, y_min, y_max (float): Region covered by tile 0/0/0.
+        client_id (str): Client the tile jobs are scheduled for.
+        tile_size (int): Edge of every tile in pixels.
+        max_zoom (int): Deepest zoom level served.
+        prefetch_zoom (int, optional): Levels 0..prefetch_zoom are rendered up front. Defaults to 0.
+        result_format (str, optional): "png" or "iterations", as for jobs. Defaults to "png".
+        palette (optional): Palette of "iterations" pyramids.
+        zoom_limit (int, optional): Largest max_zoom accepted. Defaults to 40.
+
+    Raises:
+        ValueError: If the region, sizes, zoom levels, result_format or palette are invalid.
+    """
+    if x_max <= x_min or y_max <= y_min:
+        raise ValueError("Invalid region: x_max must be greater than x_min, and y_max must be greater than y_min")
+    if not 16 <= tile_size <= 1024:
+        raise ValueError("tile_size must be between 16 and 1024 pixels")
+    if not 0 <= max_zoom <= zoom_limit:
+        raise ValueError(f"max_zoom must be between 0 and {zoom_limit}")
+    if not 0 <= prefetch_zoom <= min(max_zoom, MAX_PREFETCH_ZOOM):
+        raise ValueError(f"prefetch_zoom must be between 0 and min(max_zoom, {MAX_PREFETCH_ZOOM})")
+    if result_format not in RESULT_FORMATS:
+        raise ValueError(f"result_format must be one of {list(RESULT_FORMATS)}")
+    if palette is not None:
+        normalize_palette(palette)
+
+    return {
+        "pyramid_id": str(uuid.uuid4()),
+        "client_id": client_id,
+        "created_at": datetime.utcnow(),
+        "region": {"x_min": x_min, "x_max": x_max, "y_min": y_min, "y_max": y_max},
+        "tile_size": tile_size,
+        "max_zoom": max_zoom,
+        "prefetch_zoom": prefetch_zoom,
+        "result_format": result_format,
+        "palette": palette,
+    }
+
+
+def tile_bounds(pyramid: dict, z: int, x: int, y: int) -> Tuple[float, float, float, float]:
+    """(x_min, x_max, y_min, y_max) of tile z/x/y."""
+    region = pyramid["region"]
+    n = 1 << z
+    x_step = (region["x_max"] - region["x_min"]) / n
+    y_step = (region["y_max"] - region["y_min"]) / n
+    return (
+        region["x_min"] + x * x_step,
+        region["x_max"] if x == n - 1 else region["x_min"] + (x + 1) * x_step,
+        region["y_min"] + y * y_step,
+        region["y_max"] if y == n - 1 else region["y_min"] + (y + 1) * y_step,
+    )
+
+
+def valid_tile(pyramid: dict, z: int, x: int, y: int) -> bool:
+    return 0 <= z <= pyramid["max_zoom"] and 0 <= x < (1 << z) and 0 <= y < (1 << z)
+
+
+def child_tiles(z: int, x: int, y: int) -> List[Tuple[int, int, int]]:
+    return [(z + 1, 2 * x + dx, 2 * y + dy) for dy in (0, 1) for dx in (0, 1)]
+
+
+def get_tile(pyramid_id: str, z: int, x: int, y: int) -> Optional[dict]:
+    app = cast(ExtendedFlask, current_app)
+    return app.jobs_and_tasks_db.get_one(TILES_COLLECTION, {"pyramid_id": pyramid_id, "z": z, "x": x, "y": y})
+
+
+def plan_tile(pyramid: dict, z: int, x: int, y: int, priority: str) -> Tuple[dict, List[dict]]:
+    """
+    Makes sure tile z/x/y has a job. Returns the tile record and the tasks of a newly created job,
+    which the caller queues (none if the tile already had a job).
+    """
+    app = cast(ExtendedFlask, current_app)
+    job_db = app.jobs_and_tasks_db
+    existing = get_tile(pyramid["pyramid_id"], z, x, y)
+    if existing is not None:
+        return existing, []
+
+    address = {"pyramid_id": pyramid["pyramid_id"], "z": z, "x": x, "y": y}
+    size = pyramid["tile_size"]
+    job, *tasks = create_job_and_tasks(
+        *tile_bounds(pyramid, z, x, y), size, size, pyramid["client_id"],
+        num_tasks=1,
+        message=f"Tile {z}/{x}/{y} of pyramid {pyramid['pyramid_id']}",
+        priority=priority,
+        result_format=pyramid["result_format"],
+        palette=pyramid["palette"]
+    )
+
+    # The job is stored before the tile record points at it, so a record never names a missing job
+    # (which a concurrent request would take for a job that is gone and forget)
+    job["pyramid_id"] = pyramid["pyramid_id"]
+    job["tile"] = {"z": z, "x": x, "y": y}
+    job_db.add("active_jobs", job)
+
+    # Only the request that inserts the tile record keeps its job; the others drop theirs before queueing it
+    existing = job_db.db[TILES_COLLECTION].find_one_and_update(
+        address,
+        {"$setOnInsert": {
+            **address,
+            "job_id": job["job_id"],
+            "priority_level": normalize_priority(priority),
+            "image_id": None,
+            "created_at": datetime.utcnow(),
+        }},
+        upsert=True, return_document=ReturnDocument.BEFORE
+    )
+    if existing is not None:
+        job_db.delete_many("active_jobs", {"job_id": job["job_id"]})
+        return existing, []
+    return get_tile(pyramid["pyramid_id"], z, x, y), tasks
+
+
+def promote_tile(tile: dict, priority: str) -> int:
+    """Moves the job of a tile that is still queued up to priority. Returns how many tasks were promoted."""
+    app = cast(ExtendedFlask, current_app)
+    level = normalize_priority(priority)
+    if tile["priority_level"] <= level:
+        return 0
+    app.jobs_and_tasks_db.update_many(TILES_COLLECTION, {"_id": tile["_id"]}, {"$set": {"priority_level": level}})
+    app.jobs_and_tasks_db.update_many("active_jobs", {"job_id": tile["job_id"]}, {"$set": {
+        "priority": priority, "priority_level": level
+    }})
+    return app.task_store.promote({"job_id": tile["job_id"]}, level)
+
+
+def forget_tile(tile: dict):
+    """Drops a tile record whose job is gone, so the next request starts a new one."""
+    app = cast(ExtendedFlask, current_app)
+    app.jobs_and_tasks_db.delete_many(TILES_COLLECTION, {"_id": tile["_id"], "job_id": tile["job_id"]})
+
+
+def store_tile_image(tile: dict, image_id: str):
+    app = cast(ExtendedFlask, current_app)
+    app.jobs_and_tasks_db.update_many(TILES_COLLECTION, {"_id": tile["_id"]}, {"$set": {"image_id": image_id}})
@@ -0,0 +1,180 @@
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import cast
+
+from flask import current_app
+
+from app.extended_flask import ExtendedFlask
+from app.utilities.assign_tasks import fill_inboxes, load_index
+from app.utilities.node_stats import observe_failures
+from app.utilities.results import sweep_canvases
+from app.utilities.speculation import refresh_stragglers
+
+"""
+Background reaper for stranded tasks.
+
+A task is stranded when its lease expired (the node claimed it and went quiet), when its node
+stopped sending heartbeats, or when its node was marked unavailable. Stranded tasks are pulled out
+of the node inbox, reset and put back into the unassigned pool, which is then drained in batches
+through the normal assignment path.
+
+The TaskStore moves tasks so that the reaper never races a completing node or another reaper
+process for the same document, and a late upload from the old holder is rejected.
+"""
+
+
+def requeue_node_tasks(node_id: str, expired_only: bool = False) -> int:
+    """
+    Moves tasks out of a node's inbox back into the unassigned pool.
+
+    Args:
+        node_id: Node whose inbox is drained.
+        expired_only: Only move RUNNING tasks whose lease has expired, instead of every task.
+
+    Returns:
+        int: Number of tasks requeued.
+    """
+    app = cast(ExtendedFlask, current_app)
+
+    if expired_only:
+        query = {"status": "RUNNING", "lease_expires_at": {"$lt": datetime.utcnow()}}
+    else:
+        query = {"status": {"$in": ["ASSIGNED", "RUNNING"]}}
+
+    count = app.task_store.requeue(node_id, query)
+    if count == 0:
+        return 0
+
+    app.node_load.adjust(node_id, -count)
+    app.fair_share.invalidate()  # the requeued tasks' clients are pending again
+    if expired_only:
+        app.computing_nodes_db.increment_field("all_nodes", {"node_id": node_id}, "tasks_failed", count)
+        observe_failures(node_id)
+    return count
+
+
+def release_node(node_id: str) -> int:
+    """Requeues every task of a node that went unavailable and clears its 'stranded' flag."""
+    app = cast(ExtendedFlask, current_app)
+    app.node_load.remove(node_id)
+    count = requeue_node_tasks(node_id)
+    app.computing_nodes_db.update_field("all_nodes", {"node_id": node_id}, "stranded", False)
+    return count
+
+
+def reassign_unassigned(batch_size: int) -> int:
+    """
+    Fills inboxes with up to batch_size tasks from the unassigned pool, in fair-share order.
+    Tasks that still find no inbox slot stay in the pool.
+    """
+    return fill_inboxes(batch_size)
+
+
+def reap_stranded_tasks() -> dict:
+    """
+    One reaper pass: expires silent nodes, recovers interrupted task moves, requeues tasks of
+    unavailable nodes and expired leases, ages queued tasks, then reassigns unassigned tasks in batches.
+    """
+    app = cast(ExtendedFlask, current_app)
+    nodes_db = app.computing_nodes_db
+    # Claims and lease renewals count as heartbeats, so a node holding an unexpired lease is never silent for longer
+    # than TASK_LEASE_SECONDS, however long its slice takes
+    timeout = max(app.config["NODE_HEARTBEAT_TIMEOUT_SECONDS"], app.config["TASK_LEASE_SECONDS"])
+    heartbeat_cutoff = datetime.utcnow() - timedelta(seconds=timeout)
+
+    # Nodes that stopped polling are treated as if they had set themselves unavailable, until they poll again
+    nodes_db.update_many(
+        "all_nodes",
+        {"available": True, "last_seen": {"$lt": heartbeat_cutoff}},
+        {"$set": {"available": False, "stranded": True, "timed_out": True, "unavailable_since": datetime.utcnow()}}
+    )
+
+    # Moves a crashed process left halfway would otherwise strand their tasks where no query finds them. Only
+    # nodes that can still hold one are scanned: available ones, ones being released, and ones that went
+    # unavailable recently enough for a move started just before to have not been recovered yet
+    move_seconds = app.config["ORPHANED_MOVE_SECONDS"]
+    move_cutoff = datetime.utcnow() - timedelta(seconds=move_seconds)
+    recovered = app.task_store.recover_moves(move_cutoff, nodes_db.distinct("all_nodes", "node_id", {"$or": [
+        {"available": True},
+        {"stranded": True},
+        {"unavailable_since": {"$gte": move_cutoff - timedelta(seconds=move_seconds)}},
+    ]}))
+    if recovered:
+        app.fair_share.invalidate()
+
+    requeued = 0
+    for node in nodes_db.find("all_nodes", {"stranded": True}):
+        requeued += release_node(node["node_id"])
+
+    available_node_ids = [node["node_id"] for node in nodes_db.find("all_nodes", {"available": True})]
+    for node_id in app.task_store.nodes_with_expired_leases(datetime.utcnow(), available_node_ids):
+        requeued += requeue_node_tasks(node_id, expired_only=True)
+
+    # Waiting tasks climb one priority level per PRIORITY_AGING_SECONDS, and to high once they waited
+    # PRIORITY_MAX_WAIT_SECONDS, so no work starves behind a steady stream of higher priority work. Empty
+    # inboxes have nothing to age, so only the pool and the inboxes the load index reports tasks in are updated
+    aged = app.task_store.age_priorities(
+        datetime.utcnow(), app.config["PRIORITY_AGING_SECONDS"], app.config["PRIORITY_MAX_WAIT_SECONDS"],
+        load_index().busy_nodes()
+    )
+
+    # Rescan for straggler tasks here, so idle polls find the list fresh (see app/utilities/speculation.py)
+    refresh_stragglers()
+
+    # Canvases of jobs that finished without this host producing their composite would otherwise stay on disk
+    sweep_canvases()
+
+    reassigned = 0
+    batch_size = app.config["REAPER_BATCH_SIZE"]
+    while True:
+        count = reassign_unassigned(batch_size)
+        reassigned += count
+        # A short batch means the pool is drained, or every inbox is full
+        if count < batch_size or len(app.node_load) == 0:
+            break
+
+    return {"requeued": requeued, "reassigned": reassigned, "aged": aged, "recovered": recovered}
+
+
+def ensure_reaper_indexes():
+    """
+    Creates the all_nodes indexes the reaper scans rely on. Task indexes are created by the TaskStore.
+    Nodes that went unavailable before unavailable_since was recorded get it now, so their inboxes
+    are scanned for interrupted moves once more.
+    """
+    app = cast(ExtendedFlask, current_app)
+    app.computing_nodes_db.create_index("all_nodes", [("available", 1), ("last_seen", 1)])
+    app.computing_nodes_db.create_index("all_nodes", [("stranded", 1)])
+    app.computing_nodes_db.create_index("all_nodes", [("unavailable_since", 1)], sparse=True)
+    app.computing_nodes_db.update_many(
+        "all_nodes", {"available": False, "unavailable_since": {"$exists": False}},
+        {"$set": {"unavailable_since": datetime.utcnow()}}
+    )
+
+
+def start_reaper(app: ExtendedFlask) -> threading.Thread:
+    """Runs reap_stranded_tasks every REAPER_INTERVAL_SECONDS on a daemon thread."""
+    interval = app.config["REAPER_INTERVAL_SECONDS"]
+
+    def run():
+        with app.app_context():
+            try:
+                ensure_reaper_indexes()
+            except Exception as e:
+                app.logger.error(f"Reaper could not create indexes: {e}")
+            while True:
+                time.sleep(interval)
+                try:
+                    result = reap_stranded_tasks()
+                    if result["requeued"] or result["reassigned"] or result["recovered"]:
+                        app.logger.info(
+                            f"Reaper requeued {result['requeued']} and reassigned {result['reassigned']} tasks, "
+                            f"recovered {result['recovered']} interrupted moves"
+                        )
+                except Exception as e:
+                    app.logger.error(f"Reaper pass failed: {e}")
+
+    thread = threading.Thread(target=run, name="task-reaper", daemon=True)
+    thread.start()
+    return thread
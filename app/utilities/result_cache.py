@@ -0,0 +1,255 @@
+import hashlib
+import json
+from collections import Counter
+from datetime import datetime
+from typing import List, Tuple, cast
+
+from bson import ObjectId
+from flask import current_app
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+from app.extended_flask import ExtendedFlask
+from app.utilities.metrics import increment_many, read_counters
+
+"""
+Memoization of task results across jobs.
+
+Clients often resubmit the same region at the same resolution. Every completed slice is indexed in
+'result_cache' under result_key, a sha256 of the task's instruction, its instruction_data without
+the slice's placement in the final image, its image_metadata (result format and resolution) and
+RESULT_CACHE_NAMESPACE. The entry points at the GridFS file the node uploaded; nothing is copied.
+
+When a job is submitted, or a lazy job's tasks are generated, tasks with an entry are completed on
+the spot by the sentinel node CACHE_NODE_ID: they land in its outbox with the cached image_id and
+go through record_completions like any upload, so compositing and downloads need no special case.
+Only the misses are dispatched.
+
+The cache indexes at most RESULT_CACHE_MAX_BYTES of results. Beyond that, entries are evicted by
+RESULT_CACHE_EVICTION: "lru" drops the least recently used, "lfu" the least often hit. Eviction
+only forgets the entry; the file stays with the job that produced it. An entry whose file has been
+deleted is dropped when it is next looked up. Hits, misses, evictions and the indexed bytes are
+counters in app.utilities.metrics, reported by GET /metrics.
+"""
+
+RESULT_CACHE_COLLECTION = "result_cache"
+CACHE_NODE_ID = "result-cache"
+EVICTION_SORTS = {
+    "lru": [("last_used_at", 1)],
+    "lfu": [("hits", 1), ("last_used_at", 1)],
+}
+EVICTION_BATCH = 64
+
+# instruction_data fields that only place a slice in the final image, not what is rendered
+PLACEMENT_FIELDS = ("pixel_x", "pixel_y")
+
+
+def result_key(task: dict, namespace: str) -> str:
+    """Canonical hash of everything that determines a task's result."""
+    instruction_data = {
+        field: value for field, value in task["instruction_data"].items() if field not in PLACEMENT_FIELDS
+    }
+    canonical = json.dumps({
+        "namespace": namespace,
+        "instruction": task["instruction"],
+        "instruction_data": instruction_data,
+        "image_metadata": task.get("image_metadata", {}),
+    }, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+def ensure_result_cache(app: ExtendedFlask):
+    """
+    Creates the cache indexes and the sentinel node's all_nodes record. The sentinel is never
+    available, so nothing is ever assigned to it, but per-node outbox scans and migrations find it.
+
+    Raises:
+        ValueError: If RESULT_CACHE_EVICTION is not a known policy.
+    """
+    if app.config["RESULT_CACHE_EVICTION"] not in EVICTION_SORTS:
+        raise ValueError(
+            f"Unknown RESULT_CACHE_EVICTION '{app.config['RESULT_CACHE_EVICTION']}', "
+            f"expected one of {sorted(EVICTION_SORTS)}"
+        )
+    app.jobs_and_tasks_db.create_index(RESULT_CACHE_COLLECTION, [("key", 1)], unique=True)
+    for sort in EVICTION_SORTS.values():
+        app.jobs_and_tasks_db.create_index(RESULT_CACHE_COLLECTION, sort)
+
+    app.computing_nodes_db.db["all_nodes"].update_one({"node_id": CACHE_NODE_ID}, {"$setOnInsert": {
+        "node_id": CACHE_NODE_ID,
+        "name": "result cache",
+        "sentinel": True,
+        "date_joined": {"$date": datetime.utcnow().isoformat() + "Z"},
+        "available": False,
+        "stranded": False,
+        "tasks_completed": 0,
+        "tasks_failed": 0,
+    }}, upsert=True)
+
+
+def split_cached(tasks: List[dict]) -> Tuple[List[dict], List[dict]]:
+    """
+    Looks up a batch of new tasks in the cache with one query.
+
+    Returns:
+        (hits, misses): the hits as COMPLETED task documents held by CACHE_NODE_ID with the cached
+        output_data, and the tasks that still have to be computed, both in their original order.
+    """
+    app = cast(ExtendedFlask, current_app)
+    if not app.config["RESULT_CACHE_ENABLED"] or not tasks:
+        return [], tasks
+
+    db = app.jobs_and_tasks_db
+    keys = [result_key(task, app.config["RESULT_CACHE_NAMESPACE"]) for task in tasks]
+    entries = {entry["key"]: entry for entry in db.find(RESULT_CACHE_COLLECTION, {"key": {"$in": list(set(keys))}})}
+
+    # An entry is only served while its file exists
+    if entries:
+        present = {
+            str(doc["_id"]) for doc in db.db.fs.files.find(
+                {"_id": {"$in": [ObjectId(entry["image_id"]) for entry in entries.values()]}}, {"_id": 1}
+            )
+        }
+        dangling = [key for key, entry in entries.items() if entry["image_id"] not in present]
+        if dangling:
+            forget(dangling)
+            for key in dangling:
+                del entries[key]
+
+    now = datetime.utcnow()
+    hits, misses = [], []
+    for task, key in zip(tasks, keys):
+        entry = entries.get(key)
+        if entry:
+            hits.append(cached_task(task, entry, now))
+        else:
+            misses.append(task)
+
+    db.bulk_write(RESULT_CACHE_COLLECTION, [
+        UpdateOne({"key": key}, {"$set": {"last_used_at": now}, "$inc": {"hits": count}})
+        for key, count in Counter(key for key in keys if key in entries).items()
+    ])
+    increment_many({"result_cache.hits": len(hits), "result_cache.misses": len(misses)})
+    return hits, misses
+
+
+def cached_task(task: dict, entry: dict, now: datetime) -> dict:
+    """The task completed by CACHE_NODE_ID with the result of a cache entry."""
+    task["status"] = "COMPLETED"
+    task["assigned_to"] = CACHE_NODE_ID
+    task["assigned_at"] = {"$date": now.isoformat() + "Z"}
+    task["completed_at"] = now
+    task["cache_hit"] = True
+    task["output_data"] = {**task.get("output_data", {}), "image_id": entry["image_id"], "file_name": entry["file_name"]}
+    return task
+
+
+def remember_results(tasks: List[dict]):
+    """
+    Indexes the results of freshly completed tasks, then evicts entries if the cache has grown
+    beyond RESULT_CACHE_MAX_BYTES. A result that is already cached keeps its existing entry.
+    """
+    app = cast(ExtendedFlask, current_app)
+    if not app.config["RESULT_CACHE_ENABLED"]:
+        return
+    db = app.jobs_and_tasks_db
+    namespace = app.config["RESULT_CACHE_NAMESPACE"]
+
+    new_results = {}
+    for task in tasks:
+        if task.get("assigned_to") != CACHE_NODE_ID and task.get("output_data", {}).get("image_id"):
+            new_results[result_key(task, namespace)] = task
+    if not new_results:
+        return
+
+    image_ids = [ObjectId(task["output_data"]["image_id"]) for task in new_results.values()]
+    sizes = {str(doc["_id"]): doc["length"] for doc in db.db.fs.files.find({"_id": {"$in": image_ids}}, {"length": 1})}
+
+    now = datetime.utcnow()
+    entries = [
+        {
+            "key": key,
+            "image_id": task["output_data"]["image_id"],
+            "file_name": task["output_data"].get("file_name"),
+            "size": sizes.get(task["output_data"]["image_id"], 0),
+            "job_id": task["job_id"],
+            "created_at": now,
+            "last_used_at": now,
+            "hits": 0,
+        }
+        for key, task in new_results.items()
+    ]
+    operations = [UpdateOne({"key": entry["key"]}, {"$setOnInsert": entry}, upsert=True) for entry in entries]
+    try:
+        upserted = db.bulk_write(RESULT_CACHE_COLLECTION, operations).upserted_ids
+    except BulkWriteError as e:
+        # Another process cached some of the same results in between; its entries stand
+        upserted = {item["index"]: item["_id"] for item in e.details.get("upserted", [])}
+
+    increment_many({
+        "result_cache.entries": len(upserted),
+        "result_cache.bytes": sum(entries[index]["size"] for index in upserted),
+    })
+    evict(app.config["RESULT_CACHE_MAX_BYTES"], app.config["RESULT_CACHE_EVICTION"])
+
+
+def forget(keys: List[str]) -> int:
+    """
+    Removes entries one find_one_and_delete at a time, so concurrent removals never count the same
+    entry twice. Returns the bytes freed.
+    """
+    app = cast(ExtendedFlask, current_app)
+    removed, freed = 0, 0
+    for key in keys:
+        entry = app.jobs_and_tasks_db.take_one(RESULT_CACHE_COLLECTION, {"key": key})
+        if entry:
+            removed += 1
+            freed += entry.get("size", 0)
+    increment_many({"result_cache.entries": -removed, "result_cache.bytes": -freed})
+    return freed
+
+
+def evict(max_bytes: int, policy: str) -> int:
+    """Forgets entries in policy order until at most max_bytes are indexed. Returns how many were evicted."""
+    app = cast(ExtendedFlask, current_app)
+    excess = cached_bytes() - max_bytes
+    evicted = 0
+    while excess > 0:
+        victims = []
+        for entry in app.jobs_and_tasks_db.find(
+            RESULT_CACHE_COLLECTION, {}, limit=EVICTION_BATCH, sort=EVICTION_SORTS[policy]
+        ):
+            victims.append(entry["key"])
+            excess -= entry.get("size", 0)
+            if excess <= 0:
+                break
+        if not victims:
+            break
+        forget(victims)
+        evicted += len(victims)
+
+    increment_many({"result_cache.evictions": evicted})
+    return evicted
+
+
+def cached_bytes() -> int:
+    return read_counters("result_cache.bytes").get("result_cache.bytes", 0)
+
+
+def result_cache_stats() -> dict:
+    """Configuration and counters of the cache, with its hit rate over all lookups so far."""
+    app = cast(ExtendedFlask, current_app)
+    counters = read_counters("result_cache.")
+    hits = counters.get("result_cache.hits", 0)
+    misses = counters.get("result_cache.misses", 0)
+    return {
+        "enabled": app.config["RESULT_CACHE_ENABLED"],
+        "eviction": app.config["RESULT_CACHE_EVICTION"],
+        "max_bytes": app.config["RESULT_CACHE_MAX_BYTES"],
+        "bytes": counters.get("result_cache.bytes", 0),
+        "entries": counters.get("result_cache.entries", 0),
+        "hits": hits,
+        "misses": misses,
+        "evictions": counters.get("result_cache.evictions", 0),
+        "hit_rate": hits / (hits + misses) if hits + misses else None,
+    }
@@ -0,0 +1,205 @@
+import hashlib
+import os
+import socket
+import time
+from collections import defaultdict
+from datetime import datetime
+from typing import List, Optional, Tuple, cast
+
+import gridfs
+from flask import current_app
+from PIL import Image
+
+from app.extended_flask import ExtendedFlask
+from app.utilities.compositor import RgbCanvas, decode_image, slice_offset, stream_png
+from app.utilities.preview import store_thumbnail
+from app.utilities.result_cache import remember_results
+from app.utilities.speculation import in_tail
+
+"""
+Work done when a task result arrives, after the task has been moved to the outbox.
+
+Each slice is pasted into a per-job canvas, a raw RGB file memory-mapped from COMPOSITE_CANVAS_DIR,
+as soon as it is uploaded. The upload that completes the job encodes the canvas to PNG once and
+stores it in GridFS as the job's composite, so /client/completed-job only has to stream that blob.
+
+Canvases are local files. Every paste is counted per host on the job document, and the composite
+is only produced when the finishing host pasted every slice itself; otherwise (several servers
+without a shared canvas directory, a failed paste, ...) the download falls back to reconstructing
+the image from the slices. A canvas that cannot become the composite is deleted when its job
+finishes, and the reaper deletes any canvas of a finished or missing job that was left behind.
+"""
+
+
+def canvas_path(job_id: str) -> str:
+    app = cast(ExtendedFlask, current_app)
+    return os.path.join(app.config["COMPOSITE_CANVAS_DIR"], f"{job_id}.rgb")
+
+
+def discard_canvas(job_id: str):
+    try:
+        os.remove(canvas_path(job_id))
+    except FileNotFoundError:
+        pass
+
+
+def sweep_canvases() -> int:
+    """
+    Deletes this host's canvases of jobs that finished or no longer exist, once no paste touched
+    them for COMPOSITE_CANVAS_GRACE_SECONDS. Canvases of running jobs are kept. Returns how many.
+    """
+    app = cast(ExtendedFlask, current_app)
+    canvas_dir = app.config["COMPOSITE_CANVAS_DIR"]
+    cutoff = time.time() - app.config["COMPOSITE_CANVAS_GRACE_SECONDS"]
+    try:
+        idle = [
+            entry.name[:-len(".rgb")] for entry in os.scandir(canvas_dir)
+            if entry.name.endswith(".rgb") and entry.stat().st_mtime < cutoff
+        ]
+    except FileNotFoundError:
+        return 0
+    if not idle:
+        return 0
+
+    running = {
+        job["job_id"]
+        for job in app.jobs_and_tasks_db.db["active_jobs"].find(
+            {"job_id": {"$in": idle}, "status": {"$ne": "COMPLETED"}},
+            {"job_id": 1, "num_completed": 1, "num_tasks": 1}
+        )
+        if job["num_completed"] < job["num_tasks"]
+    }
+    for job_id in idle:
+        if job_id not in running:
+            discard_canvas(job_id)
+    return len(idle) - len(running)
+
+
+def paste_into_canvas(job: dict, task: dict, image: Image.Image) -> bool:
+    """Pastes one slice into the job's canvas, creating the canvas file on first use. Returns False on failure."""
+    app = cast(ExtendedFlask, current_app)
+    mandelbrot_info = job["mandelbrot"]
+    width = mandelbrot_info["resolution"]["width"]
+    height = mandelbrot_info["resolution"]["height"]
+    try:
+        os.makedirs(app.config["COMPOSITE_CANVAS_DIR"], exist_ok=True)
+        canvas = RgbCanvas.open_or_create(canvas_path(job["job_id"]), width, height)
+        try:
+            offset_x, offset_y = slice_offset(task["instruction_data"], mandelbrot_info)
+            canvas.paste(image, offset_x, offset_y)
+        finally:
+            canvas.close()
+        return True
+    except Exception as e:
+        app.logger.error(f"Could not paste task {task['task_id']} into the canvas of job {job['job_id']}: {e}")
+        return False
+
+
+def finalize_composite(job: dict) -> Optional[str]:
+    """
+    Encodes the finished canvas of a job into GridFS and marks the job COMPLETED.
+    Returns the GridFS id of the composite as a string.
+    """
+    app = cast(ExtendedFlask, current_app)
+    job_id = job["job_id"]
+    mandelbrot_info = job["mandelbrot"]
+    path = canvas_path(job_id)
+
+    canvas = RgbCanvas(mandelbrot_info["resolution"]["width"], mandelbrot_info["resolution"]["height"], path=path)
+    fs = gridfs.GridFS(app.jobs_and_tasks_db.db)
+    digest = hashlib.sha256()
+    with fs.new_file(filename=f"{job_id}.png", contentType="image/png",
+                     metadata={"job_id": job_id, "kind": "composite"}) as grid_in:
+        for chunk in stream_png(canvas, app.config["COMPOSITE_BAND_HEIGHT"]):
+            digest.update(chunk)
+            grid_in.write(chunk)
+    composite_id = grid_in._id
+    fs_files = app.jobs_and_tasks_db.db.fs.files
+    fs_files.update_one({"_id": composite_id}, {"$set": {"metadata.sha256": digest.hexdigest()}})
+
+    app.jobs_and_tasks_db.update_many("active_jobs", {"job_id": job_id}, {"$set": {
+        "composite_id": str(composite_id),
+        "status": "COMPLETED",
+        "completed_at": {"$date": datetime.utcnow().isoformat() + "Z"},
+    }})
+    discard_canvas(job_id)
+    return str(composite_id)
+
+
+def record_completion(task: dict, image_data: Optional[bytes] = None):
+    """
+    Updates the job after one of its tasks completed, compositing incrementally and storing a
+    preview thumbnail if enabled. The slice is decoded once for both.
+
+    Args:
+        task: The completed task document returned by TaskStore.complete.
+        image_data: The encoded slice. Read back from GridFS through output_data.image_id if omitted.
+    """
+    record_completions([(task, image_data)])
+
+
+def record_completions(completed: List[Tuple[dict, Optional[bytes]]]):
+    """
+    record_completion for a batch of (task, image_data), counting the tasks of each job with a
+    single $inc. A slice that cannot be decoded is still counted; it just misses the canvas, so the
+    download falls back to reconstructing the image. The results are also added to the result cache.
+    """
+    app = cast(ExtendedFlask, current_app)
+    job_db = app.jobs_and_tasks_db
+    host = socket.gethostname().replace(".", "_")
+
+    try:
+        remember_results([task for task, _ in completed])
+    except Exception as e:
+        app.logger.error(f"Could not add {len(completed)} results to the result cache: {e}")
+
+    per_job = defaultdict(list)
+    for task, image_data in completed:
+        per_job[task["job_id"]].append((task, image_data))
+
+    for job_id, job_completed in per_job.items():
+        pasted = 0
+        job = None
+        if app.config["COMPOSITE_ON_SUBMIT"] or app.config["PREVIEWS_ENABLED"]:
+            job = job_db.get_one("active_jobs", {"job_id": job_id})
+        for task, image_data in (job_completed if job else []):
+            try:
+                if image_data is None:
+                    image_data = job_db.read_file_gridfs(task["output_data"]["image_id"])
+                with decode_image(image_data, job.get("palette")) as image:
+                    if app.config["COMPOSITE_ON_SUBMIT"] and paste_into_canvas(job, task, image):
+                        pasted += 1
+                    if app.config["PREVIEWS_ENABLED"]:
+                        try:
+                            store_thumbnail(job, task, image)
+                        except Exception as e:
+                            app.logger.error(f"Could not store the preview thumbnail of task {task['task_id']}: {e}")
+            except Exception as e:
+                app.logger.error(f"Could not decode the slice of task {task['task_id']}: {e}")
+
+        # Counting after the paste means whoever reaches num_tasks knows every counted slice is on the canvas
+        increments = {"num_completed": len(job_completed)}
+        if pasted:
+            increments[f"canvas_pastes.{host}"] = pasted
+        update = {"$inc": increments}
+        # Lazy jobs keep no per-task map, so they record which nodes' outboxes their tasks completed in
+        workers = sorted({task["assigned_to"] for task, _ in job_completed if task.get("lazy") and task["assigned_to"]})
+        if workers:
+            update["$addToSet"] = {"completed_by": {"$each": workers}}
+        job = job_db.claim_one("active_jobs", {"job_id": job_id}, update)
+        if not job:
+            continue
+
+        # Speculation only looks for stragglers in jobs flagged in_tail, through an index
+        if in_tail(job) != bool(job.get("in_tail")):
+            job_db.update_many("active_jobs", {"job_id": job_id}, {"$set": {"in_tail": in_tail(job)}})
+
+        if job["num_completed"] >= job["num_tasks"] and job.get("canvas_pastes", {}).get(host) == job["num_tasks"]:
+            try:
+                finalize_composite(job)
+            except Exception as e:
+                app.logger.error(f"Could not finalize the composite of job {job_id}: {e}")
+                discard_canvas(job_id)
+        elif job["num_completed"] >= job["num_tasks"]:
+            # Some slices are missing from this host's canvas, so the download reconstructs the image instead
+            discard_canvas(job_id)
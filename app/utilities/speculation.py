@@ -0,0 +1,262 @@
+import statistics
+from datetime import datetime, timedelta
+from typing import List, Optional, Set, Tuple, cast
+
+import gridfs
+from bson import ObjectId
+from flask import current_app
+from pymongo.errors import DuplicateKeyError
+
+from app.extended_flask import ExtendedFlask
+from app.utilities.metrics import increment_many, read_counters
+from app.utilities.node_stats import task_pixels
+from app.utilities.task_store import as_original, reset_task
+
+"""
+Speculative re-execution of straggler tasks.
+
+A job finishes only when its slowest slice arrives, so one slow or flaky node holding the last
+strip can double its wall time. Once a job is SPECULATION_MIN_PROGRESS complete, it is flagged
+in_tail (by app.utilities.results) and a task that has been RUNNING for SPECULATION_SLOWDOWN times
+the job's median task time (and at least SPECULATION_MIN_SECONDS) is a straggler. Stragglers are
+found by the reaper, or at most every SPECULATION_SCAN_SECONDS, and kept in app.stragglers. When a
+measured node runs out of work, it gets a copy of the oldest straggler it is expected to finish,
+from its seconds_per_megapixel, in less time than the straggler has already run.
+
+The copy is an ordinary inbox task with its own task_id and speculative_of set to the original's;
+the original is flagged speculated, so each task is copied at most once. A record in the
+'speculation' collection, unique per original task_id, arbitrates: the first of the two to
+complete sets its winner with a single find_one_and_update. The winner's result counts as the
+task's and the other copy is cancelled, so its node's upload is rejected like one for a requeued
+task. If both complete at once, the loser's completion is deleted again along with its file before
+anything is counted, so tasks_completed and num_completed never see it. A winning copy stands in
+for the original wherever completed tasks are read (TaskStore.completed_tasks).
+
+Copies launched, won by the copy (hits) or by the original, and the compute spent on the losing
+side are counters in app.utilities.metrics, reported by GET /metrics.
+"""
+
+SPECULATION_COLLECTION = "speculation"
+MAX_CANDIDATE_JOBS = 8
+
+
+def copy_task_id(task_id: str) -> str:
+    return f"{task_id}-speculative"
+
+
+def candidate_jobs() -> List[dict]:
+    """Jobs far enough along for speculation that are not finished yet (in_tail), highest priority first."""
+    app = cast(ExtendedFlask, current_app)
+    return app.jobs_and_tasks_db.find(
+        "active_jobs", {"in_tail": True}, limit=MAX_CANDIDATE_JOBS, sort=[("priority_level", 1), ("_id", 1)]
+    )
+
+
+def in_tail(job: dict) -> bool:
+    """Whether a job is SPECULATION_MIN_PROGRESS complete but not finished."""
+    app = cast(ExtendedFlask, current_app)
+    return job["num_tasks"] * app.config["SPECULATION_MIN_PROGRESS"] <= job["num_completed"] < job["num_tasks"]
+
+
+def median_task_seconds(job: dict) -> Optional[float]:
+    """Median claim-to-completion time of the job's completed tasks, or None if none was computed."""
+    app = cast(ExtendedFlask, current_app)
+    tasks_and_nodes = None if job.get("lazy") else job["tasks_and_nodes"]
+    durations = [
+        (task["completed_at"] - task["claimed_at"]).total_seconds()
+        for task in app.task_store.completed_tasks(job["job_id"], tasks_and_nodes, job.get("completed_by"))
+        if task.get("claimed_at") and isinstance(task.get("completed_at"), datetime)
+    ]
+    return statistics.median(durations) if durations else None
+
+
+def find_stragglers() -> List[dict]:
+    """RUNNING tasks of jobs in their tail that have run long enough to be copied, not copied yet."""
+    app = cast(ExtendedFlask, current_app)
+    now = datetime.utcnow()
+    stragglers = []
+    for job in candidate_jobs():
+        median = median_task_seconds(job)
+        if median is None:
+            continue
+        cutoff = now - timedelta(seconds=max(app.config["SPECULATION_MIN_SECONDS"],
+                                             app.config["SPECULATION_SLOWDOWN"] * median))
+        tasks_and_nodes = None if job.get("lazy") else job["tasks_and_nodes"]
+        stragglers.extend(app.task_store.in_flight_tasks(job["job_id"], tasks_and_nodes, {
+            "status": "RUNNING", "claimed_at": {"$lt": cutoff},
+            "speculated": {"$ne": True}, "speculative_of": None,
+        }))
+    return stragglers
+
+
+def refresh_stragglers():
+    """Rebuilds app.stragglers if it is older than SPECULATION_SCAN_SECONDS and no one else is at it."""
+    app = cast(ExtendedFlask, current_app)
+    if app.config["SPECULATION_ENABLED"] and app.stragglers.start_rebuild():
+        app.stragglers.rebuild(find_stragglers())
+
+
+def speculate(node_id: str) -> int:
+    """
+    Gives an idle node a copy of the oldest straggler task it is expected to finish in less time
+    than the task has already run. Returns how many tasks were added to its inbox (0 or 1).
+    """
+    app = cast(ExtendedFlask, current_app)
+    if not app.config["SPECULATION_ENABLED"] or app.node_load.depth(node_id) is None:
+        return 0
+    refresh_stragglers()
+    if not len(app.stragglers):
+        return 0
+    node = app.computing_nodes_db.get_one("all_nodes", {"node_id": node_id})
+    if not node or not node.get("seconds_per_megapixel"):
+        return 0  # a node that was never measured cannot be trusted to be fast
+
+    now = datetime.utcnow()
+    for task in app.stragglers.tasks():
+        if task["assigned_to"] == node_id:
+            continue
+        elapsed = (now - task["claimed_at"]).total_seconds()
+        if node["seconds_per_megapixel"] * task_pixels(task) / 1e6 >= elapsed:
+            continue
+        # Whether or not the copy is launched, the task is done with: copied, finished or copied elsewhere
+        if app.stragglers.discard(task["task_id"]) and launch_copy(task, node_id, now):
+            return 1
+    return 0
+
+
+def launch_copy(task: dict, node_id: str, now: datetime) -> bool:
+    """
+    Records the speculation, flags the original and puts its copy in node_id's inbox. Returns
+    False if the original finished or was copied by someone else in the meantime.
+    """
+    app = cast(ExtendedFlask, current_app)
+    job_db = app.jobs_and_tasks_db
+    original_id = task["task_id"]
+    record = {
+        "task_id": original_id,
+        "job_id": task["job_id"],
+        "original_node": task["assigned_to"],
+        "copy_task_id": copy_task_id(original_id),
+        "copy_node": node_id,
+        "launched_at": now,
+        "winner": None,
+    }
+    try:
+        job_db.add(SPECULATION_COLLECTION, record)
+    except DuplicateKeyError:
+        return False
+
+    flagged = app.task_store.claim(
+        task["assigned_to"], {"task_id": original_id, "status": "RUNNING", "speculated": {"$ne": True}},
+        {"$set": {"speculated": True}}
+    )
+    if not flagged:
+        job_db.delete_many(SPECULATION_COLLECTION, {"task_id": original_id, "winner": None})
+        return False
+
+    copy = reset_task({key: value for key, value in task.items() if key != "speculated"})
+    copy["task_id"] = record["copy_task_id"]
+    copy["speculative_of"] = original_id
+    copy["assigned_to"] = node_id
+    copy["status"] = "ASSIGNED"
+    copy["assigned_at"] = {"$date": now.isoformat() + "Z"}
+    copy["inboxed_at"] = now
+    app.task_store.add_to_inbox(node_id, [copy])
+    app.node_load.adjust(node_id, 1)
+    increment_many({"speculation.launched": 1})
+
+    # The original may have completed between the flag and the insert, then nobody cancels the copy
+    if job_db.get_one(SPECULATION_COLLECTION, {"task_id": original_id, "winner": {"$ne": None}}):
+        cancel(node_id, record["copy_task_id"], now)
+    return True
+
+
+def cancel(node_id: str, task_id: str, now: datetime) -> int:
+    """Cancels the losing side of a speculation in node_id's inbox. Returns the milliseconds it had run."""
+    app = cast(ExtendedFlask, current_app)
+    cancelled = app.task_store.cancel(node_id, {"task_id": task_id})
+    if not cancelled:
+        return 0
+    app.node_load.adjust(node_id, -len(cancelled))
+    return sum(
+        int((now - task["claimed_at"]).total_seconds() * 1000) for task in cancelled if task.get("claimed_at")
+    )
+
+
+def settle(node_id: str, tasks: List[dict]) -> Tuple[List[dict], Set[str]]:
+    """
+    Arbitrates freshly completed tasks of node_id that took part in a speculation. Must run right
+    after TaskStore.complete / complete_many and before anything is counted.
+
+    Returns:
+        (winners, lost): the tasks whose results count, winning copies relabelled with the
+        original's task_id, and the task_ids (as uploaded) of completions that lost. Lost
+        completions are already deleted from the outbox with their files, and their inbox slot is
+        released.
+    """
+    contested = [task for task in tasks if task.get("speculated") or task.get("speculative_of")]
+    if not contested:
+        return tasks, set()
+
+    lost = {task["task_id"] for task in contested if not arbitrate(node_id, task)}
+    return [as_original(task) for task in tasks if task["task_id"] not in lost], lost
+
+
+def arbitrate(node_id: str, task: dict) -> bool:
+    """Settles one completed task against its speculation record. Returns True if it won."""
+    app = cast(ExtendedFlask, current_app)
+    job_db = app.jobs_and_tasks_db
+    original_id = task.get("speculative_of") or task["task_id"]
+    now = datetime.utcnow()
+    record = job_db.claim_one(SPECULATION_COLLECTION, {"task_id": original_id, "winner": None}, {"$set": {
+        "winner": node_id, "winner_task_id": task["task_id"], "settled_at": now,
+    }})
+
+    if record:
+        if task.get("speculative_of"):
+            wasted = cancel(record["original_node"], original_id, now)
+            if not task.get("lazy"):
+                job_db.update_many("active_jobs", {"job_id": task["job_id"]},
+                                   {"$set": {f"tasks_and_nodes.{original_id}": node_id}})
+            # /client/task-result looks files up by metadata.task_id, which the node set to the copy's id
+            image_id = task.get("output_data", {}).get("image_id")
+            if image_id:
+                job_db.update_many("fs.files", {"_id": ObjectId(image_id)}, {"$set": {"metadata.task_id": original_id}})
+            counters = {"speculation.hits": 1}
+        else:
+            wasted = cancel(record["copy_node"], record["copy_task_id"], now)
+            counters = {"speculation.original_wins": 1}
+        increment_many({**counters, "speculation.wasted_tasks": 1 if wasted else 0, "speculation.wasted_ms": wasted})
+        return True
+
+    if not job_db.get_one(SPECULATION_COLLECTION, {"task_id": original_id}):
+        return True  # the launch was abandoned before the copy existed
+
+    # The other side won first: take this completion back before it is counted
+    app.task_store.discard_completed(node_id, {"task_id": task["task_id"]})
+    image_id = task.get("output_data", {}).get("image_id")
+    if image_id:
+        gridfs.GridFS(job_db.db).delete(ObjectId(image_id))
+    app.node_load.adjust(node_id, -1)
+    wasted = int((task["completed_at"] - task["claimed_at"]).total_seconds() * 1000) if task.get("claimed_at") else 0
+    increment_many({"speculation.wasted_tasks": 1, "speculation.wasted_ms": wasted})
+    return False
+
+
+def speculation_stats() -> dict:
+    """Configuration and counters of speculative execution, with the share of copies that won."""
+    app = cast(ExtendedFlask, current_app)
+    counters = read_counters("speculation.")
+    hits = counters.get("speculation.hits", 0)
+    original_wins = counters.get("speculation.original_wins", 0)
+    return {
+        "enabled": app.config["SPECULATION_ENABLED"],
+        "min_progress": app.config["SPECULATION_MIN_PROGRESS"],
+        "slowdown": app.config["SPECULATION_SLOWDOWN"],
+        "launched": counters.get("speculation.launched", 0),
+        "hits": hits,
+        "original_wins": original_wins,
+        "hit_rate": hits / (hits + original_wins) if hits + original_wins else None,
+        "wasted_tasks": counters.get("speculation.wasted_tasks", 0),
+        "wasted_seconds": counters.get("speculation.wasted_ms", 0) / 1000,
+    }
@@ -0,0 +1,59 @@
+import threading
+import time
+from typing import List, Optional
+
+
+class StragglerIndex:
+    """
+    In-memory list of straggler tasks that idle nodes may get a speculative copy of, oldest claim
+    first (see app.utilities.speculation).
+
+    Finding stragglers scans every job in its tail and that job's tasks in every inbox, so it is
+    done when the list is older than max_age_seconds, by the reaper or by the first idle poll after
+    that, instead of on every idle poll. A task leaves the list as soon as a copy of it is tried.
+    """
+    __slots__ = ['_lock', '_tasks', '_built_at', 'max_age_seconds']
+
+    def __init__(self, max_age_seconds: float = 15):
+        self._lock = threading.Lock()
+        self._tasks: List[dict] = []
+        self._built_at: Optional[float] = None
+        self.max_age_seconds = max_age_seconds
+
+    def is_stale(self) -> bool:
+        if self._built_at is None:
+            return True
+        return time.monotonic() - self._built_at > self.max_age_seconds
+
+    def start_rebuild(self) -> bool:
+        """True for exactly one caller while the list is stale, which must then call rebuild."""
+        with self._lock:
+            if not self.is_stale():
+                return False
+            self._built_at = time.monotonic()
+            return True
+
+    def rebuild(self, tasks: List[dict]):
+        with self._lock:
+            self._tasks = sorted(tasks, key=lambda task: task["claimed_at"])
+            self._built_at = time.monotonic()
+
+    def invalidate(self):
+        """Forces a rebuild on next use."""
+        self._built_at = None
+
+    def tasks(self) -> List[dict]:
+        with self._lock:
+            return list(self._tasks)
+
+    def discard(self, task_id: str) -> bool:
+        """Removes a task from the list. Returns False if another caller already took it."""
+        with self._lock:
+            for i, task in enumerate(self._tasks):
+                if task["task_id"] == task_id:
+                    del self._tasks[i]
+                    return True
+            return False
+
+    def __len__(self):
+        return len(self._tasks)
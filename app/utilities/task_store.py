@@ -0,0 +1,793 @@
+import secrets
+from abc import ABC, abstractmethod
+from collections import defaultdict
+from datetime import datetime
+from typing import Callable, Dict, List, Optional, Tuple
+
+from pymongo import ReplaceOne, UpdateOne
+from pymongo.change_stream import ChangeStream
+
+from app.utilities.database import DataBase
+from app.utilities.dispatch import (
+    DISPATCH_SORT, INBOX_DISPATCH_SORT, LOWEST_PRIORITY, PRIORITY_NAMES, QUEUED_STATUSES, aging_steps, normalize_priority
+)
+
+"""
+Where task documents live while they move through the system.
+
+Two layouts are supported, picked with the TASK_STORAGE config value:
+
+- "per-node" (PerNodeTaskStore): the original layout. Unassigned tasks sit in unassigned_tasks,
+  every node gets its own inbox_<node_id>, outbox_<node_id> and dump_<node_id> collections and a
+  task is moved between them by delete + insert.
+- "unified" (UnifiedTaskStore): one 'tasks' collection in the jobs_and_tasks database. A task never
+  moves, its 'status' and 'assigned_to' fields say which box it is in, and compound indexes make
+  per-node and per-job lookups single indexed queries.
+
+Moves that take several writes stamp the tasks with a token and the time (moving_at) first, and
+their copies stay out of reach until the originals are gone. A process that dies halfway leaves
+stamped tasks behind, which recover_moves finishes or rolls back once they are old enough.
+
+Routes and utilities only talk to the TaskStore interface, so they work the same on both layouts.
+"""
+
+INBOX_STATUSES = ["ASSIGNED", "RUNNING", "REQUEUING"]
+INBOX_LEASE_INDEX = [("status", 1), ("lease_expires_at", 1)]
+INBOX_DISPATCH_INDEX = [("status", 1)] + INBOX_DISPATCH_SORT
+# Tasks stamped by a move that spans several writes, found by the reaper if the move was interrupted
+MOVING_INDEX = [("moving_at", 1)]
+INBOX_INDEXES = [INBOX_LEASE_INDEX, INBOX_DISPATCH_INDEX, MOVING_INDEX]
+# Stolen tasks come off the back of an inbox, the ones its node would have run last
+INBOX_STEAL_SORT = [(key, -direction) for key, direction in INBOX_DISPATCH_SORT]
+
+
+def reset_task(task: dict) -> dict:
+    """Clears the assignment and claim fields of a task so it can be assigned again."""
+    task.pop("_id", None)
+    task.pop("reap_token", None)
+    task.pop("moving_at", None)
+    task["status"] = "AVAILABLE"
+    task["assigned_to"] = None
+    task["assigned_at"] = {"$date": None}
+    task["inboxed_at"] = None
+    task["claim_token"] = None
+    task["claimed_at"] = None
+    task["lease_expires_at"] = None
+    return task
+
+
+def as_original(task: dict) -> dict:
+    """A completed speculative copy stands in for the task it duplicated (see app/utilities/speculation.py)."""
+    if task.get("speculative_of"):
+        task["task_id"] = task["speculative_of"]
+    return task
+
+
+def merge_queries(base: dict, query: Optional[dict]) -> dict:
+    if not query:
+        return base
+    if not base:
+        return query
+    return {"$and": [base, query]}
+
+
+def backfill_priority_levels(db: DataBase, collection: str, query: dict, **fields) -> int:
+    """
+    Gives documents stored before priority levels existed the priority_level of their priority
+    string (low if it is unknown) and fields. A missing priority_level sorts ahead of level 0, so
+    they would otherwise jump every queue. Returns how many were updated.
+    """
+    query = merge_queries(query, {"priority_level": None})
+    if db.get_one(collection, query) is None:
+        return 0
+    updated = 0
+    for priority in db.distinct(collection, "priority", query):
+        try:
+            level = normalize_priority(priority)
+        except ValueError:
+            level = LOWEST_PRIORITY
+        updated += db.update_many(
+            collection, merge_queries(query, {"priority": priority}), {"$set": {"priority_level": level, **fields}}
+        )
+    # Documents without a priority at all
+    return updated + db.update_many(collection, query, {"$set": {"priority_level": LOWEST_PRIORITY, **fields}})
+
+
+class TaskStore(ABC):
+    """
+    Interface shared by both storage layouts. Queries passed to the inbox methods are plain task
+    filters (e.g. {"status": "ASSIGNED"}); each layout scopes them to the node itself.
+    """
+    __slots__ = ['jobs_db', 'nodes_db']
+
+    def __init__(self, jobs_db: DataBase, nodes_db: DataBase):
+        self.jobs_db = jobs_db
+        self.nodes_db = nodes_db
+
+    @abstractmethod
+    def inbox(self, node_id: str) -> Tuple[DataBase, str, dict]:
+        """Returns (database, collection, base filter) addressing a node's inbox."""
+
+    @abstractmethod
+    def outbox(self, node_id: str) -> Tuple[DataBase, str, dict]:
+        """Returns (database, collection, base filter) addressing a node's completed tasks."""
+
+    @abstractmethod
+    def ensure_indexes(self):
+        ...
+
+    @abstractmethod
+    def register_node(self, node_id: str):
+        ...
+
+    @abstractmethod
+    def add_to_inbox(self, node_id: str, tasks: List[dict]):
+        ...
+
+    @abstractmethod
+    def add_unassigned(self, tasks: List[dict]):
+        ...
+
+    @abstractmethod
+    def take_unassigned(self, limit: int, query: dict = None) -> List[dict]:
+        """
+        Atomically removes up to limit tasks from the unassigned pool, in dispatch order, and returns
+        them reset.
+        """
+
+    @abstractmethod
+    def complete(self, node_id: str, task_id: str, claim_token: str, output_data: dict) -> Optional[dict]:
+        """Moves a claimed task to the node's outbox as COMPLETED. Returns None if the claim does not match."""
+
+    @abstractmethod
+    def add_completed(self, node_id: str, tasks: List[dict]):
+        """Stores tasks that were never in an inbox (e.g. served from the result cache) in the node's outbox."""
+
+    @abstractmethod
+    def complete_many(self, node_id: str, results: List[Tuple[str, str, dict]]) -> List[dict]:
+        """
+        complete for a batch of (task_id, claim_token, output_data) with one bulk write. Returns the
+        tasks that were completed; results whose claim does not match are left alone.
+        """
+
+    @abstractmethod
+    def requeue(self, node_id: str, query: dict) -> int:
+        """Moves inbox tasks matching query back to the unassigned pool. Returns how many moved."""
+
+    @abstractmethod
+    def steal(self, from_node_id: str, to_node_id: str, limit: int) -> List[dict]:
+        """
+        Atomically moves up to limit unclaimed (ASSIGNED) tasks from the back of one node's inbox to
+        another's, leaving speculative copies alone. Returns the moved tasks.
+        """
+
+    @abstractmethod
+    def recover_moves(self, cutoff: datetime, node_ids: List[str]) -> int:
+        """
+        Finishes or rolls back moves stamped before cutoff that never completed, e.g. because their
+        process died, in the given nodes' boxes and the unassigned pool. Returns how many.
+        """
+
+    @abstractmethod
+    def nodes_with_expired_leases(self, now: datetime, available_node_ids: List[str]) -> List[str]:
+        ...
+
+    @abstractmethod
+    def inbox_depths(self, node_ids: List[str]) -> Dict[str, int]:
+        ...
+
+    @abstractmethod
+    def backfill_priorities(self, node_ids: List[str]) -> int:
+        """Backfills priority_level on queued tasks from before it existed, in the pool and the given nodes' inboxes."""
+
+    @abstractmethod
+    def age_priorities(self, now: datetime, aging_seconds: float, max_wait_seconds: float, node_ids: List[str]) -> int:
+        """
+        Promotes queued tasks that waited aging_seconds by one priority level, and tasks queued for
+        more than max_wait_seconds to high (see app/utilities/dispatch.py), in the pool and the given
+        nodes' inboxes. Returns how many.
+        """
+
+    @abstractmethod
+    def promote(self, query: dict, priority_level: int) -> int:
+        """Raises queued tasks matching query that are below priority_level to it. Returns how many."""
+
+    @abstractmethod
+    def in_flight_by_client(self, node_ids: List[str]) -> Dict[Optional[str], int]:
+        """Number of tasks per client_id sitting in the given nodes' inboxes."""
+
+    @abstractmethod
+    def pending_clients(self) -> List[Optional[str]]:
+        """client_ids with tasks in the unassigned pool. None stands for tasks without a client_id."""
+
+    @abstractmethod
+    def open_inbox_stream(self) -> Tuple[ChangeStream, Callable[[dict], Optional[str]]]:
+        """
+        Opens a Mongo change stream over task assignments (needs a replica set). Returns the stream
+        and a function giving the node_id a change assigned a task to, or None.
+        """
+
+    @abstractmethod
+    def completed_tasks(self, job_id: str, tasks_and_nodes: Optional[dict],
+                        completed_by: Optional[List[str]] = None) -> List[dict]:
+        """
+        Completed tasks of a job. tasks_and_nodes is None for lazy jobs, which keep no per-task map;
+        completed_by then lists the nodes that completed their tasks (every node if None, for lazy
+        jobs from before it was recorded). A speculative copy that won is returned under the task_id
+        of the task it duplicated.
+        """
+
+    @abstractmethod
+    def in_flight_tasks(self, job_id: str, tasks_and_nodes: Optional[dict], query: dict = None) -> List[dict]:
+        """Tasks of a job sitting in any inbox that match query."""
+
+    # Generic inbox and outbox helpers, built on inbox() and outbox()
+
+    def inbox_count(self, node_id: str, query: dict = None) -> int:
+        db, collection, base = self.inbox(node_id)
+        return db.num_items_query(collection, merge_queries(base, query))
+
+    def claim(self, node_id: str, query: dict, update: dict, sort: list = None) -> Optional[dict]:
+        db, collection, base = self.inbox(node_id)
+        return db.claim_one(collection, merge_queries(base, query), update, sort=sort)
+
+    def cancel(self, node_id: str, query: dict) -> List[dict]:
+        """
+        Deletes the inbox tasks matching query, whatever their status or claim, and returns them.
+        A later upload from the node is rejected like one for a requeued task.
+        """
+        db, collection, base = self.inbox(node_id)
+        cancel_token = secrets.token_hex(16)
+        if db.update_many(collection, merge_queries(base, query), {"$set": {"cancel_token": cancel_token}}) == 0:
+            return []
+        stamped = merge_queries(base, {"cancel_token": cancel_token})
+        tasks = db.find(collection, stamped)
+        db.delete_many(collection, stamped)
+        return tasks
+
+    def discard_completed(self, node_id: str, query: dict) -> int:
+        """Deletes completed tasks of the node matching query. Returns how many were deleted."""
+        db, collection, base = self.outbox(node_id)
+        return db.delete_many(collection, merge_queries(base, query))
+
+    def claim_batch(self, node_id: str, query: dict, update: dict, limit: int, sort: list = None) -> List[dict]:
+        """
+        Claims up to limit inbox tasks matching query and returns the ones this call won, in sort order.
+
+        The batch is not claimed atomically: candidates are read first and each is then claimed by its
+        own update, still filtered on query, in one bulk write. A task a concurrent call claimed in
+        between no longer matches and is left out, so no task is handed out twice. Every task gets its
+        own claim_token in place of the one update $sets, and the tokens tell which candidates were won.
+        """
+        db, collection, base = self.inbox(node_id)
+        scoped = merge_queries(base, query)
+        candidates = db.find(collection, scoped, limit=limit, sort=sort)
+        if not candidates:
+            return []
+        tokens = {task["task_id"]: secrets.token_hex(16) for task in candidates}
+        db.bulk_write(collection, [
+            UpdateOne(merge_queries(scoped, {"task_id": task_id}),
+                      {**update, "$set": {**update["$set"], "claim_token": token}})
+            for task_id, token in tokens.items()
+        ])
+        tasks = db.find(collection, merge_queries(base, {"claim_token": {"$in": list(tokens.values())}}), sort=sort)
+        for task in tasks:
+            task["_id"] = str(task["_id"])
+        return tasks
+
+
+class PerNodeTaskStore(TaskStore):
+    __slots__ = ['_indexed_inboxes']
+
+    def __init__(self, jobs_db: DataBase, nodes_db: DataBase):
+        super().__init__(jobs_db, nodes_db)
+        self._indexed_inboxes = set()
+
+    def inbox(self, node_id: str) -> Tuple[DataBase, str, dict]:
+        return self.nodes_db, f"inbox_{node_id}", {}
+
+    def _index_inbox(self, node_id: str):
+        """register_node creates a node's inbox indexes; this covers inboxes from before they existed, once per process."""
+        if node_id not in self._indexed_inboxes:
+            self._indexed_inboxes.add(node_id)
+            self.nodes_db.ensure_indexes(f"inbox_{node_id}", INBOX_INDEXES)
+
+    def outbox(self, node_id: str) -> Tuple[DataBase, str, dict]:
+        return self.nodes_db, f"outbox_{node_id}", {}
+
+    def ensure_indexes(self):
+        self.jobs_db.ensure_indexes(
+            "unassigned_tasks", [[("reap_token", 1)], [("client_id", 1)] + DISPATCH_SORT, MOVING_INDEX]
+        )
+        # Inbox indexes are created per node, by register_node or when tasks are first added (see _index_inbox)
+
+    def register_node(self, node_id: str):
+        #Keed in mind, Inbox and Outbox are from the perspective of the node.
+        self.nodes_db.create_collection(f"dump_{node_id}")
+        self.nodes_db.create_collection(f"inbox_{node_id}")
+        self.nodes_db.create_collection(f"outbox_{node_id}")
+        self.nodes_db.ensure_indexes(f"inbox_{node_id}", INBOX_INDEXES)
+        self._indexed_inboxes.add(node_id)
+
+    def add_to_inbox(self, node_id: str, tasks: List[dict]):
+        self._index_inbox(node_id)
+        self.nodes_db.add_many(f"inbox_{node_id}", tasks)
+
+    def add_unassigned(self, tasks: List[dict]):
+        self.jobs_db.add_many("unassigned_tasks", tasks)
+
+    def take_unassigned(self, limit: int, query: dict = None) -> List[dict]:
+        candidates = self.jobs_db.find(
+            "unassigned_tasks", merge_queries({"reap_token": None}, query), limit=limit, sort=DISPATCH_SORT
+        )
+        if not candidates:
+            return []
+
+        batch_token = secrets.token_hex(16)
+        self.jobs_db.update_many(
+            "unassigned_tasks",
+            {"task_id": {"$in": [task["task_id"] for task in candidates]}, "reap_token": None},
+            {"$set": {"reap_token": batch_token, "moving_at": datetime.utcnow()}}
+        )
+        tasks = self.jobs_db.find("unassigned_tasks", {"reap_token": batch_token})
+        self.jobs_db.delete_many("unassigned_tasks", {"reap_token": batch_token})
+        return [reset_task(task) for task in tasks]
+
+    def complete(self, node_id: str, task_id: str, claim_token: str, output_data: dict) -> Optional[dict]:
+        task = self.nodes_db.take_one(f"inbox_{node_id}", {"task_id": task_id, "claim_token": claim_token})
+        if not task:
+            return None
+
+        task['completed_at'] = datetime.utcnow()
+        task['output_data'] = task.get('output_data', {})
+        task['output_data'].update(output_data)
+        task['status'] = "COMPLETED"
+        self.nodes_db.add(f"outbox_{node_id}", task)
+        return task
+
+    def add_completed(self, node_id: str, tasks: List[dict]):
+        self.nodes_db.add_many(f"outbox_{node_id}", tasks)
+
+    def complete_many(self, node_id: str, results: List[Tuple[str, str, dict]]) -> List[dict]:
+        # Stamp the matching tasks first, then move everything stamped in one delete + insert
+        inbox_collection = f"inbox_{node_id}"
+        complete_token = secrets.token_hex(16)
+        self.nodes_db.bulk_write(inbox_collection, [
+            UpdateOne({"task_id": task_id, "claim_token": claim_token}, {"$set": {
+                "complete_token": complete_token,
+                "moving_at": datetime.utcnow(),
+                **{f"output_data.{key}": value for key, value in output_data.items()},
+            }})
+            for task_id, claim_token, output_data in results
+        ])
+        tasks = self.nodes_db.find(inbox_collection, {"complete_token": complete_token})
+        if not tasks:
+            return []
+
+        # The outbox copies keep the complete_token, so an interrupted move can be rolled back (see recover_moves)
+        now = datetime.utcnow()
+        for task in tasks:
+            task.pop("_id", None)
+            task.pop("moving_at", None)
+            task['completed_at'] = now
+            task['status'] = "COMPLETED"
+        self.nodes_db.add_many(f"outbox_{node_id}", tasks)
+        self.nodes_db.delete_many(inbox_collection, {"complete_token": complete_token})
+        return tasks
+
+    def requeue(self, node_id: str, query: dict) -> int:
+        reap_token = secrets.token_hex(16)
+
+        # Stamping the claim_token makes any late upload from the old holder fail with a 409.
+        stamped = self.nodes_db.update_many(f"inbox_{node_id}", query, {"$set": {
+            "status": "REQUEUING", "reap_token": reap_token, "claim_token": reap_token, "moving_at": datetime.utcnow(),
+        }})
+        if stamped == 0:
+            return 0
+        return self._finish_requeue(node_id, reap_token)
+
+    def _finish_requeue(self, node_id: str, reap_token: str, resume: bool = False) -> int:
+        """
+        Moves the inbox tasks stamped with reap_token to unassigned_tasks. The copies stay reserved
+        by the token until the originals are deleted, so the move can be run again from any point
+        (resume skips copies that are already there). Returns how many tasks moved.
+        """
+        inbox_collection = f"inbox_{node_id}"
+        tasks = self.nodes_db.find(inbox_collection, {"reap_token": reap_token})
+        copied = set()
+        if resume:
+            copied = {task["task_id"] for task in self.jobs_db.find("unassigned_tasks", {"reap_token": reap_token})}
+        moving_at = datetime.utcnow()
+        self.jobs_db.add_many("unassigned_tasks", [
+            {**reset_task(task), "reap_token": reap_token, "moving_at": moving_at}
+            for task in tasks if task["task_id"] not in copied
+        ])
+        self.nodes_db.delete_many(inbox_collection, {"reap_token": reap_token})
+        self.jobs_db.update_many(
+            "unassigned_tasks", {"reap_token": reap_token}, {"$set": {"reap_token": None}, "$unset": {"moving_at": ""}}
+        )
+        return len(tasks)
+
+    def steal(self, from_node_id: str, to_node_id: str, limit: int) -> List[dict]:
+        inbox_collection = f"inbox_{from_node_id}"
+        candidates = self.nodes_db.find(
+            inbox_collection, {"status": "ASSIGNED", "speculative_of": None}, limit=limit, sort=INBOX_STEAL_SORT
+        )
+        if not candidates:
+            return []
+
+        # STEALING takes the tasks out of the node's reach before they are copied, so it cannot claim them meanwhile
+        steal_token = secrets.token_hex(16)
+        stamped = self.nodes_db.update_many(
+            inbox_collection,
+            {"task_id": {"$in": [task["task_id"] for task in candidates]}, "status": "ASSIGNED"},
+            {"$set": {
+                "status": "STEALING", "steal_token": steal_token,
+                "steal_from": from_node_id, "steal_to": to_node_id, "moving_at": datetime.utcnow(),
+            }}
+        )
+        if stamped == 0:
+            return []
+        return self._finish_steal(from_node_id, to_node_id, steal_token)
+
+    def _finish_steal(self, from_node_id: str, to_node_id: str, steal_token: str, resume: bool = False) -> List[dict]:
+        """
+        Moves the tasks stamped with steal_token between the two inboxes. The copies stay STEALING,
+        out of the thief's reach, until the originals are deleted, so the move can be run again
+        from any point (resume skips copies that are already there). Returns the moved tasks.
+        """
+        source, target = f"inbox_{from_node_id}", f"inbox_{to_node_id}"
+        self._index_inbox(to_node_id)
+        tasks = self.nodes_db.find(source, {"steal_token": steal_token})
+        copied = set()
+        if resume:
+            copied = {task["task_id"] for task in self.nodes_db.find(target, {"steal_token": steal_token})}
+        assigned_at = {"$date": datetime.utcnow().isoformat() + "Z"}
+        for task in tasks:
+            task.pop("_id", None)
+            task["assigned_to"] = to_node_id
+            task["assigned_at"] = assigned_at
+        self.nodes_db.add_many(target, [task for task in tasks if task["task_id"] not in copied])
+        self.nodes_db.delete_many(source, {"steal_token": steal_token})
+
+        moved = {"steal_token": "", "steal_from": "", "steal_to": "", "moving_at": ""}
+        self.nodes_db.update_many(target, {"steal_token": steal_token}, {"$set": {"status": "ASSIGNED"}, "$unset": moved})
+        for task in tasks:
+            task["status"] = "ASSIGNED"
+            for field in moved:
+                task.pop(field, None)
+        return tasks
+
+    def _roll_back_completion(self, node_id: str, complete_token: str):
+        """Undoes a complete_many that copied tasks to the outbox but never deleted them from the inbox."""
+        self.nodes_db.delete_many(f"outbox_{node_id}", {"complete_token": complete_token})
+        self.nodes_db.update_many(
+            f"inbox_{node_id}", {"complete_token": complete_token},
+            {"$unset": {"complete_token": "", "moving_at": ""}}
+        )
+
+    def recover_moves(self, cutoff: datetime, node_ids: List[str]) -> int:
+        recovered = set()
+        for node_id in node_ids:
+            for task in self.nodes_db.find(f"inbox_{node_id}", {"moving_at": {"$lt": cutoff}}):
+                if task.get("reap_token") and task["reap_token"] not in recovered:
+                    recovered.add(task["reap_token"])
+                    self._finish_requeue(node_id, task["reap_token"], resume=True)
+                elif task.get("steal_token") and task["steal_token"] not in recovered:
+                    # Seen from the victim's inbox, or from the thief's if the originals are already gone
+                    recovered.add(task["steal_token"])
+                    self._finish_steal(task["steal_from"], task["steal_to"], task["steal_token"], resume=True)
+                elif task.get("complete_token") and task["complete_token"] not in recovered:
+                    # Nothing was counted yet, so the task just goes back to RUNNING and its lease runs out
+                    recovered.add(task["complete_token"])
+                    self._roll_back_completion(node_id, task["complete_token"])
+
+        # Left over: batches take_unassigned reserved but never deleted, and requeue copies whose originals are gone
+        released = self.jobs_db.update_many(
+            "unassigned_tasks", {"reap_token": {"$ne": None}, "moving_at": {"$lt": cutoff}},
+            {"$set": {"reap_token": None}, "$unset": {"moving_at": ""}}
+        )
+        return len(recovered) + released
+
+    def nodes_with_expired_leases(self, now: datetime, available_node_ids: List[str]) -> List[str]:
+        # Every inbox is its own collection, so each one has to be checked (through its lease index)
+        return [
+            node_id for node_id in available_node_ids
+            if self.nodes_db.get_one(f"inbox_{node_id}", {"status": "RUNNING", "lease_expires_at": {"$lt": now}})
+        ]
+
+    def inbox_depths(self, node_ids: List[str]) -> Dict[str, int]:
+        return {node_id: self.nodes_db.collection_size(f"inbox_{node_id}") for node_id in node_ids}
+
+    def backfill_priorities(self, node_ids: List[str]) -> int:
+        now = datetime.utcnow()
+        backfilled = backfill_priority_levels(self.jobs_db, "unassigned_tasks", {}, aged_at=now)
+        for node_id in node_ids:
+            backfilled += backfill_priority_levels(self.nodes_db, f"inbox_{node_id}", {}, aged_at=now)
+        return backfilled
+
+    def age_priorities(self, now: datetime, aging_seconds: float, max_wait_seconds: float, node_ids: List[str]) -> int:
+        aged = 0
+        for query, update in aging_steps(now, aging_seconds, max_wait_seconds):
+            aged += self.jobs_db.update_many("unassigned_tasks", query, update)
+            for node_id in node_ids:
+                aged += self.nodes_db.update_many(f"inbox_{node_id}", query, update)
+        return aged
+
+    def promote(self, query: dict, priority_level: int) -> int:
+        # Only the pool: inboxes are shallow, and finding a task in one means scanning every node's collection
+        return self.jobs_db.update_many(
+            "unassigned_tasks", merge_queries({"priority_level": {"$gt": priority_level}}, query),
+            {"$set": {"priority_level": priority_level, "priority": PRIORITY_NAMES[priority_level]}}
+        )
+
+    def in_flight_by_client(self, node_ids: List[str]) -> Dict[Optional[str], int]:
+        counts = defaultdict(int)
+        for node_id in node_ids:
+            for row in self.nodes_db.aggregate(f"inbox_{node_id}", [
+                {"$group": {"_id": "$client_id", "count": {"$sum": 1}}},
+            ]):
+                counts[row["_id"]] += row["count"]
+        return dict(counts)
+
+    def pending_clients(self) -> List[Optional[str]]:
+        clients = self.jobs_db.distinct("unassigned_tasks", "client_id", {"reap_token": None})
+        if None not in clients and self.jobs_db.get_one("unassigned_tasks", {"reap_token": None, "client_id": None}):
+            clients.append(None)
+        return clients
+
+    def open_inbox_stream(self) -> Tuple[ChangeStream, Callable[[dict], Optional[str]]]:
+        # Every insert into an inbox_<node_id> collection is an assignment
+        stream = self.nodes_db.db.watch([
+            {"$match": {"operationType": "insert", "ns.coll": {"$regex": "^inbox_"}}},
+            {"$project": {"ns": 1}},
+        ])
+        return stream, lambda change: change["ns"]["coll"][len("inbox_"):]
+
+    def completed_tasks(self, job_id: str, tasks_and_nodes: Optional[dict],
+                        completed_by: Optional[List[str]] = None) -> List[dict]:
+        if tasks_and_nodes is None:
+            if completed_by is None:
+                completed_by = self.nodes_db.distinct("all_nodes", "node_id", {})
+            return [
+                as_original(task)
+                for node_id in completed_by
+                for task in self.nodes_db.find(f"outbox_{node_id}", {"job_id": job_id})
+            ]
+
+        # One query per node that worked on the job, rather than one per task
+        task_ids_per_node = defaultdict(list)
+        for task_id, node_id in tasks_and_nodes.items():
+            if node_id is not None:
+                task_ids_per_node[node_id].append(task_id)
+
+        completed = []
+        for node_id, task_ids in task_ids_per_node.items():
+            completed.extend(as_original(task) for task in self.nodes_db.find(f"outbox_{node_id}", {
+                "job_id": job_id, "$or": [{"task_id": {"$in": task_ids}}, {"speculative_of": {"$in": task_ids}}]
+            }))
+        return completed
+
+    def in_flight_tasks(self, job_id: str, tasks_and_nodes: Optional[dict], query: dict = None) -> List[dict]:
+        if tasks_and_nodes is None:
+            node_ids = [node["node_id"] for node in self.nodes_db.find("all_nodes", {"available": True})]
+        else:
+            node_ids = {node_id for node_id in tasks_and_nodes.values() if node_id is not None}
+        return [
+            task
+            for node_id in node_ids
+            for task in self.nodes_db.find(f"inbox_{node_id}", merge_queries({"job_id": job_id}, query))
+        ]
+
+
+class UnifiedTaskStore(TaskStore):
+    __slots__ = []
+
+    COLLECTION = "tasks"
+    INDEXES = [
+        [("assigned_to", 1), ("status", 1)] + INBOX_DISPATCH_SORT,
+        [("status", 1)] + DISPATCH_SORT,
+        [("status", 1), ("client_id", 1)] + DISPATCH_SORT,
+        [("job_id", 1), ("status", 1)],
+        [("status", 1), ("lease_expires_at", 1)],
+        [("reap_token", 1)],
+        MOVING_INDEX,
+    ]
+    # _upsert and the migration's upserts match on task_id, so it must identify a single document
+    TASK_ID_INDEX = [("task_id", 1)]
+
+    def inbox(self, node_id: str) -> Tuple[DataBase, str, dict]:
+        return self.jobs_db, self.COLLECTION, {"assigned_to": node_id, "status": {"$in": INBOX_STATUSES}}
+
+    def outbox(self, node_id: str) -> Tuple[DataBase, str, dict]:
+        return self.jobs_db, self.COLLECTION, {"assigned_to": node_id, "status": "COMPLETED"}
+
+    def ensure_indexes(self):
+        self.create_indexes(self.jobs_db)
+
+    @classmethod
+    def create_indexes(cls, jobs_db: DataBase):
+        """Creates the tasks collection's indexes, replacing a non-unique task_id index left by older versions."""
+        jobs_db.ensure_indexes(cls.COLLECTION, cls.INDEXES)
+        existing = jobs_db.db[cls.COLLECTION].index_information().get("task_id_1")
+        if existing is not None and not existing.get("unique"):
+            jobs_db.db[cls.COLLECTION].drop_index("task_id_1")
+        jobs_db.create_index(cls.COLLECTION, cls.TASK_ID_INDEX, unique=True)
+
+    def register_node(self, node_id: str):
+        pass
+
+    def _upsert(self, tasks: List[dict]):
+        self.jobs_db.bulk_write(self.COLLECTION, [
+            ReplaceOne({"task_id": task["task_id"]}, task, upsert=True) for task in tasks
+        ])
+
+    def add_to_inbox(self, node_id: str, tasks: List[dict]):
+        self._upsert(tasks)
+
+    def add_unassigned(self, tasks: List[dict]):
+        self._upsert(tasks)
+
+    def add_completed(self, node_id: str, tasks: List[dict]):
+        self._upsert(tasks)
+
+    def take_unassigned(self, limit: int, query: dict = None) -> List[dict]:
+        pool = {"status": "AVAILABLE", "reap_token": None}
+        candidates = self.jobs_db.find(self.COLLECTION, merge_queries(pool, query), limit=limit, sort=DISPATCH_SORT)
+        if not candidates:
+            return []
+
+        # The tasks stay in place; the token only reserves them until add_to_inbox overwrites them
+        batch_token = secrets.token_hex(16)
+        self.jobs_db.update_many(
+            self.COLLECTION,
+            {"task_id": {"$in": [task["task_id"] for task in candidates]}, **pool},
+            {"$set": {"reap_token": batch_token, "moving_at": datetime.utcnow()}}
+        )
+        tasks = self.jobs_db.find(self.COLLECTION, {"reap_token": batch_token})
+        return [reset_task(task) for task in tasks]
+
+    def complete(self, node_id: str, task_id: str, claim_token: str, output_data: dict) -> Optional[dict]:
+        update = {"status": "COMPLETED", "completed_at": datetime.utcnow()}
+        update.update({f"output_data.{key}": value for key, value in output_data.items()})
+        return self.jobs_db.claim_one(
+            self.COLLECTION,
+            {"task_id": task_id, "assigned_to": node_id, "claim_token": claim_token, "status": "RUNNING"},
+            {"$set": update}
+        )
+
+    def complete_many(self, node_id: str, results: List[Tuple[str, str, dict]]) -> List[dict]:
+        now = datetime.utcnow()
+        complete_token = secrets.token_hex(16)
+        self.jobs_db.bulk_write(self.COLLECTION, [
+            UpdateOne(
+                {"task_id": task_id, "assigned_to": node_id, "claim_token": claim_token, "status": "RUNNING"},
+                {"$set": {
+                    "status": "COMPLETED",
+                    "completed_at": now,
+                    "complete_token": complete_token,
+                    **{f"output_data.{key}": value for key, value in output_data.items()},
+                }}
+            )
+            for task_id, claim_token, output_data in results
+        ])
+        tasks = self.jobs_db.find(self.COLLECTION, {
+            "task_id": {"$in": [task_id for task_id, _, _ in results]},
+            "complete_token": complete_token,
+        })
+        for task in tasks:
+            task["_id"] = str(task["_id"])
+        return tasks
+
+    def requeue(self, node_id: str, query: dict) -> int:
+        _, _, base = self.inbox(node_id)
+        # A single update moves the tasks back; clearing the claim_token rejects late uploads.
+        return self.jobs_db.update_many(self.COLLECTION, merge_queries(base, query), {"$set": reset_task({})})
+
+    def steal(self, from_node_id: str, to_node_id: str, limit: int) -> List[dict]:
+        unclaimed = {"assigned_to": from_node_id, "status": "ASSIGNED"}
+        candidates = self.jobs_db.find(
+            self.COLLECTION, {**unclaimed, "speculative_of": None}, limit=limit, sort=INBOX_STEAL_SORT
+        )
+        if not candidates:
+            return []
+
+        # One update reassigns them; a task the node claimed in between no longer matches
+        steal_token = secrets.token_hex(16)
+        self.jobs_db.update_many(
+            self.COLLECTION, {"task_id": {"$in": [task["task_id"] for task in candidates]}, **unclaimed},
+            {"$set": {
+                "assigned_to": to_node_id,
+                "assigned_at": {"$date": datetime.utcnow().isoformat() + "Z"},
+                "steal_token": steal_token,
+            }}
+        )
+        tasks = self.jobs_db.find(self.COLLECTION, {
+            "task_id": {"$in": [task["task_id"] for task in candidates]}, "steal_token": steal_token
+        })
+        for task in tasks:
+            task["_id"] = str(task["_id"])
+        return tasks
+
+    def recover_moves(self, cutoff: datetime, node_ids: List[str]) -> int:
+        # Every other move is a single update; only reservations of take_unassigned can be left behind
+        return self.jobs_db.update_many(
+            self.COLLECTION, {"status": "AVAILABLE", "reap_token": {"$ne": None}, "moving_at": {"$lt": cutoff}},
+            {"$set": {"reap_token": None}, "$unset": {"moving_at": ""}}
+        )
+
+    def nodes_with_expired_leases(self, now: datetime, available_node_ids: List[str]) -> List[str]:
+        return self.jobs_db.distinct(
+            self.COLLECTION, "assigned_to", {"status": "RUNNING", "lease_expires_at": {"$lt": now}}
+        )
+
+    def inbox_depths(self, node_ids: List[str]) -> Dict[str, int]:
+        depths = {node_id: 0 for node_id in node_ids}
+        for row in self.jobs_db.aggregate(self.COLLECTION, [
+            {"$match": {"assigned_to": {"$in": node_ids}, "status": {"$in": INBOX_STATUSES}}},
+            {"$group": {"_id": "$assigned_to", "count": {"$sum": 1}}},
+        ]):
+            depths[row["_id"]] = row["count"]
+        return depths
+
+    def backfill_priorities(self, node_ids: List[str]) -> int:
+        return backfill_priority_levels(
+            self.jobs_db, self.COLLECTION, {"status": {"$in": QUEUED_STATUSES}}, aged_at=datetime.utcnow()
+        )
+
+    def age_priorities(self, now: datetime, aging_seconds: float, max_wait_seconds: float, node_ids: List[str]) -> int:
+        return sum(
+            self.jobs_db.update_many(self.COLLECTION, query, update)
+            for query, update in aging_steps(now, aging_seconds, max_wait_seconds)
+        )
+
+    def promote(self, query: dict, priority_level: int) -> int:
+        return self.jobs_db.update_many(
+            self.COLLECTION,
+            merge_queries({"status": {"$in": QUEUED_STATUSES}, "priority_level": {"$gt": priority_level}}, query),
+            {"$set": {"priority_level": priority_level, "priority": PRIORITY_NAMES[priority_level]}}
+        )
+
+    def in_flight_by_client(self, node_ids: List[str]) -> Dict[Optional[str], int]:
+        return {
+            row["_id"]: row["count"]
+            for row in self.jobs_db.aggregate(self.COLLECTION, [
+                {"$match": {"assigned_to": {"$in": node_ids}, "status": {"$in": INBOX_STATUSES}}},
+                {"$group": {"_id": "$client_id", "count": {"$sum": 1}}},
+            ])
+        }
+
+    def pending_clients(self) -> List[Optional[str]]:
+        pool = {"status": "AVAILABLE", "reap_token": None}
+        clients = self.jobs_db.distinct(self.COLLECTION, "client_id", pool)
+        if None not in clients and self.jobs_db.get_one(self.COLLECTION, {**pool, "client_id": None}):
+            clients.append(None)
+        return clients
+
+    def open_inbox_stream(self) -> Tuple[ChangeStream, Callable[[dict], Optional[str]]]:
+        stream = self.jobs_db.db[self.COLLECTION].watch([
+            {"$match": {"operationType": {"$in": ["insert", "replace"]}, "fullDocument.status": "ASSIGNED"}},
+            {"$project": {"fullDocument.assigned_to": 1}},
+        ])
+        return stream, lambda change: change["fullDocument"].get("assigned_to")
+
+    def completed_tasks(self, job_id: str, tasks_and_nodes: Optional[dict],
+                        completed_by: Optional[List[str]] = None) -> List[dict]:
+        return [as_original(task) for task in self.jobs_db.find(self.COLLECTION, {"job_id": job_id, "status": "COMPLETED"})]
+
+    def in_flight_tasks(self, job_id: str, tasks_and_nodes: Optional[dict], query: dict = None) -> List[dict]:
+        return self.jobs_db.find(
+            self.COLLECTION, merge_queries({"job_id": job_id, "status": {"$in": INBOX_STATUSES}}, query)
+        )
+
+
+TASK_STORES = {
+    "per-node": PerNodeTaskStore,
+    "unified": UnifiedTaskStore,
+}
+
+
+def create_task_store(storage: str, jobs_db: DataBase, nodes_db: DataBase) -> TaskStore:
+    if storage not in TASK_STORES:
+        raise ValueError(f"Unknown TASK_STORAGE '{storage}', expected one of {sorted(TASK_STORES)}")
+    return TASK_STORES[storage](jobs_db, nodes_db)
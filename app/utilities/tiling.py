@@ -0,0 +1,170 @@
+import math
+from typing import List, Tuple
+
+import numpy as np
+
+"""
+Cost-aware partitioning of a Mandelbrot job into 2D tiles.
+
+Escape-time cost is very uneven: a strip through the set's interior runs every pixel to the
+iteration limit, while a strip of the exterior escapes after a few iterations. Splitting the image
+into equal strips therefore leaves one straggler that sets the job's wall time.
+
+balanced_tiles samples a coarse escape-time grid with NumPy and recursively cuts the image, always
+across its longer side, at the column or row that divides the estimated cost in proportion to the
+number of tiles each side will get. The result is num_tasks pixel-aligned tiles of roughly equal
+estimated work.
+
+grid_tile is the cost-blind alternative for very large fan-out: near-square tiles in horizontal
+bands, each computable from its index alone.
+
+Tiles use the convention that pixel row 0 maps to y_min, matching the way each strip's rows are
+laid out from its own y_min.
+"""
+
+SAMPLE_GRID_WIDTH = 96
+SAMPLE_MAX_ITER = 256
+
+Rect = Tuple[int, int, int, int]  # (pixel_x0, pixel_y0, pixel_x1, pixel_y1), end exclusive
+
+
+def escape_time_grid(x_min: float, x_max: float, y_min: float, y_max: float,
+                     width: int, height: int, max_iter: int) -> np.ndarray:
+    """
+    Vectorized escape-time iteration counts at the centre of each cell of a width x height grid.
+    Returns a (height, width) uint32 array; points that never escape get max_iter.
+    """
+    xs = x_min + (np.arange(width) + 0.5) * (x_max - x_min) / width
+    ys = y_min + (np.arange(height) + 0.5) * (y_max - y_min) / height
+    c = xs[np.newaxis, :] + 1j * ys[:, np.newaxis]
+    z = np.zeros_like(c)
+    counts = np.full(c.shape, max_iter, dtype=np.uint32)
+    active = np.ones(c.shape, dtype=bool)
+    for i in range(max_iter):
+        z[active] = z[active] * z[active] + c[active]
+        escaped = active & (z.real * z.real + z.imag * z.imag > 4.0)
+        counts[escaped] = i + 1
+        active &= ~escaped
+        if not active.any():
+            break
+    return counts
+
+
+def estimate_cost_grid(x_min: float, x_max: float, y_min: float, y_max: float,
+                       width: int, height: int) -> np.ndarray:
+    """Coarse per-cell cost estimate for a width x height pixel image (iterations, at least 1 per cell)."""
+    grid_width = min(width, SAMPLE_GRID_WIDTH)
+    grid_height = max(1, min(height, round(grid_width * height / width)))
+    counts = escape_time_grid(x_min, x_max, y_min, y_max, grid_width, grid_height, SAMPLE_MAX_ITER)
+    return np.maximum(counts, 1).astype(np.float64)
+
+
+def _profile(cost: np.ndarray, rect: Rect, width: int, height: int, axis: int) -> np.ndarray:
+    """Estimated cost of every pixel column (axis=0) or row (axis=1) of rect."""
+    grid_height, grid_width = cost.shape
+    x0, y0, x1, y1 = rect
+    cols = (np.arange(x0, x1) * grid_width) // width
+    rows = (np.arange(y0, y1) * grid_height) // height
+    if axis == 0:
+        row_weights = np.bincount(rows, minlength=grid_height)
+        return (row_weights @ cost)[cols]
+    col_weights = np.bincount(cols, minlength=grid_width)
+    return (cost @ col_weights)[rows]
+
+
+def balanced_tiles(width: int, height: int, num_tasks: int, cost: np.ndarray) -> List[Rect]:
+    """
+    Recursively splits the width x height image into num_tasks tiles of roughly equal estimated cost.
+
+    Args:
+        width: Image width in pixels.
+        height: Image height in pixels.
+        num_tasks: Number of tiles; at most width * height.
+        cost: Cost grid from estimate_cost_grid, covering the whole image.
+
+    Returns:
+        List[Rect]: Pixel rectangles (x0, y0, x1, y1) that exactly cover the image.
+    """
+    tiles = []
+    stack = [((0, 0, width, height), num_tasks)]
+    while stack:
+        rect, count = stack.pop()
+        x0, y0, x1, y1 = rect
+        rect_width, rect_height = x1 - x0, y1 - y0
+        if count == 1:
+            tiles.append(rect)
+            continue
+
+        # Cut across the longer side (a rect holding two or more tiles is at least 2 pixels on one side)
+        axis = 0 if rect_width >= rect_height else 1
+        length, breadth = (rect_width, rect_height) if axis == 0 else (rect_height, rect_width)
+        if length < 2:
+            axis = 1 - axis
+            length, breadth = breadth, length
+
+        left_count = count // 2
+        cumulative = np.cumsum(_profile(cost, rect, width, height, axis))
+        split = int(np.searchsorted(cumulative, cumulative[-1] * left_count / count)) + 1
+        split = min(max(split, 1), length - 1)
+
+        # Each side needs at least as many pixels as tiles; near that limit, shift tiles to the roomier side
+        left_count = min(max(left_count, count - (length - split) * breadth), split * breadth)
+        right_count = count - left_count
+
+        if axis == 0:
+            first, second = (x0, y0, x0 + split, y1), (x0 + split, y0, x1, y1)
+        else:
+            first, second = (x0, y0, x1, y0 + split), (x0, y0 + split, x1, y1)
+        stack.append((second, right_count))
+        stack.append((first, left_count))
+
+    return tiles
+
+
+def strip_tiles(width: int, height: int, num_tasks: int) -> List[Rect]:
+    """The original equal-width vertical strips covering the full height."""
+    return [((width * i) // num_tasks, 0, (width * (i + 1)) // num_tasks, height) for i in range(num_tasks)]
+
+
+def grid_bands(width: int, height: int, num_tasks: int) -> int:
+    """
+    Number of horizontal bands for a "grid" layout of num_tasks tiles: as close to square tiles as
+    possible, while no band needs more tiles than it has columns or more bands than there are rows.
+    """
+    bands = round(math.sqrt(num_tasks * height / width))
+    return min(max(bands, -(-num_tasks // width), 1), height, num_tasks)
+
+
+def grid_tile(i: int, num_tasks: int, bands: int, width: int, height: int) -> Rect:
+    """
+    Tile i of a "grid" layout: num_tasks tiles spread evenly over the bands, row-major. Computed in
+    O(1) from the index alone, so lazy jobs can generate any tile without the ones before it.
+    """
+    band = ((i + 1) * bands + num_tasks - 1) // num_tasks - 1
+    first = (num_tasks * band) // bands
+    band_tiles = (num_tasks * (band + 1)) // bands - first
+    column = i - first
+    return (
+        (width * column) // band_tiles,
+        (height * band) // bands,
+        (width * (column + 1)) // band_tiles,
+        (height * (band + 1)) // bands,
+    )
+
+
+def tile_region(rect: Rect, x_min: float, x_max: float, y_min: float, y_max: float,
+                width: int, height: int) -> dict:
+    """Complex-plane bounds and pixel placement of a tile, in the shape of a task's instruction_data."""
+    x0, y0, x1, y1 = rect
+    x_step = (x_max - x_min) / width
+    y_step = (y_max - y_min) / height
+    return {
+        "x_min": x_min + x0 * x_step,
+        "x_max": x_max if x1 == width else x_min + x1 * x_step,
+        "y_min": y_min + y0 * y_step,
+        "y_max": y_max if y1 == height else y_min + y1 * y_step,
+        "width": x1 - x0,
+        "height": y1 - y0,
+        "pixel_x": x0,
+        "pixel_y": y0,
+    }
@@ -0,0 +1,116 @@
+from typing import Dict, Tuple
+
+import gridfs
+from flask import Request
+from werkzeug.datastructures import MultiDict
+from werkzeug.formparser import FormDataParser
+
+"""
+Streaming multipart uploads into GridFS.
+
+Flask's request.files spools every file part to memory or a temporary file before the view runs.
+parse_into_gridfs instead hands Werkzeug's multipart parser a stream factory that writes each
+file part into its own GridFS file chunk by chunk while the body is being read, so a batch of
+results is never held in memory or on local disk. Plain form fields are parsed as usual.
+"""
+
+
+class GridFSPart:
+    """Write target for one file part. Werkzeug calls seek(0) once the part is complete, which closes the GridFS file."""
+    __slots__ = ['grid_in']
+
+    def __init__(self, fs: gridfs.GridFS, filename: str, content_type: str):
+        self.grid_in = fs.new_file(filename=filename, contentType=content_type)
+
+    def write(self, data: bytes) -> int:
+        self.grid_in.write(data)
+        return len(data)
+
+    def seek(self, offset: int, whence: int = 0) -> int:
+        if not self.grid_in.closed:
+            self.grid_in.close()
+        return 0
+
+    @property
+    def file_id(self):
+        return self.grid_in._id
+
+    @property
+    def complete(self) -> bool:
+        return self.grid_in.closed
+
+
+def parse_into_gridfs(request: Request, fs: gridfs.GridFS) -> Tuple[MultiDict, Dict[str, GridFSPart]]:
+    """
+    Parses a multipart/form-data request, streaming every file part into GridFS.
+
+    Returns:
+        The form fields, and the GridFS file of every complete file part keyed by its field name.
+        If the body is cut off or malformed, every file written so far is deleted and the
+        parser's error is raised.
+    """
+    parts = []
+
+    def stream_factory(total_content_length, content_type, filename, content_length=None):
+        part = GridFSPart(fs, filename, content_type or "application/octet-stream")
+        parts.append(part)
+        return part
+
+    parser = FormDataParser(
+        stream_factory=stream_factory,
+        max_form_memory_size=request.max_form_memory_size,
+        max_content_length=request.max_content_length,
+        max_form_parts=request.max_form_parts,
+        cls=MultiDict,
+        silent=False,
+    )
+    try:
+        _, form, files = parser.parse(request.stream, request.mimetype, request.content_length,
+                                      request.mimetype_params)
+    except Exception:
+        discard_parts(fs, parts)
+        raise
+
+    incomplete = [part for part in parts if not part.complete]
+    if incomplete:
+        discard_parts(fs, parts)
+        raise ValueError("Multipart body ended in the middle of a file part")
+    return form, {name: storage.stream for name, storage in files.items()}
+
+
+def discard_parts(fs: gridfs.GridFS, parts):
+    for part in parts:
+        if part.complete:
+            fs.delete(part.file_id)
+        else:
+            part.grid_in.abort()
+
+
+def file_fields(metadata: dict) -> dict:
+    """
+    $set for the fs.files document of an uploaded part from a node's result metadata. Only filename
+    and contentType are set at the top level; everything else goes into the file's metadata
+    document, so a node can never overwrite fields GridFS owns (length, chunkSize, uploadDate, ...).
+    Keys starting with '$' or containing '.' are dropped.
+
+    Raises:
+        ValueError: If metadata, or its nested 'metadata', is not a JSON object.
+    """
+    if not isinstance(metadata, dict):
+        raise ValueError("metadata must be an object")
+    nested = metadata.get("metadata") or {}
+    if not isinstance(nested, dict):
+        raise ValueError("metadata.metadata must be an object")
+
+    def safe(key) -> bool:
+        return isinstance(key, str) and key and not key.startswith("$") and "." not in key
+
+    fields = {key: metadata[key] for key in ("filename", "contentType") if isinstance(metadata.get(key), str)}
+    extra = {key: value for key, value in nested.items() if safe(key)}
+    extra.update(
+        (key, value) for key, value in metadata.items()
+        if key not in ("filename", "contentType", "metadata", "_id") and safe(key)
+    )
+    if extra:
+        fields["metadata"] = extra
+    return fields
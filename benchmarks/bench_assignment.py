@@ -0,0 +1,144 @@
+"""
+Makespan and fleet utilization of a batch of jobs on a heterogeneous fleet under several
+assignment policies, all driven by the real NodeLoadIndex:
+
+- depth: the node with the shortest inbox gets the next task, whatever its speed
+- ect: expected completion time, (depth + 1) * the node's observed seconds per task, with inbox
+  depth scaled by relative speed (see app/utilities/node_load.py)
+- +steal: once the pool is empty, an idle node steals queued tasks off the back of the most
+  backlogged peer's inbox (NodeLoadIndex.steal_candidates), as app.utilities.assign_tasks does
+
+Every node works through its inbox one task at a time. Task cost varies like escape-time slices do
+(lognormal). Under ect the server learns each node's speed the way app.utilities.node_stats does,
+from an EWMA of the tasks it completes. The fleet first works through --warmup jobs that are not
+measured; with --warmup 0 the measured batch starts on a fleet nothing is known about. Usage:
+
+    python benchmarks/bench_assignment.py [--fleet 2x32,6x6,16x0.5] [--jobs 8] [--tasks 64] [--depth 8] [--warmup 2]
+
+--fleet is a comma-separated list of <count>x<speed>, speed in work units per second.
+"""
+import argparse
+import heapq
+import os
+import random
+import statistics
+import sys
+from collections import deque
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.utilities.node_load import NodeLoadIndex  # noqa: E402
+
+
+def parse_fleet(spec: str) -> list:
+    speeds = []
+    for group in spec.split(","):
+        count, speed = group.lower().split("x")
+        speeds.extend([float(speed)] * int(count))
+    return speeds
+
+
+def simulate(policy: str, speeds: list, work: list, max_depth: int, alpha: float, observed: dict) -> dict:
+    """
+    Runs every task to completion, starting from the per-node averages in observed (updated in
+    place). Returns the makespan and per-task completion times.
+    """
+    index = NodeLoadIndex(max_age_seconds=float("inf"))
+    nodes = [f"node-{i}" for i in range(len(speeds))]
+    index.rebuild({node_id: 0 for node_id in nodes}, costs=dict(observed) if policy.startswith("ect") else None)
+    inboxes = {node_id: deque() for node_id in nodes}
+    busy = {node_id: False for node_id in nodes}
+    pool = deque(work)
+    events = []
+    now = 0.0
+    finished = []
+    busy_seconds = 0.0
+
+    def start(node_id):
+        if not busy[node_id] and inboxes[node_id]:
+            busy[node_id] = True
+            cost = inboxes[node_id][0]
+            heapq.heappush(events, (now + cost / speeds[nodes.index(node_id)], node_id))
+
+    def fill():
+        picks = index.spread(len(pool), max_depth)
+        for node_id in picks:
+            inboxes[node_id].append(pool.popleft())
+        for node_id in set(picks):
+            start(node_id)
+
+    def steal():
+        for node_id in nodes:
+            if busy[node_id] or inboxes[node_id]:
+                continue
+            for victim, share in index.steal_candidates(node_id, max_depth):
+                queued = len(inboxes[victim]) - busy[victim]  # the head of a busy inbox is running
+                taken = [inboxes[victim].pop() for _ in range(min(share, queued))]
+                if taken:
+                    inboxes[node_id].extend(reversed(taken))
+                    index.adjust(victim, -len(taken))
+                    index.adjust(node_id, len(taken))
+                    start(node_id)
+                    break
+
+    fill()
+    while events:
+        now, node_id = heapq.heappop(events)
+        cost = inboxes[node_id].popleft()
+        busy[node_id] = False
+        finished.append(now)
+        seconds = cost / speeds[nodes.index(node_id)]
+        busy_seconds += seconds
+        index.adjust(node_id, -1)
+        if policy.startswith("ect"):
+            previous = observed.get(node_id)
+            observed[node_id] = seconds if previous is None else alpha * seconds + (1 - alpha) * previous
+            index.set_cost(node_id, observed[node_id])
+        fill()
+        start(node_id)
+        if policy.endswith("+steal") and not pool:
+            steal()
+
+    return {"makespan": now, "finished": finished, "utilization": busy_seconds / (len(nodes) * now)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--fleet", default="2x32,6x6,16x0.5")
+    parser.add_argument("--jobs", type=int, default=8)
+    parser.add_argument("--tasks", type=int, default=64, help="tasks per job")
+    parser.add_argument("--depth", type=int, default=8, help="INBOX_TARGET_DEPTH")
+    parser.add_argument("--sigma", type=float, default=0.8, help="lognormal spread of task cost")
+    parser.add_argument("--alpha", type=float, default=0.2, help="EWMA weight of each observation")
+    parser.add_argument("--warmup", type=int, default=2, help="unmeasured jobs run first")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    speeds = parse_fleet(args.fleet)
+    print(f"{len(speeds)} nodes, total speed {sum(speeds):g}, {args.jobs} jobs x {args.tasks} tasks, depth {args.depth}")
+    print(f"{'policy':>11} {'makespan':>10} {'vs bound':>9} {'median done':>12} {'utilization':>12}")
+    results = {"depth": [], "depth+steal": [], "ect": [], "ect+steal": []}
+    bounds = []
+    for run in range(args.runs):
+        rng = random.Random(args.seed + run)
+        warmup = [rng.lognormvariate(0, args.sigma) for _ in range(args.warmup * args.tasks)]
+        work = [rng.lognormvariate(0, args.sigma) for _ in range(args.jobs * args.tasks)]
+        bounds.append(max(sum(work) / sum(speeds), max(work) / max(speeds)))
+        for policy in results:
+            observed = {}
+            if warmup:
+                simulate(policy, speeds, warmup, args.depth, args.alpha, observed)
+            results[policy].append(simulate(policy, speeds, work, args.depth, args.alpha, observed))
+
+    bound = statistics.mean(bounds)
+    for policy, runs in results.items():
+        makespan = statistics.mean(result["makespan"] for result in runs)
+        median_done = statistics.mean(statistics.median(result["finished"]) for result in runs)
+        utilization = statistics.mean(result["utilization"] for result in runs)
+        print(f"{policy:>11} {makespan:>9.1f}s {makespan / bound:>8.2f}x {median_done:>11.1f}s {utilization:>11.0%}")
+    print(f"lower bound (total work / total speed): {bound:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
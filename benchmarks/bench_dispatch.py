@@ -0,0 +1,137 @@
+"""
+Wait time per priority class under a mixed synthetic load, for the dispatch orders a node could use
+when claiming from its inbox:
+
+- arbitrary: any ASSIGNED task, the old /node/task behaviour
+- fifo: oldest first, ignoring priority
+- priority: strict (priority_level, queued_at) order
+- aging: (priority_level, queued_at) with one level of promotion per --aging-s waited, down to
+  AGING_FLOOR, as the reaper does
+
+Interactive (high) renders arrive steadily, normal jobs less often, and batch (low) jobs arrive as
+large bursts of tasks. Usage:
+
+    python benchmarks/bench_dispatch.py [--workers 16] [--load 0.95] [--duration 3600] [--aging-s 120]
+"""
+import argparse
+import heapq
+import os
+import random
+import sys
+from collections import deque
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.utilities.dispatch import AGING_FLOOR, PRIORITY_NAMES, normalize_priority  # noqa: E402
+
+# (priority, share of the offered work, tasks per job, mean task seconds)
+WORKLOAD = [
+    ("high", 0.15, 4, 1.0),
+    ("normal", 0.35, 16, 2.0),
+    ("low", 0.50, 256, 4.0),
+]
+
+
+def generate_arrivals(workers: int, load: float, duration: float, rng: random.Random) -> list:
+    """Poisson job arrivals per class, sized so the fleet is busy load of the time. Returns sorted tasks."""
+    tasks = []
+    for priority, share, tasks_per_job, task_seconds in WORKLOAD:
+        level = normalize_priority(priority)
+        job_rate = workers * load * share / (tasks_per_job * task_seconds)
+        now = rng.expovariate(job_rate)
+        while now < duration:
+            for _ in range(tasks_per_job):
+                tasks.append((now, level, rng.expovariate(1 / task_seconds)))
+            now += rng.expovariate(job_rate)
+    tasks.sort()
+    return tasks
+
+
+class Queue:
+    def __init__(self, order: str, aging_seconds: float, rng: random.Random):
+        self.order = order
+        self.aging_seconds = aging_seconds
+        self.rng = rng
+        self.levels = [deque() for _ in PRIORITY_NAMES]
+        self.size = 0
+
+    def push(self, task):
+        self.levels[task[1]].append(task)
+        self.size += 1
+
+    def pop(self, now: float):
+        self.size -= 1
+        heads = [level for level in self.levels if level]
+        if self.order == "arbitrary":
+            level = self.rng.choices(self.levels, weights=[len(level) for level in self.levels])[0]
+            index = self.rng.randrange(len(level))
+            task = level[index]
+            del level[index]
+            return task
+        if self.order == "fifo":
+            return min(heads, key=lambda level: level[0][0]).popleft()
+        if self.order == "priority":
+            return heads[0].popleft()
+
+        # aging: each class's head is its oldest task, so it also has the lowest effective level
+        def effective(level):
+            queued_at, priority_level, _ = level[0]
+            if priority_level > AGING_FLOOR:
+                priority_level = max(AGING_FLOOR, priority_level - int((now - queued_at) // self.aging_seconds))
+            return priority_level, queued_at
+        return min(heads, key=effective).popleft()
+
+
+def simulate(arrivals: list, workers: int, order: str, aging_seconds: float, seed: int) -> dict:
+    """Returns the list of waits per priority level."""
+    queue = Queue(order, aging_seconds, random.Random(seed))
+    free_at = [0.0] * workers  # heap of times at which workers become free
+    waits = {level: [] for level in range(len(PRIORITY_NAMES))}
+    next_arrival = 0
+    clock = 0.0  # arrival time of the latest task admitted to the queue
+
+    while next_arrival < len(arrivals) or queue.size:
+        worker_free = free_at[0]
+        if queue.size == 0 or (next_arrival < len(arrivals) and arrivals[next_arrival][0] <= worker_free):
+            queue.push(arrivals[next_arrival])
+            clock = arrivals[next_arrival][0]
+            next_arrival += 1
+            continue
+        # Everything that arrived before the worker freed up is queued; an idle worker waits for the queue
+        now = max(worker_free, clock)
+        task = queue.pop(now)
+        waits[task[1]].append(now - task[0])
+        heapq.heapreplace(free_at, now + task[2])
+    return waits
+
+
+def percentile(values: list, fraction: float) -> float:
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=16)
+    parser.add_argument("--load", type=float, default=0.95, help="offered work / fleet capacity")
+    parser.add_argument("--duration", type=float, default=3600, help="seconds of arrivals")
+    parser.add_argument("--aging-s", type=float, default=120, help="PRIORITY_AGING_SECONDS")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    arrivals = generate_arrivals(args.workers, args.load, args.duration, random.Random(args.seed))
+    print(f"{args.workers} workers, load {args.load}, {len(arrivals)} tasks over {args.duration:.0f}s, "
+          f"aging every {args.aging_s:.0f}s")
+    print(f"{'order':>10} " + " ".join(f"{name + ' p50':>11} {name + ' p99':>11}" for name in PRIORITY_NAMES))
+    for order in ("arbitrary", "fifo", "priority", "aging"):
+        waits = simulate(arrivals, args.workers, order, args.aging_s, args.seed)
+        cells = []
+        for level in range(len(PRIORITY_NAMES)):
+            cells.append(f"{percentile(waits[level], 0.50):>10.1f}s {percentile(waits[level], 0.99):>10.1f}s")
+        print(f"{order:>10} " + " ".join(cells))
+
+
+if __name__ == "__main__":
+    main()
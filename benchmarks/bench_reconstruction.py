@@ -0,0 +1,89 @@
+"""
+Reconstruction latency against task count: serial fetch + decode versus the thread pool used by
+/client/completed-job.
+
+GridFS is simulated with in-memory PNG slices and a fixed per-read delay, so the benchmark runs
+without a database. Usage:
+
+    python benchmarks/bench_reconstruction.py [--width 3840] [--height 2160] [--fetch-ms 5] [--workers 8]
+"""
+import argparse
+import os
+import sys
+import time
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.utilities.compositor import RgbCanvas, composite_parallel, decode_image  # noqa: E402
+
+
+def make_slices(width: int, height: int, num_tasks: int) -> list:
+    """Encodes num_tasks vertical strips of a synthetic gradient, like the strips nodes upload."""
+    xs = np.linspace(0, 255, width, dtype=np.float32)
+    ys = np.linspace(0, 255, height, dtype=np.float32)
+    pixels = np.empty((height, width, 3), dtype=np.uint8)
+    pixels[..., 0] = xs[np.newaxis, :]
+    pixels[..., 1] = ys[:, np.newaxis]
+    pixels[..., 2] = (xs[np.newaxis, :] + ys[:, np.newaxis]) / 2
+
+    slices = []
+    for i in range(num_tasks):
+        left, right = (width * i) // num_tasks, (width * (i + 1)) // num_tasks
+        buffer = BytesIO()
+        Image.fromarray(pixels[:, left:right]).save(buffer, format="PNG")
+        slices.append((buffer.getvalue(), (left, 0)))
+    return slices
+
+
+def fetcher(data: bytes, fetch_seconds: float):
+    def load():
+        time.sleep(fetch_seconds)  # stands in for the GridFS round trip
+        return decode_image(data)
+    return load
+
+
+def run_serial(width, height, slices, fetch_seconds):
+    canvas = RgbCanvas(width, height)
+    for data, (offset_x, offset_y) in slices:
+        image = fetcher(data, fetch_seconds)()
+        canvas.paste(image, offset_x, offset_y)
+    canvas.close()
+
+
+def run_parallel(width, height, slices, fetch_seconds, workers):
+    canvas = RgbCanvas(width, height)
+    composite_parallel(canvas, [(fetcher(data, fetch_seconds), offset) for data, offset in slices], workers)
+    canvas.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--width", type=int, default=3840)
+    parser.add_argument("--height", type=int, default=2160)
+    parser.add_argument("--fetch-ms", type=float, default=5.0, help="simulated GridFS latency per slice")
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--tasks", type=int, nargs="+", default=[4, 16, 64, 256])
+    args = parser.parse_args()
+
+    print(f"{args.width}x{args.height}, {args.fetch_ms} ms per fetch, {args.workers} workers")
+    print(f"{'tasks':>6} {'serial ms':>10} {'parallel ms':>12} {'speedup':>8}")
+    for num_tasks in args.tasks:
+        slices = make_slices(args.width, args.height, num_tasks)
+
+        start = time.perf_counter()
+        run_serial(args.width, args.height, slices, args.fetch_ms / 1000)
+        serial = time.perf_counter() - start
+
+        start = time.perf_counter()
+        run_parallel(args.width, args.height, slices, args.fetch_ms / 1000, args.workers)
+        parallel = time.perf_counter() - start
+
+        print(f"{num_tasks:>6} {serial * 1000:>10.1f} {parallel * 1000:>12.1f} {serial / parallel:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""
+Payload size and CPU cost of the two result formats a worker can upload for one slice:
+
+- png: the slice colored on the worker and encoded as a 24-bit PNG
+- iterations: the raw escape counts with the MBIT header, zlib (and zstd if installed) compressed
+
+and the server-side cost of coloring counts through the palette lookup table, against
+interpolating every pixel. The slice is a real escape-time render. Usage:
+
+    python benchmarks/bench_result_format.py [--width 1024] [--height 768] [--max-iter 1000]
+"""
+import argparse
+import os
+import sys
+import time
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.utilities.iterations import (  # noqa: E402
+    colorize, decode_iterations, encode_iterations, interpolate, normalize_palette, zstandard
+)
+from app.utilities.tiling import escape_time_grid  # noqa: E402
+
+
+def timed(fn, repeat: int):
+    """Returns the last result of fn and its best time over repeat runs, in milliseconds."""
+    best = float("inf")
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return result, best * 1000
+
+
+def encode_png(counts: np.ndarray, max_iter: int) -> bytes:
+    buffer = BytesIO()
+    Image.fromarray(colorize(counts, max_iter)).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--width", type=int, default=1024)
+    parser.add_argument("--height", type=int, default=768)
+    parser.add_argument("--max-iter", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    counts = escape_time_grid(-2.0, 1.0, -1.2, 1.2, args.width, args.height, args.max_iter)
+    print(f"{args.width}x{args.height} slice, max_iter {args.max_iter}, raw RGB {counts.size * 3 / 1024:.0f} KiB")
+
+    print(f"{'format':>16} {'bytes':>10} {'worker encode':>14} {'server decode':>14}")
+    formats = [("png", lambda: encode_png(counts, args.max_iter), lambda data: decode_png(data))]
+    for codec, level in [("zlib", 1), ("zlib", 6)] + ([("zstd", 3), ("zstd", 19)] if zstandard else []):
+        formats.append((
+            f"iterations {codec}-{level}",
+            lambda codec=codec, level=level: encode_iterations(counts, args.max_iter, codec, level),
+            lambda data: decode_iterations(data),
+        ))
+    for name, encode, decode in formats:
+        data, encode_ms = timed(encode, args.repeat)
+        _, decode_ms = timed(lambda: decode(data), args.repeat)
+        print(f"{name:>16} {len(data):>10} {encode_ms:>12.1f}ms {decode_ms:>12.1f}ms")
+    if not zstandard:
+        print("(zstd rows skipped: the zstandard package is not installed)")
+
+    stops = normalize_palette("fire")
+    _, lut_ms = timed(lambda: colorize(counts, args.max_iter, stops), args.repeat)
+    _, interp_ms = timed(lambda: interpolate(stops, counts, args.max_iter), args.repeat)
+    print(f"colorize: lookup table {lut_ms:.1f}ms, per-pixel interpolation {interp_ms:.1f}ms")
+
+
+def decode_png(data: bytes) -> np.ndarray:
+    with Image.open(BytesIO(data)) as image:
+        return np.asarray(image.convert("RGB"))
+
+
+if __name__ == "__main__":
+    main()
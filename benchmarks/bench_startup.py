@@ -0,0 +1,137 @@
+"""
+Cold start and idle connections of forked server workers, with the previous per-database clients
+and with the shared lazy client of app/utilities/mongo.py:
+
+- legacy: every DataBase built its own MongoClient and pinged it in the constructor, so a worker
+  opened two pools and blocked on two round trips (or on the server selection timeout) at import
+- shared: both DataBase instances use the process's one client, created with connect=False;
+  building them touches nothing and the first query connects
+
+Each mode forks --workers processes like a pre-fork server. A worker times building its two
+databases and its first query on each, then idles while the parent reads the server's current
+connection count (serverStatus) and subtracts the count from before the fork. Threads are the
+worker's live threads, mostly pymongo monitors, one set per client. Usage:
+
+    MONGO_CONNECTION_STRING=mongodb://localhost:27017 python benchmarks/bench_startup.py [--workers 8] [--idle 2]
+
+Without a reachable server the connection column reads n/a and legacy workers fail after the
+server selection timeout, which is the startup cost the lazy client removes.
+"""
+import argparse
+import multiprocessing
+import os
+import statistics
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pymongo.errors import PyMongoError  # noqa: E402
+from pymongo.mongo_client import MongoClient  # noqa: E402
+from pymongo.server_api import ServerApi  # noqa: E402
+
+from app import dbs  # noqa: E402
+from app.utilities.database import DataBase  # noqa: E402
+
+
+def build_legacy(uri: str, timeout_ms: int) -> list:
+    databases = []
+    for name in dbs:
+        client = MongoClient(uri, server_api=ServerApi('1'), serverSelectionTimeoutMS=timeout_ms)
+        client.admin.command('ping')
+        databases.append(client[name])
+    return databases
+
+
+def build_shared(uri: str, timeout_ms: int) -> list:
+    options = {"serverSelectionTimeoutMS": timeout_ms}
+    return [DataBase(uri, name, options).db for name in dbs]
+
+
+BUILDERS = {"legacy": build_legacy, "shared": build_shared}
+
+
+def worker(mode: str, uri: str, timeout_ms: int, results, release):
+    result = {"pid": os.getpid()}
+    start = time.perf_counter()
+    try:
+        databases = BUILDERS[mode](uri, timeout_ms)
+        result["build"] = time.perf_counter() - start
+        for database in databases:
+            database["all_nodes"].find_one({})
+        result["first_query"] = time.perf_counter() - start
+    except PyMongoError as e:
+        result["error"] = f"{type(e).__name__} after {time.perf_counter() - start:.2f}s"
+    result["threads"] = threading.active_count()
+    results.put(result)
+    release.wait()
+
+
+def server_connections(observer: MongoClient):
+    if observer is None:
+        return None
+    try:
+        return observer.admin.command("serverStatus")["connections"]["current"]
+    except PyMongoError:
+        return None
+
+
+def run(mode: str, uri: str, workers: int, idle: float, timeout_ms: int, observer) -> dict:
+    context = multiprocessing.get_context("fork")
+    results = context.Queue()
+    release = context.Event()
+    before = server_connections(observer)
+    processes = [context.Process(target=worker, args=(mode, uri, timeout_ms, results, release)) for _ in range(workers)]
+    for process in processes:
+        process.start()
+    reports = [results.get() for _ in processes]
+    time.sleep(idle)
+    after = server_connections(observer)
+    release.set()
+    for process in processes:
+        process.join()
+
+    built = [report["build"] for report in reports if "build" in report]
+    queried = [report["first_query"] for report in reports if "first_query" in report]
+    return {
+        "build": statistics.median(built) if built else None,
+        "first_query": statistics.median(queried) if queried else None,
+        "threads": statistics.median(report["threads"] for report in reports),
+        "connections": after - before if before is not None and after is not None else None,
+        "errors": [report["error"] for report in reports if "error" in report],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--uri", default=os.getenv("MONGO_CONNECTION_STRING", "mongodb://localhost:27017"))
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--idle", type=float, default=2, help="seconds workers idle before connections are counted")
+    parser.add_argument("--timeout-ms", type=int, default=5000, help="server selection timeout")
+    parser.add_argument("--modes", default="legacy,shared")
+    args = parser.parse_args()
+
+    try:
+        observer = MongoClient(args.uri, serverSelectionTimeoutMS=args.timeout_ms)
+        observer.admin.command("ping")
+    except PyMongoError as e:
+        print(f"no server at {args.uri} ({type(e).__name__}), connections are not counted")
+        observer = None
+
+    def seconds(value):
+        return f"{value * 1000:.1f} ms" if value is not None else "failed"
+
+    print(f"{args.workers} workers")
+    print(f"{'mode':<8} {'build':>10} {'first query':>12} {'threads':>8} {'connections':>12}")
+    for mode in args.modes.split(","):
+        result = run(mode, args.uri, args.workers, args.idle, args.timeout_ms, observer)
+        connections = result["connections"] if result["connections"] is not None else "n/a"
+        print(f"{mode:<8} {seconds(result['build']):>10} {seconds(result['first_query']):>12} "
+              f"{result['threads']:>8} {connections:>12}")
+        if result["errors"]:
+            print(f"         {len(result['errors'])} workers failed, e.g. {result['errors'][0]}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""
+Simulated makespan of equal-width strips versus cost-balanced 2D tiles (tiling="balanced").
+
+The true cost of every task is measured on a reference escape-time grid much finer than the one
+the tiler samples, then the tasks are handed to a fleet of identical workers in order, each one
+taking the next task as soon as it is free. Makespan is reported in millions of iterations, so
+the result does not depend on the machine. Usage:
+
+    python benchmarks/bench_tiling.py [--width 3840] [--height 2160] [--workers 8] [--max-iter 1000]
+"""
+import argparse
+import heapq
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.utilities.tiling import (  # noqa: E402
+    balanced_tiles, escape_time_grid, estimate_cost_grid, strip_tiles
+)
+
+REGIONS = {
+    "full": (-2.0, 1.0, -1.5, 1.5),
+    "seahorse": (-0.80, -0.70, 0.05, 0.15),
+    "edge": (-1.0, 0.5, 0.0, 1.2),
+}
+
+
+def tile_costs(tiles, width, height, reference: np.ndarray) -> np.ndarray:
+    """Sums the reference iteration counts falling in each tile, scaled to the full resolution."""
+    ref_height, ref_width = reference.shape
+    pixel_x = ((np.arange(ref_width) + 0.5) * width / ref_width).astype(np.int64)
+    pixel_y = ((np.arange(ref_height) + 0.5) * height / ref_height).astype(np.int64)
+
+    labels = np.empty((height, width), dtype=np.int32)
+    for index, (x0, y0, x1, y1) in enumerate(tiles):
+        labels[y0:y1, x0:x1] = index
+    sampled = labels[np.ix_(pixel_y, pixel_x)]
+
+    costs = np.bincount(sampled.ravel(), weights=reference.ravel(), minlength=len(tiles))
+    return costs * (width * height) / reference.size
+
+
+def makespan(costs: np.ndarray, workers: int) -> float:
+    """Greedy list scheduling in task order, as nodes pulling from their inboxes would do."""
+    finish_times = [0.0] * workers
+    for cost in costs:
+        heapq.heapreplace(finish_times, finish_times[0] + cost)
+    return max(finish_times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--width", type=int, default=3840)
+    parser.add_argument("--height", type=int, default=2160)
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--max-iter", type=int, default=1000, help="iteration limit of the reference render")
+    parser.add_argument("--ref-width", type=int, default=960, help="width of the reference cost grid")
+    parser.add_argument("--tasks", type=int, nargs="+", default=[8, 16, 64, 256])
+    args = parser.parse_args()
+
+    ref_height = max(1, round(args.ref_width * args.height / args.width))
+    print(f"{args.width}x{args.height}, {args.workers} workers, reference {args.ref_width}x{ref_height} "
+          f"at {args.max_iter} iterations")
+    print(f"{'region':>9} {'tasks':>6} {'strips Mit':>11} {'balanced Mit':>13} {'speedup':>8} "
+          f"{'strip max/mean':>15} {'tile max/mean':>14} {'tiling ms':>10}")
+
+    for name, (x_min, x_max, y_min, y_max) in REGIONS.items():
+        reference = escape_time_grid(x_min, x_max, y_min, y_max, args.ref_width, ref_height, args.max_iter)
+        reference = reference.astype(np.float64)
+
+        for num_tasks in args.tasks:
+            strips = tile_costs(strip_tiles(args.width, args.height, num_tasks), args.width, args.height, reference)
+
+            start = time.perf_counter()
+            cost = estimate_cost_grid(x_min, x_max, y_min, y_max, args.width, args.height)
+            tiles = balanced_tiles(args.width, args.height, num_tasks, cost)
+            tiling_ms = (time.perf_counter() - start) * 1000
+            balanced = tile_costs(tiles, args.width, args.height, reference)
+
+            strip_span = makespan(strips, args.workers)
+            tile_span = makespan(balanced, args.workers)
+            print(f"{name:>9} {num_tasks:>6} {strip_span / 1e6:>11.1f} {tile_span / 1e6:>13.1f} "
+                  f"{strip_span / tile_span:>7.2f}x {strips.max() / strips.mean():>15.2f} "
+                  f"{balanced.max() / balanced.mean():>14.2f} {tiling_ms:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,139 @@
+import os
+import tempfile
+
+
 class Config:
     DEBUG = True
     SECRET_KEY = 'your-secret-key-here'
     ENV = 'development'
 
+    # MongoDB deployment and the pool of the one client each process shares (see app/utilities/mongo.py). Pool
+    # connections idle for MONGO_MAX_IDLE_TIME_MS are closed; a timeout of 0 means no limit.
+    MONGO_CONNECTION_STRING = os.getenv("MONGO_CONNECTION_STRING")
+    MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", 100))
+    MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", 0))
+    MONGO_MAX_IDLE_TIME_MS = int(os.getenv("MONGO_MAX_IDLE_TIME_MS", 60000))
+    MONGO_CONNECT_TIMEOUT_MS = int(os.getenv("MONGO_CONNECT_TIMEOUT_MS", 10000))
+    MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.getenv("MONGO_SERVER_SELECTION_TIMEOUT_MS", 10000))
+    MONGO_SOCKET_TIMEOUT_MS = int(os.getenv("MONGO_SOCKET_TIMEOUT_MS", 0))
+
+    # Create indexes and start the background threads (reaper, change stream watcher, ingestion) on the first request
+    # of each process instead of in create_app, so the app builds without a reachable database and pre-fork servers
+    # start them in every worker. False restores the fail-fast startup.
+    LAZY_STARTUP = os.getenv("LAZY_STARTUP", "1") not in ("0", "false", "False")
+
+    # Seconds before the in-memory inbox depth index is rebuilt from Mongo
+    NODE_LOAD_REBUILD_SECONDS = 30
+
+    # Seconds a node holds a claimed task before the claim expires unless renewed
+    TASK_LEASE_SECONDS = 300
+
+    # Stranded task reaper: pass interval (0 disables it), node heartbeat timeout and reassignment batch size. Polls, claims
+    # and lease renewals are heartbeats; the timeout is never shorter than TASK_LEASE_SECONDS, so a node busy on one long
+    # task is not expired while its lease holds. An expired node becomes available again on its next poll.
+    REAPER_INTERVAL_SECONDS = 30
+    NODE_HEARTBEAT_TIMEOUT_SECONDS = 360
+    REAPER_BATCH_SIZE = 500
+    # Seconds after which the reaper finishes or rolls back a multi-write task move (requeue, steal, batch completion)
+    # that never completed, e.g. because its server process died in the middle
+    ORPHANED_MOVE_SECONDS = 60
+
+    # Jobs with at least LAZY_JOB_MIN_TASKS tasks store a task range and generate tasks as nodes pull
+    # work, LAZY_PULL_BATCH at a time into an empty inbox
+    LAZY_JOB_MIN_TASKS = 1024
+    LAZY_PULL_BATCH = 16
+
+    # Seconds a queued task waits before the reaper promotes it one priority level (0 disables aging). Aging stops at
+    # normal; a task queued for more than PRIORITY_MAX_WAIT_SECONDS is promoted to high, so none waits forever (0 disables)
+    PRIORITY_AGING_SECONDS = 120
+    PRIORITY_MAX_WAIT_SECONDS = 1800
+
+    # Fair share across clients: inboxes are only filled up to INBOX_TARGET_DEPTH tasks (0 = unlimited) and
+    # the rest waits in the unassigned pool; free slots go to the client with the least weighted usage,
+    # in-flight tasks plus completed tasks decayed with the half-life. Unlisted clients weigh 1.
+    INBOX_TARGET_DEPTH = 8
+    CLIENT_WEIGHTS = {}
+    FAIR_SHARE_HALF_LIFE_SECONDS = 300
+    FAIR_SHARE_REBUILD_SECONDS = 30
+
+    # Batch claims (/node/tasks/<node_id>): a node may run one task per advertised core, or enough to keep every
+    # core busy for PREFETCH_TARGET_SECONDS at its observed seconds per task; EWMA weight of each new observation
+    PREFETCH_TARGET_SECONDS = 2
+    PREFETCH_MAX_TASKS = 64
+    PREFETCH_EWMA_ALPHA = 0.2
+
+    # Asynchronous ingestion of /node/submit-image uploads: spooled locally, answered with 202 and a receipt, and
+    # processed by INGEST_WORKERS threads; more than INGEST_QUEUE_SIZE queued uploads are refused with 429.
+    # A receipt still QUEUED after INGEST_STALE_SECONDS is assumed lost and taken over by a retry.
+    ASYNC_INGESTION = False
+    INGEST_WORKERS = 4
+    INGEST_QUEUE_SIZE = 256
+    INGEST_SPOOL_DIR = os.path.join(tempfile.gettempdir(), "dcn-ingest-spool")
+    INGEST_STALE_SECONDS = 300
+    INGEST_RETRY_AFTER_SECONDS = 2
+    # Seconds a finished receipt (COMPLETED, REJECTED or FAILED) is kept for retries and /node/receipt polls
+    INGEST_RECEIPT_TTL_SECONDS = 24 * 3600
+
+    # Result memoization: completed slices are indexed by a hash of their instruction, region and image format, and
+    # identical tasks of later jobs complete from the stored result instead of being dispatched. Beyond
+    # RESULT_CACHE_MAX_BYTES entries are evicted "lru" (least recently used) or "lfu" (least often hit). Change the
+    # namespace to invalidate every entry, e.g. after a renderer change.
+    RESULT_CACHE_ENABLED = True
+    RESULT_CACHE_MAX_BYTES = 10 * 1024 ** 3
+    RESULT_CACHE_EVICTION = "lru"
+    RESULT_CACHE_NAMESPACE = "v1"
+
+    # Work stealing: a node whose inbox ran dry takes unclaimed tasks off the back of the most backlogged peer's inbox
+    WORK_STEALING = True
+
+    # Speculative re-execution: once a job is SPECULATION_MIN_PROGRESS complete, a task RUNNING for SPECULATION_SLOWDOWN
+    # times the job's median task time (and at least SPECULATION_MIN_SECONDS) is copied onto an idle node that is expected
+    # to finish it sooner than it has already run. The first result wins; the other copy is cancelled and its upload discarded.
+    # Stragglers are looked for by the reaper and at most every SPECULATION_SCAN_SECONDS, not on every idle poll.
+    SPECULATION_ENABLED = True
+    SPECULATION_MIN_PROGRESS = 0.9
+    SPECULATION_SLOWDOWN = 3
+    SPECULATION_MIN_SECONDS = 10
+    SPECULATION_SCAN_SECONDS = 15
+
+    # Most task results a node may send in one /node/submit-images request
+    MAX_RESULTS_PER_UPLOAD = 256
+
+    # Long-poll task fetch (/node/task/<node_id>/wait): longest hold, and how often waiters re-check Mongo
+    # when no change stream reports other processes' assignments (TASK_CHANGE_STREAM needs a replica set)
+    LONG_POLL_MAX_SECONDS = 30
+    LONG_POLL_RECHECK_SECONDS = 5
+    TASK_CHANGE_STREAM = True
+
+    # Task storage layout: "per-node" (inbox_/outbox_/dump_ collections per node) or "unified" (one indexed tasks collection)
+    TASK_STORAGE = "per-node"
+
+    # Completed-job reconstruction: rows encoded per PNG band, and where the memory-mapped canvas is spooled (None = system temp dir)
+    COMPOSITE_BAND_HEIGHT = 64
+    COMPOSITE_SPOOL_DIR = None
+    # Threads fetching and decoding slices in parallel during reconstruction
+    COMPOSITE_FETCH_WORKERS = 8
+
+    # Paste each slice into a per-job canvas file as it is submitted and store the final PNG once the job completes.
+    # The reaper deletes canvases of finished or missing jobs once no paste touched them for COMPOSITE_CANVAS_GRACE_SECONDS.
+    COMPOSITE_ON_SUBMIT = True
+    COMPOSITE_CANVAS_DIR = os.path.join(tempfile.gettempdir(), "dcn-canvases")
+    COMPOSITE_CANVAS_GRACE_SECONDS = 300
+
+    # Local disk cache of encoded composites for /client/completed-job, evicted least recently used beyond the size cap
+    COMPOSITE_CACHE_DIR = os.path.join(tempfile.gettempdir(), "dcn-composite-cache")
+    COMPOSITE_CACHE_MAX_BYTES = 2 * 1024 ** 3
+
+    # Tile pyramids (/tiles): tile edge in pixels, deepest zoom (doubles run out of precision around 40 at 256 px),
+    # levels rendered when a pyramid is created, whether the children of a requested tile are prefetched, bytes of
+    # encoded tiles kept in memory per process, and the Retry-After sent while a tile is rendering
+    TILE_SIZE = 256
+    TILE_MAX_ZOOM = 40
+    TILE_PREFETCH_ZOOM = 2
+    TILE_PREFETCH_CHILDREN = True
+    TILE_MEMORY_CACHE_BYTES = 256 * 1024 ** 2
+    TILE_RETRY_AFTER_SECONDS = 1
+
+    # Store a thumbnail of every submitted slice for /client/job/<job_id>/preview, and the preview's width
+    PREVIEWS_ENABLED = True
+    PREVIEW_MAX_WIDTH = 512